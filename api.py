@@ -0,0 +1,187 @@
+"""The checks as a library, for callers holding sheets in memory.
+
+    import api
+    problems = api.validate_vineyard(frame)
+
+Importing this module doesn't import pandas or the checks, the first
+call does, so tools that only need the names here start quickly. A long
+running process such as a service keeps a `Workbook`, which reads its
+sheets once and again only after the file changes, and validates per
+request without paying for the startup or the read.
+
+Sheets may be as read from the workbook or as returned by `main.data_in`:
+indexed by Membership Number or holding it as a column, with or without
+the dtype plan of `schema`.
+"""
+import os
+import threading
+
+#############
+# variables
+
+index_column = 'Membership Number'
+validated_sheets = ['Vineyard', 'Winery']
+
+
+def prepare(data):
+    """Returns a sheet indexed by Membership Number with the dtype plan.
+
+    Args:
+        data: the sheet as a DataFrame, which isn't changed.
+
+    Returns:
+        A DataFrame ready for the checks.
+    """
+    import schema
+    from loader import normalise_index
+
+    if data.index.name != index_column and index_column in data.columns:
+        data = normalise_index(data.copy(), index_column)
+    # The plan leaves planned columns as they are
+    return schema.apply(data)
+
+
+def validation(sheet_name):
+    """Returns the `main.Validation` of a sheet.
+
+    Raises:
+        KeyError: if the sheet has no checks.
+    """
+    import main
+
+    validations = {check.name: check for check in (main.vineyard,
+                                                   main.winery)}
+    return validations[sheet_name]
+
+
+def validate_sheet(data, sheet_name, settings=None):
+    """Returns the problems found in a sheet.
+
+    Args:
+        data: the sheet as a DataFrame.
+        sheet_name: 'Vineyard' or 'Winery', which checks to run.
+        settings: a `main.Settings` of how problems are found, the
+            defaults if None.
+
+    Returns:
+        A DataFrame of the problems of each member with any, indexed by
+        the zero padded Membership Number.
+    """
+    import main
+
+    return main.validate(prepare(data), validation(sheet_name), settings)
+
+
+def validate_vineyard(data, settings=None):
+    """Returns the problems found in a Vineyard sheet, see
+    `validate_sheet`."""
+    return validate_sheet(data, 'Vineyard', settings)
+
+
+def validate_winery(data, settings=None):
+    """Returns the problems found in a Winery sheet, see
+    `validate_sheet`."""
+    return validate_sheet(data, 'Winery', settings)
+
+
+def validate(sheets, settings=None):
+    """Returns the problems found in sheets keyed by sheet name.
+
+    Args:
+        sheets: a dict of DataFrames keyed by sheet name.
+        settings: a `main.Settings`, the defaults if None.
+
+    Returns:
+        A dict of problems DataFrames for the sheets with checks.
+    """
+    return {name: validate_sheet(data, name, settings)
+            for name, data in sheets.items() if name in validated_sheets}
+
+
+def validate_across(sheets):
+    """Returns the problems found across sheets for the members in every
+    one of them, see `crosscheck`.
+
+    Args:
+        sheets: a dict of DataFrames keyed by sheet name.
+
+    Returns:
+        A DataFrame of the problems of each member with any.
+    """
+    import crosscheck
+
+    return crosscheck.validate({name: prepare(data)
+                                for name, data in sheets.items()})
+
+
+class Workbook:
+    """A workbook kept warm in a long running process.
+
+    The sheets are read on first use and again whenever the file's
+    modification time or size changes, and the problems of each sheet
+    are kept until then. The methods may be called from several threads.
+
+    Args:
+        path: the workbook path.
+        sheet_names: the sheets to read, defaults to
+            `validated_sheets`.
+        use_cache: whether to go through the Parquet cache.
+        settings: a `main.Settings` the problems are found with, the
+            defaults if None.
+    """
+
+    def __init__(self, path='data.xlsx', sheet_names=None, use_cache=True,
+                 settings=None):
+        self.path = path
+        self.sheet_names = list(sheet_names or validated_sheets)
+        self.use_cache = use_cache
+        self.settings = settings
+        self.version = None
+        self.sheets = {}
+        self.found = {}
+        self.lock = threading.RLock()
+
+    def stamp(self):
+        """Returns the modification time and size of the file."""
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def changed(self):
+        """Returns whether the file changed since the sheets were read."""
+        return self.stamp() != self.version
+
+    def load(self, force=False):
+        """Reads the sheets if the file changed since they were read.
+
+        Args:
+            force: read them even if it hasn't.
+
+        Returns:
+            Whether the sheets were read.
+        """
+        from main import data_in
+
+        with self.lock:
+            version = self.stamp()
+            if version == self.version and not force:
+                return False
+            self.sheets = data_in(self.sheet_names, self.path,
+                                  self.use_cache)
+            self.version = version
+            self.found = {}
+            return True
+
+    def sheet(self, sheet_name):
+        """Returns a sheet as read, reading the workbook if needed."""
+        with self.lock:
+            self.load()
+            return self.sheets[sheet_name]
+
+    def problems(self, sheet_name):
+        """Returns the problems found in a sheet, see `validate_sheet`."""
+        with self.lock:
+            self.load()
+            if sheet_name not in self.found:
+                self.found[sheet_name] = validate_sheet(
+                    self.sheets[sheet_name], sheet_name, self.settings)
+            return self.found[sheet_name]
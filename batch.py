@@ -0,0 +1,169 @@
+"""Validates many SWA workbooks at once across a process pool.
+
+Each workbook gets its own output directory, named by its path relative
+to the folder holding them all, with the usual problems_vineyard and
+problems_winery files, and summary.xlsx counts the problems of every
+workbook side by side.
+
+Usage:
+    python batch.py 'exports/*.xlsx' --output problems --workers 8
+"""
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import writer
+from main import data_in, validate_vineyard, validate_winery
+
+validators = {'Vineyard': validate_vineyard, 'Winery': validate_winery}
+
+
+def workbooks(pattern: str):
+    """Returns the workbooks in a directory or matching a glob.
+
+    Args:
+        pattern: a directory or a glob pattern.
+
+    Returns:
+        A sorted list of workbook paths, skipping Excel lock files.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.xlsx')
+    return sorted(path for path in glob.glob(pattern)
+                  if not os.path.basename(path).startswith('~$'))
+
+
+def output_names(paths):
+    """Returns the output directory name of each workbook.
+
+    Each workbook's path without its extension, relative to the folder
+    holding them all, so exports/2023/data.xlsx and exports/2024/data.xlsx
+    get 2023/data and 2024/data.
+
+    Args:
+        paths: the workbook paths.
+
+    Returns:
+        A dict of the name of each path.
+    """
+    stems = {path: os.path.splitext(os.path.abspath(path))[0]
+             for path in paths}
+    if not stems:
+        return {}
+    common = os.path.commonpath(
+        [os.path.dirname(stem) for stem in stems.values()])
+    return {path: os.path.relpath(stem, common)
+            for path, stem in stems.items()}
+
+
+def validate_workbook(path: str, output: str, sheet_names=None,
+                      format='xlsx', name=None, write_memory=False):
+    """Validates one workbook and writes its problems.
+
+    Args:
+        path: the workbook path.
+        output: the directory the workbook's output directory goes in.
+        sheet_names: the sheets to validate, defaults to every sheet
+            with a validator.
+        format: the output format, see `writer.formats`.
+        name: the workbook's output directory, defaults to its stem, see
+            `output_names`.
+        write_memory: also report the peak memory of writing each
+            file, see `writer.write`.
+
+    Returns:
+        A list with a summary dict per sheet.
+    """
+    start = time.perf_counter()
+    sheet_names = sheet_names or list(validators)
+    directory = os.path.join(
+        output, name or os.path.splitext(os.path.basename(path))[0])
+    os.makedirs(directory, exist_ok=True)
+
+    summary = []
+    frames = {}
+    sheets = data_in(sheet_names, path=path)
+    for sheet in sheet_names:
+        problems = frames[sheet] = validators[sheet](sheets[sheet])
+        summary.append(dict(
+            {'Workbook': path, 'Sheet': sheet,
+             'Members': len(sheets[sheet]),
+             'Members with problems': len(problems)},
+            **problems.notna().sum().to_dict()))
+    writer.write(frames, format, directory, memory=write_memory)
+
+    seconds = time.perf_counter() - start
+    for row in summary:
+        row['Seconds'] = seconds
+    return summary
+
+
+def run(paths, output='problems', workers=None, sheet_names=None,
+        format='xlsx', write_memory=False):
+    """Validates workbooks in parallel and writes the merged summary.
+
+    Args:
+        paths: the workbook paths.
+        output: the output directory.
+        workers: the number of processes, defaults to the CPU count.
+        sheet_names: the sheets to validate in each workbook.
+        format: the output format, see `writer.formats`.
+        write_memory: also report the peak memory of writing each file.
+
+    Returns:
+        The summary DataFrame, a row per workbook and sheet.
+    """
+    start = time.perf_counter()
+    summary = []
+    names = output_names(paths)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(validate_workbook, path, output,
+                               sheet_names, format, names[path],
+                               write_memory): path
+                   for path in paths}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                print('{}: failed ({})'.format(futures[future], e))
+                continue
+            print('{}: {:.2f}s'.format(futures[future], rows[0]['Seconds']))
+            summary += rows
+
+    summary = pd.DataFrame(summary)
+    if len(summary):
+        summary = summary.sort_values(['Workbook', 'Sheet']) \
+            .set_index(['Workbook', 'Sheet'])
+        summary.to_excel(os.path.join(output, 'summary.xlsx'))
+    print('{} workbooks in {:.2f}s'.format(
+        len(paths), time.perf_counter() - start))
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('workbooks',
+                        help='a directory of workbooks or a glob pattern')
+    parser.add_argument('--output', default='problems',
+                        help='the directory to write the problems to')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='the number of processes, defaults to the '
+                             'number of CPUs')
+    parser.add_argument('--sheets', nargs='+', choices=list(validators),
+                        help='the sheets to validate')
+    parser.add_argument('--format', choices=writer.formats, default='xlsx',
+                        help='the output format')
+    parser.add_argument('--write-memory', action='store_true',
+                        help='write each file again under tracemalloc to '
+                             'report its peak memory')
+    args = parser.parse_args()
+
+    paths = workbooks(args.workbooks)
+    if not paths:
+        parser.error('no workbooks match {}'.format(args.workbooks))
+    run(paths, args.output, args.workers, args.sheets, args.format,
+        args.write_memory)
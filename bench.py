@@ -0,0 +1,290 @@
+"""Benchmarks each stage of the pipeline on synthetic SWA workbooks.
+
+The synthetic Vineyard and Winery sheets have the column names main.py
+and clean.py read, GI Regions that climate() knows, and a share of blank
+answers like the real export. Every stage is timed at each size and the
+results are written as JSON so versions can be compared.
+
+Usage:
+    python bench.py --sizes 1000 10000 100000 --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import cache
+import clean
+import main
+import schema
+import writer
+from loader import normalise_index
+from outliers import unusual
+from rules import evaluate
+
+#############
+# variables
+
+sizes = [1000, 10000, 100000, 1000000]
+excel_max_rows = 100000
+repeat = 3
+blank_rate = 0.4
+
+regions = ['Macedon Ranges', 'Yarra Valley', 'Adelaide Hills', 'Orange',
+           'Coonawarra', 'Wrattonbully', 'Geelong', 'Pyrenees',
+           'Alpine Valleys', 'Tumbarumba', 'Eden Valley', 'Heathcote',
+           'McLaren Vale', 'Great Southern', 'Margaret River', 'Geographe',
+           'Clare Valley', 'Mudgee', 'Barossa Valley', 'Langhorne Creek',
+           'Hunter Valley', 'Perth Hills', 'Riverland', 'Riverina',
+           'Murray Darling', 'Swan Hill']
+
+vineyard_numbers = [
+    'Total Vineyard Area (ha)', 'Total t/ha harvested', 'Red grapes',
+    'White grapes', 'Grapes harvested (t)',
+    'New development / redevelopment (ha)', 'Frost (ha)',
+    'Pest/disease (ha)', 'Non-sale (ha)', 'River water (ML)',
+    'Groundwater (ML)', 'Surface water dam (ML)',
+    'Recycled water from winery (ML)',
+    'Recycled water from other source (ML)', 'Mains water (ML)',
+    'Other water (ML)', 'Water applied for frost control (ML)',
+    'Irrigation type - Dripper (ha)',
+    'Irrigation type - Undervine Sprinkler (ha)',
+    'Irrigation type - Overhead Sprinkler (ha)',
+    'Irrigation type - Flood (ha)', 'Irrigation type - Non-irrigated (ha)',
+    'Petrol (L)', 'LPG (L)', 'Diesel (L)', 'Biodiesel (L)',
+    'Slashing Number of times/passes per year',
+    'Fungicide spraying Number of times/passes per year',
+    'Insecticide spraying Number of times/passes per year',
+    'Herbicide spraying Number of times/passes per year',
+    'Applied', 'Applied.1', 'Applied.2', 'Applied.3', 'Applied.4',
+    'Applied.5', 'Annual cover crop (ha)',
+    'Permanent cover crop non native (ha)',
+    'Permanent cover crop volunteer sward (ha)',
+    'Permanent cover crop - native (ha)', 'Bare soil (ha)',
+    'Livestock grazing (ha)', 'Diesel (ha)', 'Electricity (ha)',
+    'Electricity from the grid (kWh)',
+    'Renewable energy sourced from the grid (kWh)', 'Solar (kWh)',
+    'Wind (kWh)',
+    'Renewable electricity generated and exported to the grid (kWh)',
+    'How many timber trellis posts have been re-used or recycled in the '
+    'past 12 months?',
+    'How many posts have been disposed (e.g. landfill/combustion) in the '
+    'past 12 months?',
+    'Synthetic nitrogen', 'Organic nitrogen', 'Urea',
+    'Total vineyard revenue (from grape sales)',
+    'Total vineyard operating costs']
+
+vineyard_answers = {
+    'Mechanical harvesting': ['We perform', 'Contractor'],
+    'Mechanical pruning': ['We perform', 'Contractor'],
+    'Slashing': ['We perform', 'Contractor'],
+    'Fungicide spraying': ['We perform', 'Contractor'],
+    'Insecticide spraying': ['We perform', 'Contractor'],
+    'Herbicide spraying': ['We perform', 'Contractor'],
+    'Was any of your vineyard NOT harvested last season?': ['Yes', 'No'],
+    'Other': ['Other'],
+    'If you selected other, please tell us what you are using '
+    'undervine': ['Mulch'],
+    'GrowData': ['GrowData'], 'Accolade': ['Accolade'],
+    'Yalumba': ['Yalumba'], 'SAW': ['SAW'], 'GrapeWeb': ['GrapeWeb'],
+    'GrapeLink': ['GrapeLink'],
+}
+
+winery_numbers = [
+    'Tonnes crushed', 'Full winemaking (kL)', 'First stage winemaking (kL)',
+    'Final stage winemaking (kL)', 'Water used (kL)',
+    'Wastewater recycled (kL)', 'Other', 'Wind', 'Solar',
+    'Renewable energy generated onsite and exported to the grid',
+    'Electricity from the grid', 'Petrol (L)', 'Diesel (L)', 'Natural gas',
+    'LPG', 'Refrigerant', 'Refrigerant.1', 'Refrigerant.2',
+    'Refrigerant.3', 'Refrigerant.4']
+
+
+def members(rows, rng):
+    # Some member numbers are stored as text with a leading apostrophe
+    numbers = pd.Series(rng.permutation(rows) + 1).astype(str).str.zfill(5)
+    return numbers.where(rng.random(rows) < 0.8, "'" + numbers)
+
+
+def amounts(rows, rng, blanks=blank_rate):
+    values = np.round(rng.lognormal(3, 1.5, rows), 1)
+    values[rng.random(rows) < blanks] = np.nan
+    return values
+
+
+def answers(options, rows, rng, blanks=blank_rate):
+    values = rng.choice(np.array(options, dtype=object), rows)
+    values[rng.random(rows) < blanks] = None
+    return values
+
+
+def synthetic_vineyard(rows, seed=0, blanks=blank_rate):
+    """Returns a synthetic Vineyard sheet as it appears in the workbook.
+
+    Args:
+        rows: the number of members.
+        seed: the random seed.
+        blanks: the share of blank answers.
+
+    Returns:
+        A DataFrame with a 'Membership Number' column.
+    """
+    rng = np.random.default_rng(seed)
+    data = {'Membership Number': members(rows, rng),
+            'Data Reporting Year': '2022/23',
+            'Paid At': answers([pd.Timestamp('2023-07-01')], rows, rng),
+            'GI Region': answers(regions, rows, rng, 0.05)}
+    for col in vineyard_numbers:
+        data[col] = amounts(rows, rng, blanks)
+    for col, options in vineyard_answers.items():
+        data[col] = answers(options, rows, rng, blanks)
+    return pd.DataFrame(data)
+
+
+def synthetic_winery(rows, seed=1, blanks=blank_rate):
+    """Returns a synthetic Winery sheet as it appears in the workbook.
+
+    Args:
+        rows: the number of members.
+        seed: the random seed.
+        blanks: the share of blank answers.
+
+    Returns:
+        A DataFrame with a 'Membership Number' column.
+    """
+    rng = np.random.default_rng(seed)
+    data = {'Membership Number': members(rows, rng),
+            'Paid At': answers([pd.Timestamp('2023-07-01')], rows, rng)}
+    for col in winery_numbers:
+        data[col] = amounts(rows, rng, blanks)
+    data['Tonnes crushed'] = np.round(rng.lognormal(6, 2, rows))
+    return pd.DataFrame(data)
+
+
+def synthetic_workbook(path, rows, seed=0):
+    """Writes a synthetic workbook with Vineyard and Winery sheets,
+    headed by a title row like the SWA export."""
+    engine = 'xlsxwriter' if writer.xlsxwriter is not None else None
+    with pd.ExcelWriter(path, engine=engine) as excel:
+        for name, data in [('Vineyard', synthetic_vineyard(rows, seed)),
+                           ('Winery', synthetic_winery(rows, seed + 1))]:
+            data.to_excel(excel, sheet_name=name, index=False, startrow=1)
+
+
+def best_time(function, *args):
+    """Returns the fastest of `repeat` runs of a function, in seconds,
+    with anything it prints discarded."""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_size(rows, directory):
+    """Returns the seconds each stage takes on `rows` members."""
+    results = {}
+    sheets = {'Vineyard': synthetic_vineyard(rows),
+              'Winery': synthetic_winery(rows)}
+    for name in sheets:
+        sheets[name] = schema.apply(normalise_index(sheets[name]))
+
+    if rows <= excel_max_rows:
+        path = os.path.join(directory, 'bench_{}.xlsx'.format(rows))
+        synthetic_workbook(path, rows)
+        results['data_in'] = best_time(
+            main.data_in, ['Vineyard', 'Winery'], path, False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.data_in(['Vineyard', 'Winery'], path)
+        results['data_in (cached)'] = best_time(
+            main.data_in, ['Vineyard', 'Winery'], path)
+
+    results['data_transform'] = best_time(
+        main.data_transform, sheets['Vineyard'])
+    results['winery_transform'] = best_time(
+        main.winery_transform, sheets['Winery'])
+    results['proc_vineyard'] = best_time(
+        lambda data: clean.proc_vineyard(data.copy()),
+        synthetic_vineyard(rows))
+
+    for name, validation in [('Vineyard', main.vineyard),
+                             ('Winery', main.winery)]:
+        df = validation.transform(sheets[name])
+        results['outliers ({})'.format(name)] = best_time(
+            unusual, df, validation.metrics, validation.groupings,
+            main.threshold, validation.suffix, validation.report)
+        results['rules ({})'.format(name)] = best_time(
+            evaluate, validation.rules, df)
+
+    if rows <= excel_max_rows:
+        frames = {'Vineyard': main.validate_vineyard(sheets['Vineyard']),
+                  'Winery': main.validate_winery(sheets['Winery'])}
+        # The write alone, without writer.write's report around it
+        results['to_excel'] = best_time(
+            writer.write_excel, frames, os.path.join(directory,
+                                                     'problems.xlsx'))
+    return results
+
+
+def version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(sizes=sizes):
+    """Benchmarks every stage at each size.
+
+    Args:
+        sizes: the numbers of members to benchmark.
+
+    Returns:
+        A dict of the version, environment and the seconds of each
+        stage at each size.
+    """
+    report = {'version': version(), 'python': platform.python_version(),
+              'pandas': pd.__version__, 'numpy': np.__version__,
+              'repeat': repeat, 'results': []}
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = cache.cache_dir
+        cache.cache_dir = os.path.join(directory, '.cache')
+        try:
+            for rows in sizes:
+                for stage, seconds in bench_size(rows, directory).items():
+                    print('{:>9} {:<22} {:.4f}s'.format(rows, stage, seconds))
+                    report['results'].append(
+                        {'rows': rows, 'stage': stage, 'seconds': seconds})
+        finally:
+            cache.cache_dir = cache_dir
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=sizes,
+                        help='the numbers of members to benchmark')
+    parser.add_argument('--excel-max-rows', type=int, default=excel_max_rows,
+                        help='skip the Excel stages above this many rows')
+    parser.add_argument('--repeat', type=int, default=repeat,
+                        help='runs per stage, the fastest is reported')
+    parser.add_argument('--output', default='bench.json',
+                        help='the JSON file to write')
+    args = parser.parse_args()
+
+    excel_max_rows, repeat = args.excel_max_rows, args.repeat
+    with open(args.output, 'w') as f:
+        json.dump(run(args.sizes), f, indent=2)
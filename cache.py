@@ -0,0 +1,163 @@
+"""On-disk Parquet cache for sheets read out of the SWA workbooks.
+
+Each sheet is stored once per workbook content hash and version of the
+reader, so an edited workbook or dtype plan never serves stale frames,
+and repeat runs skip the Excel parse. Every workbook, by absolute path,
+and sheet gets its own directory, so workbooks of the same name in
+different folders keep their own entries.
+"""
+import contextlib
+import hashlib
+import os
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:
+    pyarrow = None
+
+#############
+# variables
+
+cache_dir = '.cache'
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20):
+    """Returns the sha256 hex digest of a file's contents.
+
+    Args:
+        path: the file to hash.
+        chunk_size: number of bytes read at a time.
+
+    Returns:
+        The hex digest as a string.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(path: str, sheet_name: str, key: str, directory=None):
+    """Returns the cache file for a sheet of a workbook version.
+
+    Args:
+        path: the workbook path.
+        sheet_name: the sheet inside the workbook.
+        key: the content hash of the workbook.
+        directory: the cache directory, defaults to `cache_dir`.
+
+    Returns:
+        The path of the Parquet file for the sheet.
+    """
+    return os.path.join(sheet_dir(path, sheet_name, directory),
+                        '{}.parquet'.format(key[:16]))
+
+
+def sheet_dir(path: str, sheet_name: str, directory=None):
+    """Returns the directory holding the cached versions of a sheet.
+
+    The workbook's directory is named by its stem and a hash of its
+    absolute path, and holds a directory per sheet, as sheet names can't
+    hold a '/'.
+    """
+    location = os.path.abspath(path)
+    stem = os.path.splitext(os.path.basename(location))[0]
+    return os.path.join(directory or cache_dir, '{}-{}'.format(
+        stem, hashlib.sha256(location.encode()).hexdigest()[:16]),
+        sheet_name)
+
+
+def cached_read(path: str, sheet_names, reader, directory=None, version=''):
+    """Returns sheets from the cache, reading the misses with `reader`.
+
+    All the sheets missing from the cache are handed to `reader` in one
+    call so the workbook is only opened once. Cache entries for older
+    versions of the same workbook and sheet are removed when a new
+    version is written. When pyarrow is missing, or a frame can't be
+    stored as Parquet (e.g. mixed type columns), it is still returned but
+    not cached.
+
+    Args:
+        path: the workbook path.
+        sheet_names: a sheet name or a list of sheet names.
+        reader: a callable taking (path, list of sheet names) and
+            returning a dict of cleaned DataFrames keyed by sheet name.
+        directory: the cache directory, defaults to `cache_dir`.
+        version: identifies how `reader` cleans the sheets, e.g. a hash
+            of its code and settings, so cached sheets are read again
+            when it changes.
+
+    Returns:
+        A DataFrame if `sheet_names` is a single name, otherwise a dict
+        of DataFrames keyed by sheet name.
+    """
+    names = [sheet_names] if isinstance(sheet_names, str) else \
+        list(sheet_names)
+    start = time.perf_counter()
+    if pyarrow is None:
+        data = reader(path, names)
+        print('{}: no pyarrow, read without cache ({:.2f}s)'.format(
+            ', '.join(names), time.perf_counter() - start))
+        return data[names[0]] if isinstance(sheet_names, str) else data
+
+    key = hashlib.sha256((file_hash(path) + version).encode()).hexdigest()
+    data = {}
+    for name in names:
+        target = cache_path(path, name, key, directory)
+        if os.path.exists(target):
+            try:
+                data[name] = pd.read_parquet(target, memory_map=True)
+            except OSError:
+                # Replaced by another process since
+                continue
+            print('{}: cache hit ({:.2f}s)'.format(
+                name, time.perf_counter() - start))
+
+    missing = [name for name in names if name not in data]
+    if missing:
+        data.update(reader(path, missing))
+        for name in missing:
+            print('{}: cache miss ({:.2f}s){}'.format(
+                name, time.perf_counter() - start,
+                store(data[name], path, name, key, directory)))
+
+    data = {name: data[name] for name in names}
+    return data[names[0]] if isinstance(sheet_names, str) else data
+
+
+def store(data, path: str, sheet_name: str, key: str, directory=None):
+    """Writes a sheet to the cache, replacing older versions of it.
+
+    Args:
+        data: the DataFrame to cache.
+        path: the workbook path.
+        sheet_name: the sheet the frame was read from.
+        key: the content hash of the workbook.
+        directory: the cache directory, defaults to `cache_dir`.
+
+    Returns:
+        An empty string on success, otherwise a note on why the frame
+        wasn't cached.
+    """
+    target = cache_path(path, sheet_name, key, directory)
+    folder = os.path.dirname(target)
+    os.makedirs(folder, exist_ok=True)
+    for old in os.listdir(folder):
+        if old.endswith('.parquet') and old != os.path.basename(target):
+            # Another process may have removed it first
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(folder, old))
+    # Written aside and renamed, so readers never see a partial file
+    partial = '{}.{}.partial'.format(target, os.getpid())
+    try:
+        data.to_parquet(partial)
+    except (pyarrow.ArrowException, ValueError) as e:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return ', not cached: {}'.format(e)
+    os.replace(partial, target)
+    return ''
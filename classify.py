@@ -0,0 +1,108 @@
+"""Vectorised climate and size classes as categorical columns.
+
+The climate of each GI Region is read from `climates_path`, so a new
+region only needs a row in the CSV. Regions are factorized once and each
+distinct region is looked up, rather than the lookup running per row.
+Sizes are binned with np.searchsorted against sorted bin edges.
+
+Every class has a fixed set of categories, so chunks and incremental
+updates classified separately can be concatenated without falling back
+to object columns, and groupings can use the category codes directly.
+"""
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+#############
+# variables
+
+climates_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'climates.csv')
+unknown_climate = 'Unknown Climate'
+
+# Winery sizes by tonnes crushed. Planned sizes:
+# Vlarge > 20k
+# large < 20k
+# med < 10k
+# small < 500
+# micro < 100
+size_bins = [500, 10000]
+size_labels = ['Small', 'Medium', 'Large']
+
+# Vineyard sizes by total area (ha)
+vineyard_size_bins = [10, 25, 50, 100]
+vineyard_size_labels = [1, 2, 3, 4, 5]
+
+
+@functools.lru_cache()
+def load_climates(path=None):
+    """Returns the climate of each GI Region.
+
+    Args:
+        path: a CSV with 'GI Region' and 'Climate' columns, defaults to
+            `climates_path`.
+
+    Returns:
+        A Series of climates indexed by GI Region.
+    """
+    table = pd.read_csv(path or climates_path)
+    return table.set_index('GI Region')['Climate']
+
+
+def climate(regions: pd.Series, path=None):
+    """Returns the climate of each GI Region.
+
+    Args:
+        regions: the GI Region of each row.
+        path: the climates CSV, defaults to `climates_path`.
+
+    Returns:
+        A categorical Series, 'Unknown Climate' for regions that are
+        missing or not in the CSV.
+    """
+    climates = load_climates(path)
+    dtype = pd.CategoricalDtype(
+        list(climates.unique()) + [unknown_climate])
+    codes, uniques = pd.factorize(regions)
+    lookup = dtype.categories.get_indexer(
+        climates.reindex(uniques).fillna(unknown_climate))
+    # Missing regions have the code -1, the last entry of the lookup
+    lookup = np.append(lookup, len(dtype.categories) - 1)
+    return pd.Series(pd.Categorical.from_codes(lookup[codes], dtype=dtype),
+                     index=regions.index, name='Climate')
+
+
+def binned(values: pd.Series, bins, labels):
+    """Returns the class of each value as an ordered categorical.
+
+    A value equal to a bin edge goes in the class above it, like the
+    `value < edge` tests this replaces. Missing values fall in the last
+    class, as they failed every one of those tests.
+
+    Args:
+        values: the values to classify.
+        bins: the sorted edges between the classes.
+        labels: a label per class, one more than the edges.
+
+    Returns:
+        A categorical Series with the index of `values`.
+    """
+    codes = np.searchsorted(bins, values.to_numpy(dtype=float),
+                            side='right')
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=labels, ordered=True),
+        index=values.index)
+
+
+def size(tonnes: pd.Series):
+    """Returns 'Small', 'Medium' or 'Large' for each winery's tonnes
+    crushed."""
+    return binned(tonnes, size_bins, size_labels)
+
+
+def vineyard_size(area: pd.Series):
+    """Returns the size class of each vineyard area, from 1 under 10 ha
+    to 5 for 100 ha or more."""
+    return binned(area, vineyard_size_bins, vineyard_size_labels)
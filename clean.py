@@ -1,6 +1,11 @@
 import numpy as np
 import pandas as pd
 
+from classify import vineyard_size
+from factors import factors
+from loader import read_workbook
+from metrics import Metric, MetricTable
+
 
 def int_to_char(index: int):
     letter = ''
@@ -13,175 +18,182 @@ def int_to_char(index: int):
 # Vineyard processing
 
 
-def vineyard_size(size):
-    if size < 10:
-        return 1
-    elif size < 25:
-        return 2
-    elif size < 50:
-        return 3
-    elif size < 100:
-        return 4
-    else:
-        return 5
-
-
-def proc_vineyard(df):
-    df.rename(columns={
-        'Red grapes': 'Red grapes (ha)',
-        'White grapes': 'White grapes (ha)'
-    }, inplace=True)
-
-    df['Total Vineyard Area  (ha)'] = \
-        df['Red grapes (ha)'] + \
-        df['White grapes (ha)']
-
-    df['Vineyard Size'] = df['Total Vineyard Area  (ha)'].map(
-        vineyard_size)
-
-    df['t/ha'] = df['Grapes harvested (t)'] / \
-        df['Total Vineyard Area  (ha)']
-
-    df['Total Vineyard not harvested (ha)'] = (
-        df['New development / redevelopment (ha)'] +
-        df['Frost (ha)'] +
-        df['Pest/disease (ha)'] +
-        df['Non-sale (ha)'])
-
-    df['t/ha harvested from'] = df['Grapes harvested (t)'] / \
-        (df['Total Vineyard Area  (ha)'] -
-         df['Total Vineyard not harvested (ha)'])
-
-    df['% not harvested compared to total vineyard area'] = \
-        df['Total Vineyard not harvested (ha)'] / \
-        df['Total Vineyard Area  (ha)']
-
-    df['Total water used (ML)'] = \
-        (df['River water (ML)'] +
-         df['Groundwater (ML)'] +
-         df['Surface water dam (ML)'] +
-         df['Recycled water from winery (ML)'] +
-         df['Recycled water from other source (ML)'] +
-         df['Mains water (ML)'] +
-         df['Other water (ML)'] +
-         df['Water applied for frost control (ML)'])
-
-    df['Water Use (ML/ha)'] = df['Total water used (ML)'] / \
-        df['Total Vineyard Area  (ha)']
-
-    df['Electricity CO2e'] = df['Electricity from the grid (kWh)'] * \
-        0.51
-    df['Electricity in tonnes of CO2e'] = df['Electricity CO2e'] / \
-        1000
-    df['Electricity CO2e/ha'] = df['Electricity CO2e'] / \
-        df['Total Vineyard Area  (ha)']
-    df['Electricity CO2e/t'] = df['Electricity CO2e'] / \
-        df['Grapes harvested (t)']
-
-    df['Renewable energy sourced from the grid (kWh)'] = \
-        df['Renewable energy sourced from the grid (kWh)'] + \
-        df['Solar (kWh)'] + \
-        df['Wind (kWh)'] + \
-        df['Renewable electricity generated and ' \
-           'exported to the grid (kWh)']
-
-    df['Petrol kg CO2e'] = df['Petrol (L)'] * 2.289
-    df['Petrol kg CO2e/ha'] = df['Petrol kg CO2e'] / \
-        df['Total Vineyard Area  (ha)']
-    df['Petrol kg CO2e/t'] = df['Petrol kg CO2e'] / \
-        df['Grapes harvested (t)']
-
-    df['LPG kg CO2e'] = df['LPG (L)'] * 1.578
-    df['LPG kg CO2e/ha'] = df['LPG kg CO2e'] / \
-        df['Total Vineyard Area  (ha)']
-    df['LPG kg CO2e/t'] = df['LPG kg CO2e'] / \
-        df['Grapes harvested (t)']
-
-    df['Diesel CO2e'] = df['Diesel (L)'] * 2.694
-    df['Diesel CO2e/ha'] = df['Diesel CO2e'] / \
-        df['Total Vineyard Area  (ha)']
-    df['Diesel CO2e/t'] = df['Diesel CO2e'] / \
-        df['Grapes harvested (t)']
-
-    df['Biodiesel CO2e'] = df['Biodiesel (L)'] * 0.123
-    df['Biodiesel CO2e/ha'] = df['Biodiesel CO2e'] / \
-        df['Total Vineyard Area  (ha)']
-    df['Biodiesel CO2e/t'] = df['Biodiesel CO2e'] / \
-        df['Grapes harvested (t)']
-
-    df['Total fuel CO2e'] = df['Petrol kg CO2e'] + df['LPG kg CO2e'] \
-        + df['Diesel CO2e'] + df['Biodiesel CO2e']
-
-    df['Total fuel CO2e/ha'] = df['Petrol kg CO2e/ha'] + \
-        df['LPG kg CO2e/ha'] + df['Diesel CO2e/ha'] + \
-        df['Biodiesel CO2e/ha']
-
-    df['Total fuel CO2e/t'] = df['Petrol kg CO2e/t'] + \
-        df['LPG kg CO2e/t'] + df['Diesel CO2e/t'] + \
-        df['Biodiesel CO2e/t']
-
-    df['Total elect + fuel CO2e / ha'] = df['Total fuel CO2e/ha'] + \
-        df['Electricity CO2e/ha']
-
-    df['Total elect + fuel CO2e / t'] = df['Total fuel CO2e/t'] + \
-        df['Electricity in tonnes of CO2e']
-
-    df['recycle vs landfill'] = \
-        df['How many timber trellis posts have been re-used or '
-           'recycled in the past 12 months?'] / \
-        df['How many posts have been disposed (e.g. '
-           'landfill/combustion) in the past 12 months?']
-
-    df['Total Tractor Passes per season'] = \
-        df['Slashing Number of times/passes per year'] + \
-        df['Fungicide spraying Number of times/passes per year'] + \
-        df['Herbicide spraying Number of times/passes per year'] + \
-        df['Herbicide spraying Number of times/passes per year']
-
-    df['Synthetic nitrogen kg CO2'] = df['Synthetic nitrogen'] * 3.98
-    df['Synthetic nitrogen kg CO2/ha'] = df['Synthetic nitrogen kg '
-                                            'CO2'] / \
-        df['Grapes harvested (t)']
-
-    df['Organic nitrogen kg CO2'] = df['Organic nitrogen'] * 3.98
-    df['Organic nitrogen kg CO2/ha'] = df['Organic nitrogen kg '
-                                          'CO2'] / \
-        df['Grapes harvested (t)']
-
-    df['Urea kg CO2'] = df['Urea'] * 0.733
+# Every metric proc_vineyard adds, in the order of the columns. The
+# emission factors are the columns added by `factors.factors`.
+vineyard_metrics = MetricTable([
+    Metric('Total Vineyard Area  (ha)',
+           '`Red grapes (ha)` + `White grapes (ha)`', 'ha'),
+    Metric('t/ha', '`Grapes harvested (t)` / `Total Vineyard Area  (ha)`',
+           't/ha'),
+    Metric('Total Vineyard not harvested (ha)',
+           '`New development / redevelopment (ha)` + `Frost (ha)` + '
+           '`Pest/disease (ha)` + `Non-sale (ha)`', 'ha'),
+    Metric('t/ha harvested from',
+           '`Grapes harvested (t)` / (`Total Vineyard Area  (ha)` - '
+           '`Total Vineyard not harvested (ha)`)', 't/ha'),
+    Metric('% not harvested compared to total vineyard area',
+           '`Total Vineyard not harvested (ha)` / '
+           '`Total Vineyard Area  (ha)`', 'ratio'),
+    Metric('Total water used (ML)',
+           '`River water (ML)` + `Groundwater (ML)` + '
+           '`Surface water dam (ML)` + `Recycled water from winery (ML)` + '
+           '`Recycled water from other source (ML)` + '
+           '`Mains water (ML)` + `Other water (ML)` + '
+           '`Water applied for frost control (ML)`', 'ML'),
+    Metric('Water Use (ML/ha)',
+           '`Total water used (ML)` / `Total Vineyard Area  (ha)`',
+           'ML/ha'),
+
+    Metric('Electricity CO2e',
+           '`Electricity from the grid (kWh)` * `Grid electricity factor`',
+           'kg CO2e'),
+    Metric('Electricity in tonnes of CO2e', '`Electricity CO2e` / 1000',
+           't CO2e'),
+    Metric('Electricity CO2e/ha',
+           '`Electricity CO2e` / `Total Vineyard Area  (ha)`',
+           'kg CO2e/ha'),
+    Metric('Electricity CO2e/t',
+           '`Electricity CO2e` / `Grapes harvested (t)`', 'kg CO2e/t'),
+
+    Metric('Renewable energy sourced from the grid (kWh)',
+           '`Renewable energy sourced from the grid (kWh)` + '
+           '`Solar (kWh)` + `Wind (kWh)` + '
+           '`Renewable electricity generated and exported to the grid '
+           '(kWh)`', 'kWh'),
+
+    Metric('Petrol kg CO2e', '`Petrol (L)` * `Petrol factor`', 'kg CO2e'),
+    Metric('Petrol kg CO2e/ha',
+           '`Petrol kg CO2e` / `Total Vineyard Area  (ha)`', 'kg CO2e/ha'),
+    Metric('Petrol kg CO2e/t',
+           '`Petrol kg CO2e` / `Grapes harvested (t)`', 'kg CO2e/t'),
+
+    Metric('LPG kg CO2e', '`LPG (L)` * `LPG factor`', 'kg CO2e'),
+    Metric('LPG kg CO2e/ha',
+           '`LPG kg CO2e` / `Total Vineyard Area  (ha)`', 'kg CO2e/ha'),
+    Metric('LPG kg CO2e/t',
+           '`LPG kg CO2e` / `Grapes harvested (t)`', 'kg CO2e/t'),
+
+    Metric('Diesel CO2e', '`Diesel (L)` * `Diesel factor`', 'kg CO2e'),
+    Metric('Diesel CO2e/ha',
+           '`Diesel CO2e` / `Total Vineyard Area  (ha)`', 'kg CO2e/ha'),
+    Metric('Diesel CO2e/t',
+           '`Diesel CO2e` / `Grapes harvested (t)`', 'kg CO2e/t'),
+
+    Metric('Biodiesel CO2e', '`Biodiesel (L)` * `Biodiesel factor`',
+           'kg CO2e'),
+    Metric('Biodiesel CO2e/ha',
+           '`Biodiesel CO2e` / `Total Vineyard Area  (ha)`', 'kg CO2e/ha'),
+    Metric('Biodiesel CO2e/t',
+           '`Biodiesel CO2e` / `Grapes harvested (t)`', 'kg CO2e/t'),
+
+    Metric('Total fuel CO2e',
+           '`Petrol kg CO2e` + `LPG kg CO2e` + `Diesel CO2e` + '
+           '`Biodiesel CO2e`', 'kg CO2e'),
+    Metric('Total fuel CO2e/ha',
+           '`Petrol kg CO2e/ha` + `LPG kg CO2e/ha` + `Diesel CO2e/ha` + '
+           '`Biodiesel CO2e/ha`', 'kg CO2e/ha'),
+    Metric('Total fuel CO2e/t',
+           '`Petrol kg CO2e/t` + `LPG kg CO2e/t` + `Diesel CO2e/t` + '
+           '`Biodiesel CO2e/t`', 'kg CO2e/t'),
+
+    Metric('Total elect + fuel CO2e / ha',
+           '`Total fuel CO2e/ha` + `Electricity CO2e/ha`', 'kg CO2e/ha'),
+    Metric('Total elect + fuel CO2e / t',
+           '`Total fuel CO2e/t` + `Electricity in tonnes of CO2e`',
+           'kg CO2e/t'),
+
+    Metric('recycle vs landfill',
+           '`How many timber trellis posts have been re-used or recycled '
+           'in the past 12 months?` / `How many posts have been disposed '
+           '(e.g. landfill/combustion) in the past 12 months?`', 'ratio'),
+
+    Metric('Total Tractor Passes per season',
+           '`Slashing Number of times/passes per year` + '
+           '`Fungicide spraying Number of times/passes per year` + '
+           '`Herbicide spraying Number of times/passes per year` + '
+           '`Herbicide spraying Number of times/passes per year`',
+           'passes'),
+
+    Metric('Synthetic nitrogen kg CO2',
+           '`Synthetic nitrogen` * `Nitrogen factor`',
+           'kg CO2'),
+    Metric('Synthetic nitrogen kg CO2/ha',
+           '`Synthetic nitrogen kg CO2` / `Grapes harvested (t)`',
+           'kg CO2/t'),
+    Metric('Organic nitrogen kg CO2',
+           '`Organic nitrogen` * `Nitrogen factor`',
+           'kg CO2'),
+    Metric('Organic nitrogen kg CO2/ha',
+           '`Organic nitrogen kg CO2` / `Grapes harvested (t)`',
+           'kg CO2/t'),
+    Metric('Urea kg CO2', '`Urea` * `Urea factor`', 'kg CO2'),
 
     #TODO
     # Is it intended that total nitrogen per CO2 includes Urea?
-    df['Total Nitrogen kg CO2'] = df['Synthetic nitrogen kg CO2'] + \
-        df['Organic nitrogen kg CO2'] + df['Urea kg CO2']
-
-    df['Total Nitrogen kg CO2/ha'] = df['Total Nitrogen kg CO2'] / \
-        df['Total Vineyard Area  (ha)']
-
-    df['Total Nitrogen kg CO2/t'] = df['Total Nitrogen kg CO2'] / \
-        df['Grapes harvested (t)']
+    Metric('Total Nitrogen kg CO2',
+           '`Synthetic nitrogen kg CO2` + `Organic nitrogen kg CO2` + '
+           '`Urea kg CO2`', 'kg CO2'),
+    Metric('Total Nitrogen kg CO2/ha',
+           '`Total Nitrogen kg CO2` / `Total Vineyard Area  (ha)`',
+           'kg CO2/ha'),
+    Metric('Total Nitrogen kg CO2/t',
+           '`Total Nitrogen kg CO2` / `Grapes harvested (t)`', 'kg CO2/t'),
 
     #TODO
     # There was no formula for the below column
-    df['Total Nitrogen fertiliser use (kg N applied/ha)'] = np.nan
+    Metric('Total Nitrogen fertiliser use (kg N applied/ha)', 'nan',
+           'kg N/ha'),
 
-    df['Total Emissions kg CO2/ha'] = df['Total Nitrogen fertiliser'
-                                         ' use (kg N applied/ha)'] \
-        + df['Total elect + fuel CO2e / ha']
+    Metric('Total Emissions kg CO2/ha',
+           '`Total Nitrogen fertiliser use (kg N applied/ha)` + '
+           '`Total elect + fuel CO2e / ha`', 'kg CO2/ha'),
     #TODO
     # The below field column is listed as t/kg but is actually t/kg/ha
-    df['Productivity (t/kg CO2e)'] = df['Total Emissions kg CO2/ha'] \
-        / df['Grapes harvested (t)']
-
-    df['Gross margin'] = df['Total vineyard revenue (from grape '
-                            'sales)'] - df['Total vineyard operating '
-                                           'costs']
-    df['Average operating cost per hectare'] = df['Total vineyard '
-                                                  'operating costs'] \
-        / df['Total Vineyard Area  (ha)']
-    df['Average operating cost per tonne'] = df['Total vineyard '
-                                                'operating costs'] / \
-        df['Grapes harvested (t)']
+    Metric('Productivity (t/kg CO2e)',
+           '`Total Emissions kg CO2/ha` / `Grapes harvested (t)`',
+           't/kg CO2e'),
+
+    Metric('Gross margin',
+           '`Total vineyard revenue (from grape sales)` - '
+           '`Total vineyard operating costs`', '$'),
+    Metric('Average operating cost per hectare',
+           '`Total vineyard operating costs` / `Total Vineyard Area  (ha)`',
+           '$/ha'),
+    Metric('Average operating cost per tonne',
+           '`Total vineyard operating costs` / `Grapes harvested (t)`',
+           '$/t'),
+])
+
+
+def proc_vineyard(df, outputs=None):
+    """Adds the vineyard metrics to a Vineyard sheet.
+
+    Args:
+        df: the Vineyard sheet.
+        outputs: the metrics to add, defaults to all of
+            `vineyard_metrics`.
+
+    Returns:
+        A new DataFrame of the sheet and the metrics.
+    """
+    df = df.rename(columns={
+        'Red grapes': 'Red grapes (ha)',
+        'White grapes': 'White grapes (ha)'
+    })
+
+    # The emission factors of each member's reporting year
+    metrics = vineyard_metrics.evaluate(
+        pd.concat([df, factors(df)], axis=1), outputs)
+    if 'Total Vineyard Area  (ha)' in metrics:
+        metrics.insert(
+            list(metrics.columns).index('Total Vineyard Area  (ha)') + 1,
+            'Vineyard Size',
+            vineyard_size(metrics['Total Vineyard Area  (ha)']))
+
+    # Metrics replacing a column of the sheet keep its place
+    replaced = [col for col in metrics.columns if col in df.columns]
+    df = pd.concat([df, metrics.drop(columns=replaced)], axis=1)
+    df[replaced] = metrics[replaced]
 
     df['Other Spray Diary Used total'] = \
         ((df['GrowData'] == np.nan) +
@@ -223,13 +235,7 @@ if __name__ == '__main__':
     path = 'Copy of SWA Data 2021-07-01 - 2022-06-30 raw with extra ' \
            'columns for cleanup start 16 Sep 2022.xlsx'
 
-    sheets = pd.ExcelFile(path).sheet_names
-
-    df = {}
+    df = read_workbook(path, engine='fast')
 
-    for sheet in sheets:
-        df[sheet] = pd.read_excel(path, sheet_name=sheet)
-        df[sheet] = df.get(sheet).loc[
-                    :, ~df[sheet].columns.duplicated()].copy()
-        if sheet == 'Vineyard':
-            df[sheet] = proc_vineyard(df[sheet])
+    if 'Vineyard' in df:
+        df['Vineyard'] = proc_vineyard(df['Vineyard'])
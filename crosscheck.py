@@ -0,0 +1,129 @@
+"""Consistency checks across sheets, joined on Membership Number.
+
+Members who fill in several sheets, e.g. a Vineyard and a Winery, are
+matched through a hash lookup of each sheet's Membership Number index,
+which is linear in the number of rows. The checks are `rules.Rule`s over
+columns named '<sheet>: <column>'. Only the columns the rules read are
+gathered for the matched members, when a rule first reads them, so the
+sheets are never merged as a whole.
+
+A member repeated in a sheet is matched on their first row.
+"""
+import numpy as np
+import pandas as pd
+
+from rules import Rule, evaluate
+
+#############
+# variables
+
+separator = ': '
+# Grapes harvested and tonnes crushed this many times apart are taken as
+# entered in different units, e.g. kg for t
+units_ratio = 500
+
+
+class Joined:
+    """The matched members of several sheets, read a column at a time.
+
+    Looks enough like a DataFrame for `rules.Columns`: columns are
+    selected by '<sheet>: <column>' and gathered for the matched members
+    on first use.
+
+    Args:
+        sheets: a dict of DataFrames keyed by sheet name, each indexed by
+            Membership Number.
+    """
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.index, self.rows = matched(sheets)
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, name):
+        if not isinstance(name, str):
+            return pd.DataFrame({col: self[col] for col in name},
+                                index=self.index)
+        if name not in self.columns:
+            sheet, _, col = name.partition(separator)
+            if sheet not in self.sheets or \
+                    col not in self.sheets[sheet].columns:
+                raise KeyError(name)
+            self.columns[name] = pd.Series(
+                self.sheets[sheet][col].take(self.rows[sheet]).array,
+                index=self.index, name=name)
+        return self.columns[name]
+
+
+def first_rows(index: pd.Index):
+    """Returns the index without repeats and the row of each member."""
+    first = ~index.duplicated()
+    return index[first], np.flatnonzero(first)
+
+
+def matched(sheets):
+    """Returns the members found in every sheet and their rows.
+
+    Args:
+        sheets: a dict of DataFrames keyed by sheet name, each indexed by
+            Membership Number.
+
+    Returns:
+        A tuple of the matched Membership Numbers, in the order of the
+        first sheet, and a dict of each sheet's row per member.
+    """
+    unique = {name: first_rows(data.index) for name, data in sheets.items()}
+    members = next(iter(unique.values()))[0]
+    found = {}
+    for name, (index, rows) in unique.items():
+        # Index.get_indexer is a hash table lookup
+        found[name] = index.get_indexer(members)
+    keep = np.logical_and.reduce([positions >= 0
+                                  for positions in found.values()])
+    rows = {name: unique[name][1][positions[keep]]
+            for name, positions in found.items()}
+    return members[keep], rows
+
+
+def column(sheet, col):
+    """Returns the name a rule reads a sheet's column by."""
+    return sheet + separator + col
+
+
+harvested = column('Vineyard', 'Grapes harvested (t)')
+crushed = column('Winery', 'Tonnes crushed')
+
+cross_rules = [
+    # A member crushing grapes should say what they harvested, their
+    # vineyard may supply only part of the crush
+    Rule('Crushed grapes without a harvest', crushed, harvested),
+
+    Rule('Harvest and crush in different units', crushed,
+         where=lambda c:
+         (c[crushed] >= units_ratio * c[harvested]) |
+         (c[harvested] >= units_ratio * c[crushed])),
+
+    Rule('Recycled winery water without winery wastewater recycled',
+         column('Vineyard', 'Recycled water from winery (ML)'),
+         column('Winery', 'Wastewater recycled (kL)')),
+]
+
+
+def validate(sheets, rules=None):
+    """Returns the cross-sheet problems of the members in every sheet.
+
+    Args:
+        sheets: a dict of DataFrames keyed by sheet name, as returned by
+            data_in.
+        rules: the `rules.Rule`s to check, defaults to `cross_rules`.
+
+    Returns:
+        A DataFrame of the problems of each member with any.
+    """
+    from main import output_problems
+
+    return output_problems(evaluate(cross_rules if rules is None else rules,
+                                    Joined(sheets)))
@@ -0,0 +1,199 @@
+"""A statistics cube over nested groupings with hierarchical fallback.
+
+Instead of z scoring every metric against each grouping in turn, the
+count, mean and M2 of every metric are reduced once per cell, a
+combination of the grouping columns such as (GI Region, Climate), and
+rolled up into each level, e.g. GI Region, Climate and every member.
+Each row is then scored against the most specific level whose group
+has enough values of the metric, found by an indexed lookup per level.
+
+Each level is a `stats.GroupStats`, so cubes merge across chunks and are
+saved as one CSV of every level, which later runs can score against
+with `main.Settings.cube_dirs`, e.g. the cubes of earlier reporting
+years.
+
+Usage:
+    python cube.py data.xlsx cubes/2023
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from stats import GroupStats, finite_moments, metric_values, rollup
+
+
+def levels(groupings):
+    """Returns the levels of a cube for the groupings of a validation,
+    most specific first and ending with every member.
+
+    Args:
+        groupings: (column, minimum_count) pairs, see `outliers.unusual`.
+
+    Returns:
+        A list of (column, minimum_count) pairs, None for every member.
+    """
+    found = [(by, minimum_count) for by, minimum_count in groupings
+             if by is not None]
+    national = [(by, minimum_count) for by, minimum_count in groupings
+                if by is None]
+    return found + (national or [(None, 0)])
+
+
+class Cube:
+    """Group statistics of metric columns rolled up over nested levels.
+
+    Args:
+        levels: (column, minimum_count) pairs, the most specific first,
+            None for every member. A group is used for a metric when it
+            has more than its minimum count of values and at least two.
+        cols: the metric columns.
+    """
+
+    def __init__(self, levels, cols):
+        self.levels = list(levels)
+        self.cols = list(cols)
+        self.stats = [GroupStats(by, self.cols) for by, minimum_count in
+                      self.levels]
+
+    def add(self, df):
+        """Adds the rows of a DataFrame to every level of the cube.
+
+        The moments are reduced once per cell and rolled up into the
+        levels.
+        """
+        keys = [group_stats.factorize(df) for group_stats in self.stats]
+        cells, codes = np.unique(
+            np.stack([codes for codes, labels in keys], axis=1), axis=0,
+            return_inverse=True)
+        codes = codes.ravel()
+        count, mean, m2, nonfinite = finite_moments(
+            metric_values(df, self.cols), codes, len(cells))
+        for level, (group_stats, (level_codes, labels)) in enumerate(
+                zip(self.stats, keys)):
+            chunk = GroupStats(group_stats.by, self.cols)
+            chunk.groups = {label: i for i, label in enumerate(labels)}
+            chunk.count, chunk.mean, chunk.m2 = rollup(
+                count, mean, m2, cells[:, level], len(labels))
+            chunk.nonfinite = rollup(
+                nonfinite, np.zeros_like(nonfinite),
+                np.zeros_like(nonfinite), cells[:, level], len(labels))[0]
+            group_stats.merge(chunk)
+        return self
+
+    def merge(self, other):
+        """Adds the statistics of another `Cube` of the same levels."""
+        if [by for by, minimum_count in other.levels] != \
+                [by for by, minimum_count in self.levels]:
+            raise ValueError('Can only merge cubes of the same levels')
+        for group_stats, other_stats in zip(self.stats, other.stats):
+            group_stats.merge(other_stats)
+        return self
+
+    def lookup(self, df):
+        """Returns the level each value is scored against, and the mean
+        and standard deviation it is scored with.
+
+        Returns:
+            A tuple of (level, mean, std) arrays with a column per
+            metric, level -1 and NaN where no level has enough values.
+        """
+        shape = (len(df), len(self.cols))
+        level = np.full(shape, -1)
+        mean, std = np.full(shape, np.nan), np.full(shape, np.nan)
+        # From every member to the most specific, so the most specific
+        # level with enough values is the one left
+        for i in reversed(range(len(self.levels))):
+            group_stats = self.stats[i]
+            minimum_count = max(self.levels[i][1], 1)
+            codes = group_stats.codes(df)
+            if not len(group_stats.groups):
+                continue
+            rows = np.where(codes >= 0, codes, 0)
+            enough = (group_stats.total()[rows] > minimum_count) & \
+                (codes >= 0)[:, None]
+            level[enough] = i
+            mean[enough] = group_stats.mean[rows][enough]
+            std[enough] = group_stats.std()[rows][enough]
+        return level, mean, std
+
+    def zscores(self, df):
+        """Returns the z score of each value against the most specific
+        level with enough values, NaN where there is none."""
+        level, mean, std = self.lookup(df)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (self.values(df) - mean) / std
+
+    def values(self, df):
+        return metric_values(df, self.cols)
+
+    def to_frame(self):
+        """Returns every level as one long DataFrame, see
+        `GroupStats.to_frame`, with the level's minimum count."""
+        return pd.concat(
+            [group_stats.to_frame().assign(minimum_count=minimum_count)
+             for group_stats, (by, minimum_count) in
+             zip(self.stats, self.levels)], ignore_index=True)
+
+    @classmethod
+    def from_frame(cls, frame, cols=None):
+        """Returns the cube held in a frame from `to_frame`."""
+        by = frame['by'].astype(object).where(frame['by'].notna(), None)
+        levels = list(dict.fromkeys(zip(by, frame['minimum_count'])))
+        cube = cls(levels, cols or list(dict.fromkeys(frame['metric'])))
+        cube.stats = [GroupStats.from_frame(frame[by.to_numpy() == level],
+                                            cube.cols)
+                      for level, minimum_count in levels]
+        return cube
+
+    def save(self, path):
+        """Writes the cube to a CSV file."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.to_frame().to_csv(path, index=False)
+
+    @classmethod
+    def load(cls, path, cols=None):
+        """Reads a cube written by `save`."""
+        # The moments read back as saved, not to the nearest few digits
+        return cls.from_frame(pd.read_csv(path, float_precision='round_trip'),
+                              cols)
+
+
+def cube_path(directory, sheet_name):
+    return os.path.join(directory, '{}.csv'.format(sheet_name))
+
+
+def load_all(directories, validation):
+    """Reads and merges the cubes saved in several directories.
+
+    Args:
+        directories: directories written by this module's command line,
+            e.g. one per reporting year.
+        validation: the `main.Validation` the cubes are for.
+
+    Returns:
+        A `Cube` of the levels of the validation's groupings.
+    """
+    cube = Cube(levels(validation.groupings), validation.metrics)
+    for directory in directories:
+        cube.merge(Cube.load(cube_path(directory, validation.name),
+                             validation.metrics))
+    return cube
+
+
+if __name__ == '__main__':
+    import main
+
+    parser = argparse.ArgumentParser(
+        description='Saves the statistics cube of a workbook.')
+    parser.add_argument('path', help='the workbook')
+    parser.add_argument('directory', help='the directory to save to')
+    args = parser.parse_args()
+
+    sheets = main.data_in(['Vineyard', 'Winery'], path=args.path)
+    for name, validation in [('Vineyard', main.vineyard),
+                             ('Winery', main.winery)]:
+        Cube(levels(validation.groupings), validation.metrics) \
+            .add(validation.transform(sheets[name])) \
+            .save(cube_path(args.directory, name))
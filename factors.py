@@ -0,0 +1,136 @@
+"""Emission factors by reporting year and state.
+
+The factors are read from `factors_path`, a row per version with the
+first reporting year it applies to and, optionally, the state it is
+for. Rows without a state apply to every state. Each member gets the
+latest version up to their `Data Reporting Year`, preferring a version
+for their state when the sheet has a `state_column`. Members without a
+year get the latest version, and years before the first version get the
+first one.
+
+The factors of every row are looked up at once with np.searchsorted, so
+a sheet spanning several years is costed in one pass. The columns are
+named '<factor> factor':
+
+    Petrol, Diesel, LPG, Biodiesel   kg CO2e/L
+    Natural gas                      kg CO2e/GJ
+    Grid electricity                 kg CO2e/kWh
+    Nitrogen, Urea                   kg CO2e/kg
+"""
+import functools
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+#############
+# variables
+
+factors_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'emission_factors.csv')
+year_column = 'Data Reporting Year'
+state_column = 'State'
+
+
+@functools.lru_cache()
+def load_factors(path=None):
+    """Returns the factor versions sorted by year.
+
+    Args:
+        path: the factors CSV, defaults to `factors_path`.
+
+    Returns:
+        A DataFrame with the year, state and a column per factor.
+
+    Raises:
+        ValueError: if no row is without a state, as members of states
+            without versions of their own have nothing to fall back on.
+    """
+    table = pd.read_csv(path or factors_path)
+    table[state_column] = table[state_column].astype(object)
+    if table[state_column].notna().all():
+        raise ValueError('{} has no national factors, rows without a {}'
+                         .format(path or factors_path, state_column))
+    return table.sort_values(year_column, kind='stable') \
+        .reset_index(drop=True)
+
+
+def reporting_year(values: pd.Series):
+    """Returns the reporting years as numbers.
+
+    A financial year like '2022/23' is the year it ends in, 2023.
+
+    Args:
+        values: the reporting years as numbers or text.
+
+    Returns:
+        A float array, NaN where the year is blank or can't be read.
+    """
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return values.to_numpy(dtype=float, na_value=np.nan)
+    codes, uniques = pd.factorize(values)
+    years = []
+    for value in uniques:
+        match = re.match(r'\s*(\d{4})(?:\s*[/-]\s*(\d{2}|\d{4}))?',
+                         str(value))
+        if match is None:
+            years.append(np.nan)
+        elif match.group(2) is None:
+            years.append(float(match.group(1)))
+        else:
+            end = match.group(2)
+            years.append(float(end) if len(end) == 4 else
+                         float(match.group(1)[:2] + end))
+    # The last entry is for the code -1 of blanks
+    return np.append(years, np.nan)[codes]
+
+
+def versions(table, years):
+    """Returns the row of `table` that applies to each year, -1 for
+    years before its first version."""
+    rows = np.searchsorted(table[year_column].to_numpy(dtype=float), years,
+                           side='right') - 1
+    rows[np.isnan(years)] = len(table) - 1
+    return rows
+
+
+def factors(df, names=None, path=None):
+    """Returns the emission factors of each row of a sheet.
+
+    Args:
+        df: the sheet, its `year_column` and `state_column` are used when
+            it has them.
+        names: the factors to return, defaults to all of them.
+        path: the factors CSV, defaults to `factors_path`.
+
+    Returns:
+        A DataFrame with the index of `df` and a '<factor> factor' column
+        per factor. Years before the first national version get the first
+        national version, as there are no earlier factors, and years
+        before their state's first version get the national one.
+    """
+    table = load_factors(path)
+    names = [col for col in table.columns
+             if col not in (year_column, state_column)] \
+        if names is None else list(names)
+
+    years = reporting_year(df[year_column]) if year_column in df \
+        else np.full(len(df), np.nan)
+    national = table[table[state_column].isna()]
+    # Years before the first version, -1, fall back to it
+    values = national[names].to_numpy(dtype=float)[
+        np.maximum(versions(national, years), 0)]
+
+    if state_column in df:
+        states = df[state_column].to_numpy(dtype=object)
+        for state, state_table in table.dropna(
+                subset=[state_column]).groupby(state_column):
+            rows = np.flatnonzero(states == state)
+            found = versions(state_table, years[rows])
+            # Years before the state's first version use the national one
+            values[rows[found >= 0]] = \
+                state_table[names].to_numpy(dtype=float)[found[found >= 0]]
+
+    return pd.DataFrame(values, index=df.index,
+                        columns=[name + ' factor' for name in names])
@@ -0,0 +1,175 @@
+"""Revalidates only the members whose rows changed since the last run.
+
+The transformed rows, rule flags and group statistics of the last run
+of each sheet, and for the Vineyard sheet the metrics of
+`clean.proc_vineyard`, are kept in `state_dir`. A new workbook is
+compared with them by row hash, only new or changed members are
+transformed, processed and checked again, and the old rows of changed
+or removed members are taken out of the group statistics and the new
+ones added, without reducing any group again. Every member is then
+rescored against the updated statistics, which is a single vectorised
+lookup.
+
+The state is rebuilt when the sheet's columns, metrics, groupings or
+rule names change. Use --full after changing the logic of a rule.
+
+Usage:
+    python incremental.py data.xlsx
+"""
+import argparse
+import os
+import time
+
+import pandas as pd
+
+from clean import proc_vineyard
+import main
+from outliers import unusual
+from rules import evaluate
+from stats import GroupStats
+import writer
+
+#############
+# variables
+
+state_dir = '.state'
+# Row-wise processing kept up to date alongside the checks, by sheet
+processors = {'Vineyard': proc_vineyard}
+
+
+def row_hashes(data):
+    """Returns a hash of each row, including its Membership Number."""
+    return pd.util.hash_pandas_object(data, index=True)
+
+
+def signature(data, validation):
+    """Returns what a saved state has to match to be updated."""
+    return (list(data.columns), list(validation.metrics),
+            list(validation.groupings),
+            [rule.name for rule in validation.rules],
+            validation.name in processors)
+
+
+def build(data, validation):
+    """Returns the state of a full run over a sheet.
+
+    Args:
+        data: the sheet as returned by data_in.
+        validation: the `main.Validation` for the sheet.
+
+    Returns:
+        A dict of the row hashes, transformed rows, rule flags and group
+        statistics of the sheet, and its `processors` output if any.
+    """
+    transformed = validation.transform(data)
+    state = {
+        'signature': signature(data, validation),
+        'hashes': row_hashes(data),
+        'transformed': transformed,
+        'rules': evaluate(validation.rules, transformed),
+        'stats': [GroupStats(by, validation.metrics).add(transformed)
+                  for by, minimum_count in validation.groupings],
+    }
+    if validation.name in processors:
+        state['processed'] = processors[validation.name](data)
+    return state
+
+
+def update(state, data, validation):
+    """Updates a state with the members that changed.
+
+    Args:
+        state: the state of the last run, as returned by `build`.
+        data: the sheet as returned by data_in.
+        validation: the `main.Validation` for the sheet.
+
+    Returns:
+        A tuple of the updated state and the number of new or changed
+        and removed members.
+    """
+    hashes = row_hashes(data)
+    old = state['hashes']
+    common = hashes.index.intersection(old.index)
+    changed = common[hashes[common].to_numpy() != old[common].to_numpy()]
+    removed = old.index.difference(hashes.index)
+    stale = changed.append(removed)
+    fresh = changed.append(hashes.index.difference(old.index))
+
+    transformed = validation.transform(data.loc[fresh])
+    old = state['transformed'].loc[stale]
+    state['transformed'] = pd.concat(
+        [state['transformed'].drop(stale), transformed]).loc[data.index]
+    for stats in state['stats']:
+        stats.remove(old).add(transformed)
+
+    if validation.name in processors:
+        state['processed'] = pd.concat(
+            [state['processed'].drop(stale),
+             processors[validation.name](data.loc[fresh])]).loc[data.index]
+    state['rules'] = pd.concat(
+        [state['rules'].drop(stale),
+         evaluate(validation.rules, transformed)]).loc[data.index]
+    state['hashes'] = hashes
+    return state, len(fresh), len(removed)
+
+
+def revalidate(data, validation, name, directory=None, full=False):
+    """Returns the problems of a sheet, reusing the last run's state.
+
+    Args:
+        data: the sheet as returned by data_in.
+        validation: the `main.Validation` for the sheet.
+        name: the name the state is saved under, e.g. the sheet name.
+        directory: the state directory, defaults to `state_dir`.
+        full: ignore any saved state and validate every member.
+
+    Returns:
+        A DataFrame of the problems of each member with any.
+    """
+    start = time.perf_counter()
+    path = os.path.join(directory or state_dir, name + '.pkl')
+    state = None
+    if not full and os.path.exists(path):
+        state = pd.read_pickle(path)
+        if state['signature'] != signature(data, validation):
+            state = None
+
+    if state is None:
+        state = build(data, validation)
+        status = 'full run over {} members'.format(len(data))
+    else:
+        state, fresh, removed = update(state, data, validation)
+        status = '{} new or changed, {} removed of {} members'.format(
+            fresh, removed, len(data))
+
+    problems = unusual(
+        state['transformed'], validation.metrics, validation.groupings,
+        main.threshold, validation.suffix, validation.report,
+        stats=state['stats'])
+    problems = main.output_problems(
+        pd.concat([problems, state['rules']], axis=1))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.to_pickle(state, path)
+    print('{}: {} ({:.2f}s)'.format(
+        name, status, time.perf_counter() - start))
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', nargs='?', default='data.xlsx',
+                        help='the workbook to validate')
+    parser.add_argument('--full', action='store_true',
+                        help='validate every member from scratch')
+    parser.add_argument('--write-memory', action='store_true',
+                        help='write each file again under tracemalloc to '
+                             'report its peak memory')
+    args = parser.parse_args()
+
+    sheets = main.data_in(['Vineyard', 'Winery'], path=args.path)
+    writer.write({
+        'Vineyard': revalidate(sheets['Vineyard'], main.vineyard,
+                               'Vineyard', full=args.full),
+        'Winery': revalidate(sheets['Winery'], main.winery, 'Winery',
+                             full=args.full)}, memory=args.write_memory)
@@ -0,0 +1,172 @@
+"""Timing, memory and row counts for each stage of a run.
+
+The pipeline wraps its stages, rules and outlier groupings in `stage()`.
+Nothing is recorded unless a run is being recorded with `recording()`,
+in which case each stage gets its seconds, resident memory, peak
+resident memory and rows in and out. One stage can also be profiled
+with cProfile or traced with tracemalloc. The run report is printed as a
+table and can be saved as JSON to compare releases.
+
+The peak resident memory is the high-water mark of the process so far,
+so a stage that raises it is the one that used the memory.
+"""
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+current = None
+
+
+def rss():
+    """Returns the resident memory of the process in MB, if known."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except (OSError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """Returns the peak resident memory of the process in MB, if known."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+class Run:
+    """Records the stages of a run.
+
+    Args:
+        profile: the name of a stage to run under cProfile.
+        trace: the name of a stage to trace with tracemalloc.
+    """
+
+    def __init__(self, profile=None, trace=None):
+        self.profile = profile
+        self.trace = trace
+        self.records = []
+        self.depth = 0
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """Records a stage, yielding its record so 'rows out' and other
+        details can be filled in."""
+        record = {'stage': name, 'depth': self.depth, 'rows in': rows_in,
+                  'rows out': None}
+        self.records.append(record)
+        profiler = cProfile.Profile() if name == self.profile else None
+        tracing = name == self.trace and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        self.depth += 1
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['seconds'] = time.perf_counter() - start
+            self.depth -= 1
+            record['rss MB'] = rss()
+            record['peak rss MB'] = peak_rss()
+            if profiler is not None:
+                text = io.StringIO()
+                pstats.Stats(profiler, stream=text) \
+                    .sort_stats('cumulative').print_stats(20)
+                record['profile'] = text.getvalue()
+            if tracing:
+                record['peak traced MB'] = \
+                    tracemalloc.get_traced_memory()[1] / 2 ** 20
+                record['top allocations'] = [
+                    str(statistic) for statistic in
+                    tracemalloc.take_snapshot().statistics('lineno')[:10]]
+                tracemalloc.stop()
+
+    def add(self, name, seconds, rows_in=None, rows_out=None):
+        """Records a stage timed elsewhere, e.g. on a worker thread."""
+        self.records.append({
+            'stage': name, 'depth': self.depth, 'rows in': rows_in,
+            'rows out': rows_out, 'seconds': seconds, 'rss MB': rss(),
+            'peak rss MB': peak_rss()})
+
+    def table(self):
+        """Returns the stages as a DataFrame, nested stages indented."""
+        table = pd.DataFrame(self.records, columns=[
+            'stage', 'depth', 'seconds', 'rows in', 'rows out', 'rss MB',
+            'peak rss MB'])
+        table['stage'] = [
+            '  ' * depth + name
+            for name, depth in zip(table['stage'], table['depth'])]
+        return table.drop(columns='depth').set_index('stage')
+
+    def report(self):
+        """Prints the stages and any profile or allocation trace."""
+        print(self.table().round(4).to_string())
+        for record in self.records:
+            if 'profile' in record:
+                print('\nProfile of {}:\n{}'.format(
+                    record['stage'], record['profile']))
+            if 'top allocations' in record:
+                print('\nAllocations in {} (peak {:.1f} MB):\n{}'.format(
+                    record['stage'], record['peak traced MB'],
+                    '\n'.join(record['top allocations'])))
+
+    def save(self, path):
+        """Writes the run as JSON."""
+        with open(path, 'w') as f:
+            json.dump({'seconds': time.perf_counter() - self.start,
+                       'stages': self.records}, f, indent=2, default=str)
+
+
+def stage(name, rows_in=None):
+    """Returns a context recording a stage of the current run.
+
+    When no run is being recorded, or the stage runs on a worker thread,
+    this does nothing and the record it yields is thrown away. The stage
+    that hands work to the threads is recorded as a whole.
+    """
+    if current is None or \
+            threading.current_thread() is not threading.main_thread():
+        return contextlib.nullcontext({})
+    return current.stage(name, rows_in)
+
+
+def timed(name, seconds, rows_in=None, rows_out=None):
+    """Records a stage of the current run that was timed elsewhere, e.g.
+    on a worker thread, after the stages recorded so far.
+
+    It can't be profiled or traced. Like `stage`, this does nothing when
+    no run is being recorded or on a worker thread.
+    """
+    if current is None or \
+            threading.current_thread() is not threading.main_thread():
+        return
+    current.add(name, seconds, rows_in, rows_out)
+
+
+@contextlib.contextmanager
+def recording(profile=None, trace=None):
+    """Records the stages run inside it, yielding the `Run`."""
+    global current
+    previous, current = current, Run(profile, trace)
+    try:
+        yield current
+    finally:
+        current = previous
@@ -0,0 +1,64 @@
+"""Reads every requested sheet of an SWA workbook from one open handle."""
+import pandas as pd
+
+try:
+    import python_calamine  # noqa: F401
+    fast_engine = 'calamine'
+except ImportError:
+    fast_engine = None
+
+
+def drop_duplicate_columns(data):
+    """Returns the frame with only the first of any repeated columns."""
+    return data.loc[:, ~data.columns.duplicated()].copy()
+
+
+def normalise_index(data, column='Membership Number'):
+    """Sets a member number column as an integer index.
+
+    Leading apostrophes, which Excel uses to keep numbers as text, are
+    removed before the conversion.
+
+    Args:
+        data: the DataFrame read from the workbook.
+        column: the member number column.
+
+    Returns:
+        The DataFrame indexed by the member number.
+    """
+    data[column] = data[column].astype(str).str.lstrip("'").astype(int)
+    return data.set_index(column)
+
+
+def read_workbook(path: str, sheet_names=None, header=0, index=None,
+                  engine=None):
+    """Returns the cleaned sheets of a workbook.
+
+    The workbook is opened and unzipped once and each sheet is parsed
+    out of that handle.
+
+    Args:
+        path: the workbook path.
+        sheet_names: the sheets to read, all of them if None.
+        header: the row holding the column names.
+        index: a member number column to normalise and use as the index,
+            or None to keep the default index.
+        engine: the pandas Excel engine, 'fast' picks calamine when it
+            is installed.
+
+    Returns:
+        A dict of DataFrames keyed by sheet name.
+    """
+    if engine == 'fast':
+        engine = fast_engine
+
+    data = {}
+    with pd.ExcelFile(path, engine=engine) as workbook:
+        if sheet_names is None:
+            sheet_names = workbook.sheet_names
+        for sheet in sheet_names:
+            data[sheet] = drop_duplicate_columns(workbook.parse(
+                sheet, header=header, index_col=False))
+            if index is not None:
+                data[sheet] = normalise_index(data[sheet], index)
+    return data
@@ -1,8 +1,31 @@
 # import warnings
 # warnings.simplefilter(action='ignore', category=FutureWarning)
+import argparse
+import contextlib
+import hashlib
+import inspect
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
 
+from cache import cached_read
+from classify import climate, size
+import cube
+import crosscheck
+from factors import factors
+import instrument
+import schema
+import loader
+from loader import read_workbook
+from outliers import unusual_names, unusual_values
+from problems import Problems
+from rules import Rule, flags
+from schema import contractor_columns
+import sketch
+
 #############
 # variables
 
@@ -57,153 +80,181 @@ def cond_problem(col1: np.array, col2: np.array, two_way=False):
     return df[df != 1].fillna('Yes')
 
 
-def climate(region: str):
-    if region in ['Macedon Ranges',
-                  'Mornington Peninsula',
-                  'Orange', 'Canberra District', 'Yarra Valley',
-                  'Beechworth',  'Upper Goulburn',
-                  'Strathbogie Ranges',
-                  'Southern Fleurieu', 'Adelaide Hills']:
-        return 'Cool Damp'
-    if region in ['Mount Gambier', 'Henty', 'Grampians',
-                  'Kangaroo Island', 'Sunbury', 'Wrattonbully',
-                  'Coonawarra', 'Robe', 'Mount Benson']:
-        return 'Cool Dry'
-    if region in ['Geelong', 'Pyrenees']:
-        return 'Cool Very Dry'
-    if region in ['Alpine Valleys', 'Pemberton', 'Tumbarumba']:
-        return 'Mild Damp'
-    if region in ['Blackwood Valley',
-                  'Eden Valley',
-                  'Manjimup',
-                  'Granite Belt',
-                  'Currency Creek',
-                  'Padthaway',
-                  'Heathcote']:
-        return 'Mild Dry'
-    if region in ['Great Southern', 'McLaren Vale', 'Bendigo']:
-        return 'Mild Very Dry'
-    if region in ['Geographe', 'New England Australia',
-                  'Shoalhaven Coast', 'Southern Highlands',
-                  'Margaret River']:
-        return 'Warm Damp'
-    if region in ['Peel', 'Gundagai', 'Glenrowan',
-                  'Pericoota','Clare Valley', 'Mudgee']:
-        return 'Warm Dry'
-    if region in ['Rutherglen', 'Goulburn Valley', 'Langhorne Creek',
-                  'Barossa Valley']:
-        return 'Warm Very Dry'
-    if region in ['Hunter Valley', 'Hastings River']:
-        return 'Hot Damp'
-    if region in ['Perth Hills', 'Swan District' 'Southern Flinders Ranges']:
-        return 'Hot Dry'
-    if region in ['South Burnett',
-                  'Cowra',
-                  'Riverina',
-                  'Adelaide Plains',
-                  'Riverland',
-                  'Swan Hill',
-                  'Murray Darling']:
-        return 'Hot Very Dry'
-    return 'Unknown Climate'
-
-
-def size(tonnes: float):
-    if tonnes < 500:
-        return 'Small'
-    if tonnes < 10000:
-        return 'Medium'
-    return 'Large'
-    # Sizes:
-    # Vlarge > 20k
-    # large < 20k
-    # med < 10k
-    # small < 500
-    # micro < 100
-
 ##########
 # Data in:
 
-def data_in(sheet_name='Vineyard'):
-    # Read the data without setting the index
-    data = pd.read_excel('data.xlsx', sheet_name=sheet_name, index_col=False, header=1)
+def read_sheets(path, sheet_names, plan=True):
+    # Member numbers are in the second row of the export
+    data = read_workbook(path, sheet_names, header=1,
+                         index='Membership Number', engine='fast')
+    if plan:
+        for name, frame in data.items():
+            data[name] = schema.apply(frame)
+            print('{}: {:.2f} MB read, {:.2f} MB with the dtype plan'.format(
+                name, schema.memory_mb(frame), schema.memory_mb(data[name])))
+    return data
 
-    # Remove leading apostrophes from 'Membership Number' column
-    data['Membership Number'] = data['Membership Number'].astype(str).str.lstrip("'")
 
-    data['Membership Number'] = data['Membership Number'].astype(int)
+def reader_version():
+    """Returns a hash of the code and settings sheets are read and
+    planned with, which keys the sheet cache."""
+    digest = hashlib.sha256()
+    for code in [read_sheets, loader, schema]:
+        digest.update(inspect.getsource(code).encode())
+    # The plan's settings may be changed after import
+    digest.update(repr(sorted(
+        (name, value) for name, value in vars(schema).items()
+        if isinstance(value, (int, float, str, list, dict)) and
+        not name.startswith('_'))).encode())
+    return digest.hexdigest()
 
-    # Set 'Membership Number' as the index
-    data.set_index('Membership Number', inplace=True)
 
-    print(data.head())
-    return data
+def data_in(sheet_name='Vineyard', path='data.xlsx', use_cache=True):
+    """Reads sheets of the SWA export indexed by Membership Number.
+
+    Args:
+        sheet_name: a sheet name, or a list of them to read in one pass.
+        path: the workbook path.
+        use_cache: whether to go through the Parquet cache.
+
+    Returns:
+        A DataFrame for a single sheet name, otherwise a dict of
+        DataFrames keyed by sheet name.
+    """
+    names = [sheet_name] if isinstance(sheet_name, str) else sheet_name
+    with instrument.stage('data_in') as record:
+        if use_cache:
+            data = cached_read(path, names, read_sheets,
+                               version=reader_version())
+        else:
+            data = read_sheets(path, names)
+        record['rows out'] = sum(len(frame) for frame in data.values())
+    return data[sheet_name] if isinstance(sheet_name, str) else data
 
 ###################
 # Data transformations
 
+def total(df, cols, weights=None):
+    """Returns the sum of columns, skipping blanks.
+
+    Args:
+        df: the DataFrame holding the columns.
+        cols: the columns to add.
+        weights: an optional factor per column.
+
+    Returns:
+        An array that is blank only where every column is blank, like
+        `sum(min_count=1)`.
+    """
+    values = df[cols].to_numpy(dtype=float)
+    if weights is not None:
+        values = values * weights
+    result = np.nansum(values, axis=1)
+    result[np.isnan(values).all(axis=1)] = np.nan
+    return result
+
+
+def ratio(numerator, denominator):
+    """Divides two columns with blanks counted as zero, as the checks
+    always have, so a blank or zero denominator gives inf."""
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(np.isnan(numerator), 0, numerator) / \
+            np.where(np.isnan(denominator), 0, denominator)
+
+
+def derived_block(df, names):
+    """Returns a preallocated float block for derived columns and its
+    rows keyed by name, to be filled in and joined with `join_derived`."""
+    block = np.full((len(names), len(df)), np.nan)
+    return block, dict(zip(names, block))
+
+
+def join_derived(df, block, names, *columns):
+    """Returns the sheet with its derived columns in one concat.
+
+    The block is used as the storage of the new columns and the sheet
+    isn't copied or changed.
+    """
+    derived = pd.DataFrame(block.T, index=df.index, columns=names,
+                           copy=False)
+    return pd.concat([df, derived, *columns], axis=1)
+
+
+vineyard_derived = [
+    'Total Vineyard Area', 't/ha', 'Total water used', 'ml/ha', 'ml/t',
+    'total irrigation', 'total fuel', 'fuel / t', '#No. Passes',
+    'Applied Fertiliser', 'fertiliser/ha', 'fertiliser/tonnes',
+    'total cover', 'irrigation count', 'irrigation%', 'area not harvested']
+
+
 def data_transform(df):
+    """Derives the checked Vineyard columns.
+
+    Sums skip blank answers and are blank when every part is. Zeros are
+    kept as entered in the frame, but the checks still read every zero as
+    no answer, see `rules.Columns`.
+
+    Args:
+        df: the Vineyard sheet as returned by data_in.
+
+    Returns:
+        A new DataFrame of the sheet and the derived columns.
+    """
     #df = df[~df['Paid At'].isnull()]
-    df = df.fillna(0)
-    # df['Total Vineyard Area'] = df['Red grapes (ha)'] + df['White grapes (ha)']
-    df['Total Vineyard Area'] = df['Total Vineyard Area (ha)'].copy()
-    # df['t/ha'] = df['Grapes harvested (t)'] / df['Total Vineyard Area']
-    df['t/ha'] = df['Total t/ha harvested'].copy()
-    df['Total water used'] = df['River water (ML)'] + df['Groundwater (ML)'] + \
-        df['Surface water dam (ML)'] + df['Recycled water from winery (ML)'] + \
-        df['Recycled water from other source (ML)'] + df['Mains water (ML)'] + \
-        df['Other water (ML)'] + df['Water applied for frost control (ML)']
-    df['ml/ha'] = df['Total water used'] / df['Total Vineyard Area']
-    df['ml/t'] = df['Total water used'] / df['Grapes harvested (t)']
-    df['total irrigation'] = df['Irrigation type - Dripper (ha)'] + \
-        df['Irrigation type - Undervine Sprinkler (ha)'] + \
-        df['Irrigation type - Overhead Sprinkler (ha)'] + \
-        df['Irrigation type - Flood (ha)'] + \
-        df['Irrigation type - Non-irrigated (ha)']
-    df['total fuel'] = df['Petrol (L)'] + \
-        df['LPG (L)'] +\
-        df['Diesel (L)'] + \
-        df['Biodiesel (L)']
-    df['fuel / t'] = df['total fuel'] / df['Grapes harvested (t)']
-    df['#No. Passes'] = df['Slashing Number of times/passes per year'] + \
-        df['Fungicide spraying Number of times/passes per year'] + \
-        df['Insecticide spraying Number of times/passes per year'] + \
-        df['Herbicide spraying Number of times/passes per year']
-    df['Applied Fertiliser'] = df['Applied']
-    for i in range(1, 6):
-        df['Applied Fertiliser'] += df['Applied.{}'.format(i)]
-
-    df['fertiliser/ha'] = df['Applied Fertiliser'] / \
-                         df['Total Vineyard Area']
-    df['fertiliser/tonnes'] = df['Applied Fertiliser'] / \
-        df['Grapes harvested (t)']
-    df['total cover'] = df['Annual cover crop (ha)'] + \
-        df['Permanent cover crop non native (ha)'] + \
-        df['Permanent cover crop volunteer sward (ha)'] + \
-        df['Permanent cover crop - native (ha)'] + \
-        df['Bare soil (ha)']
-    df['irrigation count'] = \
-        (df['Irrigation type - Dripper (ha)'] > 0)*1 +\
-        (df['Irrigation type - Undervine Sprinkler (ha)'] > 0)*1 +\
-        (df['Irrigation type - Overhead Sprinkler (ha)'] > 0)*1 +\
-        (df['Irrigation type - Flood (ha)'] > 0)*1 +\
-        (df['Irrigation type - Non-irrigated (ha)'] > 0)*1
-    df['irrigation%'] = \
-        df['total irrigation'] / \
-        df['Total Vineyard Area']
-    df['area not harvested'] =\
-        df['Frost (ha)'] +\
-        df['Non-sale (ha)'] +\
-        df['New development / redevelopment (ha)'] +\
-        df['Pest/disease (ha)']
-
-    df['Climate'] = df['GI Region'].apply(climate)
-
-    return df.replace({0: np.nan})
-
-df = data_in()
-df = data_transform(df)
-problems = pd.DataFrame(index=df.index)
+    block, d = derived_block(df, vineyard_derived)
+    # d['Total Vineyard Area'] = df['Red grapes (ha)'] + df['White grapes (ha)']
+    d['Total Vineyard Area'][:] = df['Total Vineyard Area (ha)']
+    # d['t/ha'] = df['Grapes harvested (t)'] / d['Total Vineyard Area']
+    d['t/ha'][:] = df['Total t/ha harvested']
+    d['Total water used'][:] = total(df, [
+        'River water (ML)', 'Groundwater (ML)', 'Surface water dam (ML)',
+        'Recycled water from winery (ML)',
+        'Recycled water from other source (ML)', 'Mains water (ML)',
+        'Other water (ML)', 'Water applied for frost control (ML)'])
+    d['ml/ha'][:] = ratio(d['Total water used'], d['Total Vineyard Area'])
+    d['ml/t'][:] = ratio(d['Total water used'], df['Grapes harvested (t)'])
+    d['total irrigation'][:] = total(df, [
+        'Irrigation type - Dripper (ha)',
+        'Irrigation type - Undervine Sprinkler (ha)',
+        'Irrigation type - Overhead Sprinkler (ha)',
+        'Irrigation type - Flood (ha)',
+        'Irrigation type - Non-irrigated (ha)'])
+    d['total fuel'][:] = total(df, [
+        'Petrol (L)', 'LPG (L)', 'Diesel (L)', 'Biodiesel (L)'])
+    d['fuel / t'][:] = ratio(d['total fuel'], df['Grapes harvested (t)'])
+    d['#No. Passes'][:] = total(df, [
+        'Slashing Number of times/passes per year',
+        'Fungicide spraying Number of times/passes per year',
+        'Insecticide spraying Number of times/passes per year',
+        'Herbicide spraying Number of times/passes per year'])
+    d['Applied Fertiliser'][:] = total(
+        df, ['Applied'] + ['Applied.{}'.format(i) for i in range(1, 6)])
+
+    d['fertiliser/ha'][:] = ratio(d['Applied Fertiliser'],
+                                  d['Total Vineyard Area'])
+    d['fertiliser/tonnes'][:] = ratio(d['Applied Fertiliser'],
+                                      df['Grapes harvested (t)'])
+    d['total cover'][:] = total(df, [
+        'Annual cover crop (ha)', 'Permanent cover crop non native (ha)',
+        'Permanent cover crop volunteer sward (ha)',
+        'Permanent cover crop - native (ha)', 'Bare soil (ha)'])
+    d['irrigation count'][:] = (df[[
+        'Irrigation type - Dripper (ha)',
+        'Irrigation type - Undervine Sprinkler (ha)',
+        'Irrigation type - Overhead Sprinkler (ha)',
+        'Irrigation type - Flood (ha)',
+        'Irrigation type - Non-irrigated (ha)']].to_numpy(dtype=float)
+        > 0).sum(axis=1)
+    d['irrigation%'][:] = ratio(d['total irrigation'],
+                                d['Total Vineyard Area'])
+    d['area not harvested'][:] = total(df, [
+        'Frost (ha)', 'Non-sale (ha)',
+        'New development / redevelopment (ha)', 'Pest/disease (ha)'])
+
+    return join_derived(df, block, vineyard_derived,
+                        climate(df['GI Region']))
 
 ###################
 # # Finding problems using radicals
@@ -250,251 +301,317 @@ problems = pd.DataFrame(index=df.index)
 #     cl_temp = None
 
 
-for col in ['t/ha', 'ml/ha', 'ml/t', 'fuel / t', '#No. Passes',
-            'fertiliser/ha', 'fertiliser/tonnes', 'irrigation%']:
+vineyard_metrics = ['t/ha', 'ml/ha', 'ml/t', 'fuel / t', '#No. Passes',
+                    'fertiliser/ha', 'fertiliser/tonnes', 'irrigation%']
 
-    # Group by 'GI Region'
-    gp = df.groupby('GI Region')
-    regions = []
-    counts = gp[col].count()
-    for region in counts.index:
-        if counts.loc[region] > minimum_count:
-            regions.append(region)
-    gp = df[df['GI Region'].isin(regions)].groupby('GI Region')
-    
-    # Calculate z-scores
-    df_temp = gp[col].transform(zscore)
-    
-    # Align the indices and extract original values where z-scores are unusual
-    original_values = df[col].where((df_temp > threshold) | (df_temp < -threshold))
-    
-    # Group by 'Climate'
-    cl = df.groupby('Climate')
-    cl_temp = cl[col].transform(zscore)
-    
-    # Align the indices and extract original values where z-scores are unusual
-    cl_original_values = df[col].where((cl_temp > threshold) | (cl_temp < -threshold))
+#################################
+# Finding problems conditionally
 
-    # Initialize or update the 'problems' DataFrame
-    if 'Unusual ' + col not in problems:
-        problems['Unusual ' + col] = np.nan
+def performs_own_work(c):
+    """Returns a mask of members who perform any contracted work."""
+    return c.answered(contractor_columns, 'We perform').any(axis=1)
+
+
+vineyard_rules = [
+    # If using water they need a source of irrigation
+    Rule('Using water without irrigation',
+         'total irrigation', 'Total water used'),
+
+    # look for people entering 100 as a percentage instead of the actual
+    # amount of ha
+    #
+    # This is commented out because it only checks if they are equal to 1
+    # or 100. If percentage is actually extered instead of the ha. Then a
+    # calculation should be used to see if the vineyard isn't 1/100 and
+    # that they are entering the percentage...
+    #
+    # Rule('Using percentages instead of ha/ml', 'Data Reporting Year',
+    #      where=lambda c:
+    #      ((c['Total Vineyard Area'] != 100) &
+    #       (c['total irrigation'] == 100)) |
+    #      ((c['Total Vineyard Area'] != 1) &
+    #       (c['total irrigation'] == 1))),
+
+    # Look for people who have listed there developed hectares as separate
+    # from their total. i.e 5ha crop with 1 ha developed and 6 ha
+    # irrigated
+    Rule('Not included developed hectares', 'Data Reporting Year',
+         where=lambda c:
+         (c['Total Vineyard Area'] +
+          c['New development / redevelopment (ha)'] ==
+          c['total irrigation']) |
+         (c['Total Vineyard Area'] +
+          c['New development / redevelopment (ha)'] ==
+          c['total cover'])),
+
+    # ML water entered as irrigated ha as well (ignore this if it is 1 ML
+    # per 1 ha, as the ratio will make the ML = ha irrigated)
+    Rule('Area irrigated entered as ML used', 'Total water used',
+         where=lambda c:
+         (c['Total Vineyard Area'] / c['Total water used'] != 1) &
+         (c['Total water used'] == c['total irrigation'])),
+
+    # - Irrigated land needs to add up to ha of crop - it can go over 100%
+    Rule('Irrigated land does not add up to ha of crop',
+         'Data Reporting Year',
+         where=lambda c:
+         c['total irrigation'] < c['Total Vineyard Area']),
+
+    # - If they have only one source it needs to add up to 100%
+    Rule('Irrigated area below 100% when using single system',
+         'Data Reporting Year',
+         where=lambda c:
+         (c['irrigation count'] == 1) &
+         (c['total irrigation'] !=
+          np.round(c['Total Vineyard Area'].astype(float), 3))),
+
+    # total vineyard not harvested was more than vineyard total area
+    Rule('area not harvested was more than total area',
+         'Data Reporting Year',
+         where=lambda c:
+         c['area not harvested'] > c['Total Vineyard Area']),
+
+    # Rule('Total area harvested greater than vineyard size',
+    #      'Data Reporting Year',
+    #      where=lambda c:
+    #      c['total irrigation'] > c['Total Vineyard Area']),
+
+    # Undervine
+    # Total undervine vs total ha. Has to add up to 100%
+    # total ha vs inter row is 100% ha
+    # exclude livestock and include livestock
+    Rule('total undervine does not add up to vineyard area',
+         'Data Reporting Year',
+         where=lambda c:
+         (c['total cover'] < c['Total Vineyard Area']) &
+         (c['total cover'] + c['Livestock grazing (ha)'] !=
+          c['Total Vineyard Area'])),
+
+    # Other was not filled out for undervine
+    Rule('Undervine Other is not filled out',
+         'Other',
+         'If you selected other, please tell us what you are using'
+         ' undervine'),
+
+    # contractors
+    Rule('No fuel and No contractors',
+         None, 'total fuel', where=performs_own_work),
+    Rule('No Diesel and No contractors',
+         None, 'Diesel (L)', where=performs_own_work),
+
+    Rule('No irrigation', None, 'total irrigation'),
+
+    # TODO
+    # If some was not harvested then how much was not harvested
+    Rule('Labelled harvested without yield',
+         'Was any of your vineyard NOT harvested last season?',
+         'Grapes harvested (t)',
+         where=lambda c:
+         c.answered(['Was any of your vineyard NOT harvested last season?'],
+                    'No')[:, 0]),
+
+    Rule('No Electricity from the grid and no Solar',
+         None, 'Solar (kWh)',
+         where=lambda c: c.missing('Electricity from the grid (kWh)')),
+
+    Rule('Diesel irrigation and no diesel use',
+         'Diesel (ha)', 'Diesel (L)'),
+
+    Rule('Electric irrigation and no elctricity from grid used',
+         'Electricity (ha)', 'Electricity from the grid (kWh)'),
+
+    #TODO
+    # This compares Solar (kWh) with itself so it never flags anything
+    Rule('Solar irrigation and no solar electricity used',
+         'Solar (kWh)', 'Solar (kWh)'),
+
+    #TODO
+    # - If there is no Electricity from the grid (kWh) they have to use solar
+    # I am not sure if the above is done correctly.
+
+    Rule('23/24', 'Paid At'),
+]
+
+
+
+def output_problems(problems):
+    """Returns the problems with the rows without any problems dropped,
+    indexed by the zero padded Membership Number used in the output."""
+    problems = problems.dropna(axis=0, how='all')
+    problems.index = problems.index.astype(str).str.zfill(5)
+    return problems
+
+
+Validation = namedtuple(
+    'Validation',
+    ['name', 'transform', 'metrics', 'groupings', 'rules', 'suffix',
+     'report'],
+    defaults=('', 'value'))
+Validation.__doc__ = """The checks run on a sheet.
+
+Args:
+    name: the sheet name used in reports.
+    transform: a function deriving the checked columns from the sheet.
+    metrics: the columns checked for unusual values.
+    groupings: the (column, minimum_count) pairs metrics are compared
+        within, see `outliers.unusual`.
+    rules: the `rules.Rule`s checked.
+    suffix: appended to the 'Unusual <col>' column names.
+    report: 'value' or 'zscore', what unusual columns hold.
+"""
 
-    # Fill with the original values from the unusual z-scores
-    problems['Unusual ' + col].fillna(cl_original_values, inplace=True)
-    problems['Unusual ' + col].fillna(original_values, inplace=True)
 
-    # Clear temporary variables for the next iteration
-    df_temp = None
-    cl_temp = None
+Settings = namedtuple(
+    'Settings',
+    ['threshold', 'workers', 'outlier_method', 'sketch_dirs', 'fallback',
+     'cube_dirs'],
+    defaults=(threshold, None, 'zscore', (), False, ()))
+Settings.__doc__ = """How problems are found in a sheet, see `validate`.
+
+Args:
+    threshold: the z score beyond which a value is unusual.
+    workers: threads the outlier metrics and rules of a sheet are spread
+        over, None runs them one after another.
+    outlier_method: 'zscore' compares values with the mean and standard
+        deviation of their group, 'mad' and 'quantile' with the group's
+        quantile sketches, see `sketch`.
+    sketch_dirs: directories of sketches saved by sketch.py to score
+        against, a subdirectory per sheet. The sketches of the data
+        itself when empty.
+    fallback: score each value against only the most specific grouping
+        with enough values, GI Region then Climate then every member,
+        see `cube`.
+    cube_dirs: directories of cubes saved by cube.py to score against
+        with `fallback`. The cube of the data itself when empty.
+"""
 
-#################################
-# Finding problems conditionally
 
-# If using water they need a source of irrigation
-problems['Using water without irrigation'] = cond_problem(
-    df['total irrigation'], df['Total water used'])
-
-# look for people entering 100 as a percentage instead of the actual
-# amount of ha
-# 
-# This is commented out because it only checks if they are equal to 1
-# or 100. If percentage is actually extered instead of the ha. Then a
-# calculation should be used to see if the vineyard isn't 1/100 and
-# that they are entering the percentage...
-# 
-# problems['Using percentages instead of ha/ml'] = np.nan
-# df_conc = pd.concat(
-#     [df[df['Total Vineyard Area']!=100][df['total irrigation']==100]
-#     , df[df['Total Vineyard Area']!=1][df['total irrigation']==1]]
-# )
-# 
-problems['Using percentages instead of ha/ml'] = cond_problem(
-    df_conc[
-        ~df_conc.index.duplicated(
-            keep='first')]['Data Reporting Year']
-    , problems['Using percentages instead of ha/ml']
-)
-
-# Look for people who have listed there developed hectares as separate
-# from their total. i.e 5ha crop with 1 ha developed and 6 ha
-# irrigated
-problems['Not included developed hectares'] = np.nan
-df_conc = pd.concat([df[
-            df['Total Vineyard Area'] +
-            df['New development / redevelopment (ha)']
-            == df['total irrigation']],
-        df[df['Total Vineyard Area'] +
-            df['New development / redevelopment (ha)']
-            == df['total cover']]],
-        axis=0)
-problems['Not included developed hectares'] = cond_problem(
-    df_conc[
-        ~df_conc.index.duplicated(
-            keep='first')]['Data Reporting Year']
-    , problems['Not included developed hectares']
-)
-
-# ML water entered as irrigated ha as well (ignore this if it is 1 ML
-# per 1 ha, as the ratio will make the ML = ha irrigated)
-problems['Area irrigated entered as ML used'] = np.nan
-problems['Area irrigated entered as ML used'] = cond_problem(
-    df[
-        df['Total Vineyard Area'] / df['Total water used'] != 1][
-        df['Total water used'] == df['total irrigation']
-        ]['Total water used'],
-    problems['Area irrigated entered as ML used'])
-
-# - Irrigated land needs to add up to ha of crop - it can go over 100%
-problems['Irrigated land does not add up to ha of crop'] = np.nan
-problems['Irrigated land does not add up to ha of crop'] = \
-    cond_problem(
-        df[df['total irrigation'] < df['Total Vineyard Area']]
-        ['Data Reporting Year']
-        , problems['Irrigated land does not add up to ha of crop']
-    )
-
-# - If they have only one source it needs to add up to 100%
-problems['Irrigated area below 100% when using single system'] = \
-    np.nan
-problems['Irrigated area below 100% when using single system'] = \
-    cond_problem(
-        df[df['irrigation count'] == 1]
-        [df['total irrigation'] != round(
-            df['Total Vineyard Area'], 3)]
-        ['Data Reporting Year']
-        , problems['Irrigated area below '
-                   '100% when using single system']
-    )
-
-# total vineyard not harvested was more than vineyard total area
-problems['area not harvested was more than total area'] = np.nan
-problems['area not harvested was more than total area'] = \
-    cond_problem(
-        df[df['area not harvested'] > df['Total Vineyard Area']]
-        ['Data Reporting Year']
-        , problems['area not harvested was more than total area']
-    )
+def thread_pool(workers):
+    """Returns a pool of `workers` threads, or a context giving None to
+    run serially when there are fewer than two."""
+    if not workers or workers < 2:
+        return contextlib.nullcontext()
+    return ThreadPoolExecutor(workers)
+
+
+def robust_sketches(df, validation, sketch_dirs=()):
+    """Returns the quantile sketches of each grouping of a validation,
+    read from `sketch_dirs` or else built from the transformed sheet."""
+    if sketch_dirs:
+        return sketch.load_all(
+            [os.path.join(directory, validation.name)
+             for directory in sketch_dirs], validation)
+    return [sketch.GroupSketches(by, validation.metrics).add(df)
+            for by, minimum_count in validation.groupings]
+
+
+def fallback_cube(df, validation, cube_dirs=()):
+    """Returns the statistics cube of a validation, read from
+    `cube_dirs` or else built from the transformed sheet."""
+    if cube_dirs:
+        return cube.load_all(cube_dirs, validation)
+    return cube.Cube(cube.levels(validation.groupings),
+                     validation.metrics).add(df)
+
+
+def outlier_values(df, validation, pool=None, settings=None):
+    """Returns the unusual values of a transformed sheet as a matrix.
+
+    Args:
+        df: the sheet as returned by the validation's transform.
+        validation: the `Validation` for the sheet.
+        pool: an optional executor the metrics are spread over.
+        settings: the `Settings` of the run, the defaults if None.
+
+    Returns:
+        A float array with a column per metric, see
+        `outliers.unusual_values`.
+    """
+    settings = settings or Settings()
+    sketches = statistics = None
+    if settings.fallback:
+        with instrument.stage('cube ({})'.format(validation.name), len(df)):
+            statistics = fallback_cube(df, validation, settings.cube_dirs)
+    elif settings.outlier_method != 'zscore':
+        with instrument.stage('sketches ({})'.format(validation.name),
+                              len(df)):
+            sketches = robust_sketches(df, validation, settings.sketch_dirs)
+    with instrument.stage('outliers ({})'.format(validation.name),
+                          len(df)) as record:
+        values = unusual_values(
+            df, validation.metrics, validation.groupings,
+            settings.threshold, validation.report, pool=pool,
+            sketches=sketches, method=settings.outlier_method,
+            cube=statistics)
+        record['rows out'] = int((~np.isnan(values)).any(axis=1).sum())
+    return values
+
+
+def find_problems(data, validation, settings=None):
+    """Returns the problems found in a sheet as a sparse store.
+
+    Args:
+        data: the sheet as returned by data_in.
+        validation: the `Validation` for the sheet.
+        settings: the `Settings` of the run, the defaults if None.
+
+    Returns:
+        A `problems.Problems` of every unusual value and rule flag.
+    """
+    with instrument.stage('transform ({})'.format(validation.name),
+                          len(data)) as record:
+        df = validation.transform(data)
+        record['rows out'] = len(df)
+    settings = settings or Settings()
+    found = Problems(df.index)
+    # The metrics and rules are independent, so with `workers` they are
+    # evaluated on threads sharing the transformed frame. NumPy releases
+    # the GIL while it works and the results keep the table order.
+    with thread_pool(settings.workers) as pool:
+        values = outlier_values(df, validation, pool, settings)
+        found.add_values(
+            unusual_names(validation.metrics, validation.suffix), values)
+        with instrument.stage('rules ({})'.format(validation.name),
+                              len(df)) as record:
+            flagged = flags(validation.rules, df, pool)
+            found.add_flags([rule.name for rule in validation.rules], flagged)
+            record['rows out'] = int(flagged.any(axis=1).sum())
+    return found
+
+
+def validate(data, validation, settings=None):
+    """Returns the problems found in a sheet.
+
+    Args:
+        data: the sheet as returned by data_in.
+        validation: the `Validation` for the sheet.
+        settings: the `Settings` of the run, the defaults if None.
+
+    Returns:
+        A DataFrame of the problems of each member with any.
+    """
+    return output_problems(find_problems(data, validation, settings).wide())
+
+
+# Regions are only compared when they have more than minimum_count
+# values, climates are always compared
+vineyard = Validation(
+    'Vineyard', data_transform, vineyard_metrics,
+    [('GI Region', minimum_count), ('Climate', 0)], vineyard_rules)
+
+
+def validate_vineyard(data, settings=None):
+    """Returns the problems found in a Vineyard sheet.
+
+    Args:
+        data: the Vineyard sheet as returned by data_in.
+        settings: the `Settings` of the run, the defaults if None.
+
+    Returns:
+        A DataFrame of the problems of each member with any.
+    """
+    return validate(data, vineyard, settings)
 
-"""
-problems['Total area harvested greater than vineyard size'] = np.nan
-problems['Total area harvested greater than vineyard size'] = \
-    cond_problem(
-        df[df['total irrigation'] > df['Total Vineyard Area']]
-        ['Data Reporting Year']
-        , problems['Total area harvested greater than vineyard size']
-    )"""
-
-
-# Undervine
-# Total undervine vs total ha. Has to add up to 100%
-# total ha vs inter row is 100% ha
-# exclude livestock and include livestock
-problems['total undervine does not add up to vineyard area'] = np.nan
-problems['total undervine does not add up to vineyard area'] = \
-cond_problem(
-    df[df['total cover'] < df['Total Vineyard Area']]
-    [df['total cover'] + df['Livestock grazing (ha)'] !=
-        df['Total Vineyard Area']]
-    ['Data Reporting Year']
-    , problems['total undervine does not add up to vineyard area']
-)
-
-# Other was not filled out for undervine
-problems['Undervine Other is not filled out'] = cond_problem(
-    df['Other'],
-    df['If you selected other, please tell us what you are using'
-       ' undervine'])
-
-# contractors
-df['Mechanical harvesting'] = df['Mechanical harvesting'].fillna(0)
-df.loc[df['Mechanical harvesting'] != 'We perform',
-       'Mechanical harvesting'] = 0
-df.loc[df['Mechanical harvesting'] == 'We perform',
-       'Mechanical harvesting'] = 1
-
-df['Mechanical pruning'] = df['Mechanical pruning'].fillna(0)
-df.loc[df['Mechanical pruning'] != 'We perform',
-       'Mechanical pruning'] = 0
-df.loc[df['Mechanical pruning'] == 'We perform',
-       'Mechanical pruning'] = 1
-
-df['Slashing'] = df['Slashing'].fillna(0)
-df.loc[df['Slashing'] != 'We perform',
-       'Slashing'] = 0
-df.loc[df['Slashing'] == 'We perform',
-       'Slashing'] = 1
-
-df['Fungicide spraying'] = df['Fungicide spraying'].fillna(0)
-df.loc[df['Fungicide spraying'] != 'We perform',
-       'Fungicide spraying'] = 0
-df.loc[df['Fungicide spraying'] == 'We perform',
-       'Fungicide spraying'] = 1
-
-df['Insecticide spraying'] = df['Insecticide spraying'].fillna(0)
-df.loc[df['Insecticide spraying'] != 'We perform',
-       'Insecticide spraying'] = 0
-df.loc[df['Insecticide spraying'] == 'We perform',
-       'Insecticide spraying'] = 1
-
-df['Herbicide spraying'] = df['Herbicide spraying'].fillna(0)
-df.loc[df['Herbicide spraying'] != 'We perform',
-       'Herbicide spraying'] = 0
-df.loc[df['Herbicide spraying'] == 'We perform',
-       'Herbicide spraying'] = 1
-
-col1 = df['Mechanical harvesting'] + \
-       df['Mechanical pruning'] + df['Slashing'] + \
-       df['Fungicide spraying'] + df['Insecticide spraying'] + \
-       df['Herbicide spraying']
-
-col1 = col1.astype(float).replace({0: np.nan})
-
-col2 = df['total fuel'].replace({0: np.nan})
-problems['No fuel and No contractors'] = cond_problem(col1, col2)
-
-col2 = df['Diesel (L)'].replace({0: np.nan})
-problems['No Diesel and No contractors'] = cond_problem(col1, col2)
-
-problems['No irrigation'] = df[df['total irrigation'].isnull()][
-    'total irrigation'].replace({np.nan: 'Yes'})
-
-# TODO
-# If some was not harvested then how much was not harvested
-problems['Labelled harvested without yield'] = cond_problem(
-    df[df['Was any of your vineyard NOT harvested last season?']
-       == 'No'][
-        'Was any of your vineyard NOT harvested last season?'],
-    df['Grapes harvested (t)']
-)
-
-col1 = df[df['Electricity from the grid (kWh)'].isnull()][
-    'Electricity from the grid (kWh)']
-col1 = col1.replace({np.nan: 0})
-
-problems['No Electricity from the grid and no Solar'] = cond_problem(
-    col1,
-    df['Solar (kWh)'])
-
-problems['Diesel irrigation and no diesel use'] = cond_problem(
-    df['Diesel (ha)'], df['Diesel (L)'])
-
-problems['Electric irrigation and no elctricity from grid used'] = \
-    cond_problem(df['Electricity (ha)'], df['Electricity from the grid (kWh)'])
-
-problems['Solar irrigation and no solar electricity used'] = \
-    cond_problem(df['Solar (kWh)'], df['Solar (kWh)'])
-
-#TODO
-# - If there is no Electricity from the grid (kWh) they have to use solar
-# I am not sure if the above is done correctly.
-
-problems["23/24"] = df["Paid At"].apply(lambda x: 'Yes' if pd.notnull(x) else None)
-
-###############################
-# Create the output Excel sheet
-problems = problems.dropna(axis=0, how='all')
-problems.index = problems.index.astype(str).str.zfill(5)
-problems.to_excel('problems_vineyard.xlsx')
 
 ######################################################################
 #                                                                   #
@@ -503,98 +620,202 @@ problems.to_excel('problems_vineyard.xlsx')
 ##################
 # Winery issues
 
-df = data_in(sheet_name='Winery')
-
 ###################
 # Data transformations
-#df = df[~df['Paid At'].isnull()]
-df = df.fillna(0)
 
-df['% Extraction'] = df['Full winemaking (kL)'] / df['Tonnes crushed']
+winery_derived = [
+    '% Extraction', 'water / crushed', 'litre of wine',
+    'water / litre of wine', 'electricity', 'electricity / tonne',
+    'electicity / litre of wine', 'fuel / co2',
+    'total fuel / CO2 / Tonne crush', 'used / waste']
+
 
-df['water / crushed'] = df['Water used (kL)'] / df['Tonnes crushed']
+def winery_transform(df):
+    """Derives the checked Winery columns, see `data_transform`."""
+    #df = df[~df['Paid At'].isnull()]
+    block, d = derived_block(df, winery_derived)
 
-df['litre of wine'] = df['Full winemaking (kL)'] + \
-    df['First stage winemaking (kL)'] + df['Final stage winemaking (kL)']
-df['water / litre of wine'] = df['Water used (kL)'] / \
-    df['litre of wine']
+    d['% Extraction'][:] = ratio(df['Full winemaking (kL)'],
+                                 df['Tonnes crushed'])
 
-df['electricity'] = df['Other'] + df['Wind'] + df['Solar'] + \
-    df['Renewable energy generated onsite and exported to the grid'] + \
-    df['Electricity from the grid']
-df['electricity / tonne'] = df['electricity'] / df['Tonnes crushed']
+    d['water / crushed'][:] = ratio(df['Water used (kL)'],
+                                    df['Tonnes crushed'])
 
-df['electicity / litre of wine'] = df['electricity'] / \
-    df['litre of wine']
+    d['litre of wine'][:] = total(df, [
+        'Full winemaking (kL)', 'First stage winemaking (kL)',
+        'Final stage winemaking (kL)'])
+    d['water / litre of wine'][:] = ratio(df['Water used (kL)'],
+                                          d['litre of wine'])
 
-df['fuel / co2'] = (df['Petrol (L)'] * 2.289) + \
-                   (df['Diesel (L)'] * 2.694) + \
-                   (df['Natural gas'] * 51.348) + \
-                   (df['LPG'] * 1.578)
-df['total fuel / CO2 / Tonne crush'] = df['fuel / co2'] / \
-    df['Tonnes crushed']
+    d['electricity'][:] = total(df, [
+        'Other', 'Wind', 'Solar',
+        'Renewable energy generated onsite and exported to the grid',
+        'Electricity from the grid'])
+    d['electricity / tonne'][:] = ratio(d['electricity'],
+                                        df['Tonnes crushed'])
 
-df['used / waste'] = df['Wastewater recycled (kL)'] / df['Water used (kL)']
+    d['electicity / litre of wine'][:] = ratio(d['electricity'],
+                                               d['litre of wine'])
 
-df['Size'] = df['Tonnes crushed'].apply(size)
+    # The emission factors of each winery's reporting year
+    d['fuel / co2'][:] = total(
+        df, ['Petrol (L)', 'Diesel (L)', 'Natural gas', 'LPG'],
+        factors(df, ['Petrol', 'Diesel', 'Natural gas', 'LPG']).to_numpy())
+    d['total fuel / CO2 / Tonne crush'][:] = ratio(d['fuel / co2'],
+                                                   df['Tonnes crushed'])
 
-df = df.replace({0: np.nan})
-problems = pd.DataFrame(index=df.index)
+    d['used / waste'][:] = ratio(df['Wastewater recycled (kL)'],
+                                 df['Water used (kL)'])
+
+    # A blank tonnes crushed is a small winery
+    return join_derived(df, block, winery_derived,
+                        size(df['Tonnes crushed'].fillna(0)).rename('Size'))
 
 ########################
 # Finding errors using radicals
-for col in [
-    '% Extraction',
-    'water / crushed',
-    'water / litre of wine',
-    'electricity / tonne',
-    'electicity / litre of wine',
-    'total fuel / CO2 / Tonne crush',
-    'used / waste']:
-    gp = df.groupby('Size')
-    df_temp = gp[col].transform(zscore)
-    df_temp = pd.concat(
-        (df_temp[df_temp > threshold], df_temp[df_temp < -threshold]),
-        axis=0)
-
-    sz_temp = df[col].transform(zscore)
-    sz_temp = pd.concat(
-        (sz_temp[sz_temp > threshold], sz_temp[sz_temp < -threshold]),
-        axis=0)
-
-    problems['Unusual ' + col + ' (both)'] = np.nan
-    problems['Unusual ' + col + ' (both)'].fillna(sz_temp, inplace=True)
-    problems['Unusual ' + col + ' (both)'].fillna(df_temp, inplace=True)
-
-    df_temp = None
-    sz_temp = None
+winery_metrics = ['% Extraction',
+                  'water / crushed',
+                  'water / litre of wine',
+                  'electricity / tonne',
+                  'electicity / litre of wine',
+                  'total fuel / CO2 / Tonne crush',
+                  'used / waste']
 
 #################################
 # Finding problems conditionally
 
-col1 = df[df['Electricity from the grid'].isnull()][
-    'Electricity from the grid']
-col1 = col1.replace({np.nan: 0})
-
-problems['No Electricity from the grid and no Solar'] = cond_problem(
-    col1,
-    df['Solar'])
-
-col = df.loc[df['Size'] != 'Small', 'Refrigerant'].copy()
-col = col.fillna(0)
-for i in range(1, 5):
-    col += df['Refrigerant.{}'.format(i)].fillna(0)
-problems['No Refridgerants (Medium+ size)'] = col[col == 0]
-problems['No Refridgerants (Medium+ size)'] = \
-    problems['No Refridgerants (Medium+ size)'].replace(
-    {0: 'Yes'}
-)
-
-problems['No fuel'] = df[df['fuel / co2'].isnull()][
-    'fuel / co2'].replace({np.nan: 'Yes'})
-
-###############################
-# Create the output Excel sheet
-problems = problems.dropna(axis=0, how='all')
-problems.index = problems.index.astype(str).str.zfill(5)
-problems.to_excel('problems_winery.xlsx')
+refrigerant_columns = ['Refrigerant'] + \
+    ['Refrigerant.{}'.format(i) for i in range(1, 5)]
+
+winery_rules = [
+    Rule('No Electricity from the grid and no Solar',
+         None, 'Solar',
+         where=lambda c: c.missing('Electricity from the grid')),
+
+    Rule('No Refridgerants (Medium+ size)',
+         where=lambda c:
+         (c['Size'] != 'Small') &
+         (np.nansum([c[col].astype(float) for col in refrigerant_columns],
+                    axis=0) == 0)),
+
+    Rule('No fuel', None, 'fuel / co2'),
+]
+
+
+# Compared against every winery and then within each size, the z score
+# is reported rather than the value
+winery = Validation(
+    'Winery', winery_transform, winery_metrics, [(None, 0), ('Size', 0)],
+    winery_rules, suffix=' (both)', report='zscore')
+
+
+def validate_winery(data, settings=None):
+    """Returns the problems found in a Winery sheet.
+
+    Args:
+        data: the Winery sheet as returned by data_in.
+        settings: the `Settings` of the run, the defaults if None.
+
+    Returns:
+        A DataFrame of the problems of each member with any.
+    """
+    return validate(data, winery, settings)
+
+
+def settings_arguments(parser):
+    """Adds the options of the `Settings` to a command line."""
+    parser.add_argument('--workers', type=int, default=None,
+                        help='threads to check the metrics and rules of a '
+                             'sheet on')
+    parser.add_argument('--outliers', choices=['zscore'] + sketch.methods,
+                        default='zscore',
+                        help='how unusual values are found, see sketch.py '
+                             'for the robust methods')
+    parser.add_argument('--sketches', nargs='+', metavar='DIR', default=(),
+                        help='score the robust methods against sketches '
+                             'saved by sketch.py')
+    parser.add_argument('--fallback', action='store_true',
+                        help='score each value against the most specific '
+                             'grouping with enough values')
+    parser.add_argument('--cubes', nargs='+', metavar='DIR', default=(),
+                        help='score --fallback against cubes saved by '
+                             'cube.py')
+
+
+def parse_settings(parser, args):
+    """Returns the `Settings` given on a command line with the options
+    of `settings_arguments`."""
+    if args.fallback and args.outliers != 'zscore':
+        parser.error('--fallback scores z scores, not --outliers {}'.format(
+            args.outliers))
+    if args.cubes and not args.fallback:
+        parser.error('--cubes are only scored against with --fallback')
+    return Settings(threshold, args.workers, args.outliers,
+                    tuple(args.sketches), args.fallback, tuple(args.cubes))
+
+
+def main():
+    """The command line, see `api` for the checks as a library."""
+    # The writers are only imported when writing, not by library callers
+    import writer
+
+    parser = argparse.ArgumentParser(
+        description='Finds problems in the SWA Vineyard and Winery data.')
+    parser.add_argument('path', nargs='?', default='data.xlsx',
+                        help='the workbook to check')
+    parser.add_argument('--format', choices=writer.formats, default='xlsx',
+                        help='the output format')
+    parser.add_argument('--combined', action='store_true',
+                        help='write one problems.xlsx with both sheets')
+    parser.add_argument('--write-memory', action='store_true',
+                        help='write each file again under tracemalloc to '
+                             'report its peak memory')
+    settings_arguments(parser)
+    parser.add_argument('--report',
+                        help='record each stage and save the run as JSON')
+    parser.add_argument('--profile', metavar='STAGE',
+                        help='run a stage, e.g. "rules (Vineyard)", under '
+                             'cProfile, implies --report')
+    parser.add_argument('--trace', metavar='STAGE',
+                        help='trace the allocations of a stage with '
+                             'tracemalloc, implies --report')
+    args = parser.parse_args()
+    settings = parse_settings(parser, args)
+
+    if not (args.report or args.profile or args.trace):
+        run(args.path, args.format, args.combined, settings,
+            args.write_memory)
+        return
+
+    with instrument.recording(args.profile, args.trace) as recorded:
+        run(args.path, args.format, args.combined, settings,
+            args.write_memory)
+    recorded.report()
+    recorded.save(args.report or 'run.json')
+
+
+def run(path='data.xlsx', format='xlsx', combined=False, settings=None,
+        write_memory=False):
+    """Checks both sheets of a workbook and writes the problems, with
+    the `Settings` given or the defaults, and with `write_memory` the
+    peak memory of writing each file, see `writer.write`."""
+    import writer
+
+    sheets = data_in(['Vineyard', 'Winery'], path)
+    for frame in sheets.values():
+        print(frame.head())
+    with instrument.stage('cross-sheet checks') as record:
+        across = crosscheck.validate(sheets)
+        record['rows out'] = len(across)
+
+    ###############################
+    # Create the output sheets
+    writer.write({'Vineyard': validate_vineyard(sheets['Vineyard'],
+                                                settings),
+                  'Winery': validate_winery(sheets['Winery'], settings),
+                  'Cross-sheet': across},
+                 format, combined=combined, memory=write_memory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Metrics declared as formulas and evaluated in dependency order.
+
+A metric is a name, a formula and its units. Formulas refer to sheet
+columns and other metrics by name in backticks, e.g.
+
+    Metric('Water Use (ML/ha)',
+           '`Total water used (ML)` / `Total Vineyard Area  (ha)`',
+           'ML/ha')
+
+A `MetricTable` works out which metrics each one needs, evaluates them in
+topological order on NumPy arrays, with numexpr when it is installed so
+each formula runs as one fused loop, and frees every intermediate that
+isn't a requested output as soon as nothing else needs it. After an
+input column changes, `update` recomputes only the metrics downstream of
+it.
+
+A formula may refer to its own name, which reads the sheet column of
+that name, so a metric can replace a column.
+"""
+import graphlib
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+Metric = namedtuple('Metric', ['name', 'formula', 'units'],
+                    defaults=('',))
+Metric.__doc__ = """A derived column.
+
+Args:
+    name: the column the metric is written to.
+    formula: an arithmetic expression, with columns and metrics named in
+        backticks. `nan` is a blank value.
+    units: the units of the result, for reports.
+"""
+
+reference = re.compile('`([^`]+)`')
+
+
+class MetricTable:
+    """The dependency graph of a table of metrics.
+
+    Args:
+        metrics: a list of `Metric`s.
+
+    Raises:
+        ValueError: if a name is repeated or the metrics depend on each
+            other in a cycle.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = {}
+        for metric in metrics:
+            if metric.name in self.metrics:
+                raise ValueError('metric {} is declared twice'.format(
+                    metric.name))
+            self.metrics[metric.name] = metric
+
+        self.references = {}
+        self.expressions = {}
+        for name, metric in self.metrics.items():
+            names = list(dict.fromkeys(reference.findall(metric.formula)))
+            variables = {ref: 'x{}'.format(i) for i, ref in enumerate(names)}
+            self.references[name] = variables
+            self.expressions[name] = reference.sub(
+                lambda match: variables[match.group(1)], metric.formula)
+
+        self.graph = {name: self.dependencies(name) for name in self.metrics}
+        try:
+            self.order = list(graphlib.TopologicalSorter(self.graph)
+                              .static_order())
+        except graphlib.CycleError as e:
+            raise ValueError('metrics depend on each other: {}'.format(
+                ' -> '.join(e.args[1])))
+        self.order = [name for name in self.order if name in self.metrics]
+
+    def __len__(self):
+        return len(self.metrics)
+
+    def dependencies(self, name):
+        """Returns the metrics a metric's formula refers to."""
+        return {ref for ref in self.references[name]
+                if ref in self.metrics and ref != name}
+
+    def inputs(self, name):
+        """Returns the sheet columns a metric's formula refers to."""
+        return {ref for ref in self.references[name]
+                if ref not in self.metrics or ref == name}
+
+    def needed(self, outputs):
+        """Returns the metrics needed to evaluate `outputs`, in
+        evaluation order."""
+        needed = set()
+        stack = list(outputs)
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.graph[name])
+        return [name for name in self.order if name in needed]
+
+    def downstream(self, columns):
+        """Returns the metrics affected by a change to sheet columns, in
+        evaluation order."""
+        affected = set()
+        for name in self.order:
+            if self.inputs(name) & set(columns) or \
+                    self.graph[name] & affected:
+                affected.add(name)
+        return [name for name in self.order if name in affected]
+
+    def evaluate(self, df, outputs=None, known=None):
+        """Evaluates metrics over a sheet.
+
+        Args:
+            df: the sheet holding the input columns.
+            outputs: the metrics to return, defaults to all of them.
+            known: a dict of arrays of metrics that are already
+                evaluated, which are used rather than recomputed.
+
+        Returns:
+            A DataFrame of the outputs with the index of `df`.
+        """
+        outputs = list(self.metrics) if outputs is None else list(outputs)
+        known = dict(known or {})
+        steps = [name for name in self.needed(outputs) if name not in known]
+
+        # An intermediate is freed after the last step that reads it
+        last_use = {}
+        for i, name in enumerate(steps):
+            for dependency in self.graph[name]:
+                last_use[dependency] = i
+
+        values = known
+        columns = {}
+        for i, name in enumerate(steps):
+            values[name] = self.evaluate_one(name, df, values, columns)
+            for dependency in self.graph[name]:
+                if last_use.get(dependency) == i and \
+                        dependency not in outputs:
+                    del values[dependency]
+
+        return pd.DataFrame({name: values[name] for name in outputs},
+                            index=df.index)
+
+    def evaluate_one(self, name, df, values, columns):
+        """Returns the array of one metric, reading sheet columns into
+        `columns` once."""
+        variables = {'nan': np.nan}
+        for ref, variable in self.references[name].items():
+            if ref in self.metrics and ref != name:
+                variables[variable] = values[ref]
+            else:
+                if ref not in columns:
+                    columns[ref] = df[ref].to_numpy(dtype=float,
+                                                    na_value=np.nan)
+                variables[variable] = columns[ref]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if numexpr is not None:
+                result = numexpr.evaluate(self.expressions[name],
+                                          local_dict=variables)
+            else:
+                result = eval(self.expressions[name], {'__builtins__': {}},
+                              variables)
+        return np.broadcast_to(np.asarray(result, dtype=float),
+                               (len(df),)).copy() \
+            if np.ndim(result) == 0 else result
+
+    def update(self, previous, df, changed, outputs=None):
+        """Re-evaluates only the metrics affected by changed columns.
+
+        Args:
+            previous: the DataFrame returned by the last `evaluate`.
+            df: the sheet with the changed columns.
+            changed: the names of the changed sheet columns.
+            outputs: the metrics to return, defaults to those of
+                `previous`.
+
+        Returns:
+            A DataFrame of the outputs.
+        """
+        outputs = list(previous.columns) if outputs is None else outputs
+        affected = set(self.downstream(changed))
+        known = {name: previous[name].to_numpy()
+                 for name in previous.columns if name not in affected}
+        return self.evaluate(df, outputs, known)
+
+    def units(self):
+        """Returns the units of each metric as a Series."""
+        return pd.Series({name: metric.units
+                          for name, metric in self.metrics.items()},
+                         name='units')
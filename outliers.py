@@ -0,0 +1,169 @@
+"""Group z-score outlier detection for many metric columns in one pass.
+
+Rather than a groupby/transform per metric, the group keys are
+factorized once and the counts, means and standard deviations of every
+metric are reduced together with np.bincount.
+"""
+import numpy as np
+import pandas as pd
+
+import instrument
+from stats import group_moments, metric_values
+
+
+def group_codes(df, by=None):
+    """Returns integer group codes and the number of groups.
+
+    Args:
+        df: the DataFrame holding the grouping column.
+        by: the grouping column, or None for a single group of all rows.
+
+    Returns:
+        A tuple of an array of codes, -1 where the key is missing, and
+        the number of groups.
+    """
+    if by is None:
+        return np.zeros(len(df), dtype=np.intp), 1
+    if isinstance(df[by].dtype, pd.CategoricalDtype):
+        # Unused categories are empty groups, which are never scored
+        return df[by].cat.codes.to_numpy(dtype=np.intp), \
+            len(df[by].cat.categories)
+    codes, uniques = pd.factorize(df[by])
+    return codes, len(uniques)
+
+
+def group_zscores(values: np.array, codes: np.array, ngroups: int,
+                  minimum_count=0):
+    """Returns the z score of each value within its group.
+
+    Matches `transform(zscore)` on a groupby: missing values are
+    ignored and the standard deviation uses one degree of freedom.
+
+    Args:
+        values: a 2d array with a column per metric.
+        codes: the group of each row, -1 for rows without a group.
+        ngroups: the number of groups.
+        minimum_count: groups with this many values or fewer in a metric
+            get no z scores for that metric.
+
+    Returns:
+        A 2d array of z-scores shaped like `values`.
+    """
+    count, mean, m2 = group_moments(values, codes, ngroups)
+    rows = np.where(codes >= 0, codes, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(m2 / (count - 1))
+        std[count <= minimum_count] = np.nan
+        z = (values - mean[rows]) / std[rows]
+
+    z[codes < 0] = np.nan
+    return z
+
+
+def flag(values, z, result, threshold, report):
+    """Writes the values or z scores above the threshold that no earlier
+    grouping flagged into `result`, returning the new flags."""
+    flagged = (np.abs(z) > threshold) & np.isnan(result)
+    result[flagged] = (values if report == 'value' else z)[flagged]
+    return flagged
+
+
+def unusual_metric(values, codes, groupings, threshold, report):
+    """Returns the unusual values of the metrics in `values`, see
+    `unusual`."""
+    result = np.full(values.shape, np.nan)
+    for (group, ngroups), (by, minimum_count) in zip(codes, groupings):
+        z = group_zscores(values, group, ngroups, minimum_count)
+        flag(values, z, result, threshold, report)
+    return result
+
+
+def unusual_values(df, cols, groupings, threshold=2.5, report='value',
+                   stats=None, pool=None, sketches=None, method='mad',
+                   cube=None):
+    """Returns the values that are unusual within any of the groupings
+    as a matrix, see `unusual` for the arguments.
+
+    Returns:
+        A float array with a column per metric holding the value or z
+        score where it is unusual and NaN elsewhere.
+    """
+    values = metric_values(df, cols)
+    if cube is not None:
+        result = np.full(values.shape, np.nan)
+        with instrument.stage('by cube', len(df)) as record:
+            flagged = flag(values, cube.zscores(df), result, threshold,
+                           report)
+            record['rows out'] = int(flagged.any(axis=1).sum())
+            record['flagged'] = dict(zip(cols, flagged.sum(axis=0).tolist()))
+        return result
+
+    if pool is not None and stats is None and sketches is None:
+        # The group codes are worked out once for every metric
+        codes = [group_codes(df, by) for by, minimum_count in groupings]
+        return np.hstack(list(pool.map(
+            lambda i: unusual_metric(values[:, [i]], codes, groupings,
+                                     threshold, report),
+            range(len(cols)))))
+
+    result = np.full(values.shape, np.nan)
+    for i, (by, minimum_count) in enumerate(groupings):
+        with instrument.stage('by {}'.format(by or 'all'), len(df)) \
+                as record:
+            if sketches is not None:
+                z = sketches[i].zscores(df, minimum_count, method,
+                                        threshold)
+            elif stats is None:
+                codes, ngroups = group_codes(df, by)
+                z = group_zscores(values, codes, ngroups, minimum_count)
+            else:
+                z = stats[i].zscores(df, minimum_count)
+            flagged = flag(values, z, result, threshold, report)
+            # Every metric is scored in the same pass, so they are timed
+            # together and only their flags are counted separately
+            record['rows out'] = int(flagged.any(axis=1).sum())
+            record['flagged'] = dict(zip(cols, flagged.sum(axis=0).tolist()))
+
+    return result
+
+
+def unusual(df, cols, groupings, threshold=2.5, suffix='', report='value',
+            stats=None, pool=None, sketches=None, method='mad', cube=None):
+    """Returns the values that are unusual within any of the groupings.
+
+    Args:
+        df: the transformed DataFrame.
+        cols: the metric columns to check.
+        groupings: a list of (column, minimum_count) pairs, a column of
+            None compares each row with every other row.
+        threshold: the absolute z score above which a value is unusual.
+        suffix: appended to each 'Unusual <col>' output column name.
+        report: 'value' to report the original value, or 'zscore' to
+            report the z score from the first grouping that flagged it.
+        stats: an optional list of `stats.GroupStats`, one per grouping,
+            to score against instead of the statistics of `df`.
+        pool: an optional executor to score each metric on, e.g. a
+            ThreadPoolExecutor. The metrics are read from `df` once and
+            shared with the workers.
+        sketches: an optional list of `sketch.GroupSketches`, one per
+            grouping, to score against with robust scores instead of z
+            scores.
+        method: the robust score used with `sketches`, see
+            `sketch.GroupSketches.zscores`.
+        cube: an optional `cube.Cube` to score each value against the
+            most specific level with enough values instead of against
+            every grouping.
+
+    Returns:
+        A DataFrame with an 'Unusual <col>' column per metric holding
+        the value or z score where it is unusual and NaN elsewhere.
+    """
+    return pd.DataFrame(
+        unusual_values(df, cols, groupings, threshold, report, stats, pool,
+                       sketches, method, cube),
+        index=df.index, columns=unusual_names(cols, suffix))
+
+
+def unusual_names(cols, suffix=''):
+    """Returns the 'Unusual <col>' column name of each metric."""
+    return ['Unusual ' + col + suffix for col in cols]
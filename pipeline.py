@@ -0,0 +1,480 @@
+"""The checks as a graph of stages with checkpoints between them.
+
+Each sheet goes through
+
+    load -> clean -> transform -> outliers -> export
+                             \\-> rules    -/
+
+and the cleaned sheets meet again in the cross-sheet checks. Every stage
+output is checkpointed as an Arrow IPC file in `checkpoint_dir`, keyed by
+a hash of the keys of the stage's inputs and of what the stage runs: the
+code of its functions and of the functions and classes they use, the
+data files they read, e.g. climates.csv, and its settings, e.g. the
+rules, metrics, threshold and sketch files, see `fingerprint`. The
+workbook's content hash keys the load stage, and each workbook, by
+absolute path, has its own checkpoints.
+
+A rerun works back from the exports and stops at the first stage with a
+checkpoint for its key, so after changing a rule only the rules and
+export stages run again, from the transformed sheets read back from
+their checkpoints. Checkpoints are written to a temporary file and
+renamed, so an interrupted run never leaves a partial one, and are
+memory mapped when read. Older checkpoints of a stage are removed when
+a new one is written. Frames Arrow can't store are passed on without a
+checkpoint, and --full ignores every checkpoint.
+
+Usage:
+    python pipeline.py data.xlsx --format csv
+"""
+import argparse
+import dis
+import glob
+import hashlib
+import inspect
+import os
+import sys
+import time
+import types
+from collections import namedtuple
+
+import pandas as pd
+
+import crosscheck
+import cube
+import instrument
+import main
+import schema
+from cache import file_hash
+from problems import Problems
+from outliers import unusual_names
+from rules import flags
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+#############
+# variables
+
+checkpoint_dir = '.checkpoints'
+# Code outside this directory, e.g. pandas, is keyed by name only
+here = os.path.dirname(os.path.abspath(__file__))
+sheet_names = ['Vineyard', 'Winery']
+# The sheets a member's answers are checked across
+cross_sheet = 'Cross-sheet'
+
+Stage = namedtuple('Stage', ['name', 'inputs', 'run', 'settings'],
+                   defaults=((),))
+Stage.__doc__ = """A step of the pipeline.
+
+Args:
+    name: the stage name, '<sheet>: <step>'.
+    inputs: the names of the stages whose outputs `run` takes, in order.
+    run: a function of the input frames returning a DataFrame.
+    settings: anything else the output depends on, e.g. functions `run`
+        reaches through a module, rules or a threshold.
+"""
+
+
+def step(sheet, name):
+    """Returns the name of a step of a sheet's stages."""
+    return sheet + crosscheck.separator + name
+
+
+def local(value):
+    """Returns whether a function or class is defined in this repository,
+    rather than a library whose code isn't followed."""
+    module = value if isinstance(value, types.ModuleType) else \
+        sys.modules.get(getattr(value, '__module__', None))
+    return os.path.dirname(os.path.abspath(
+        getattr(module, '__file__', None) or '')) == here
+
+
+def followed(value):
+    """Returns whether a name refers to something a key should follow."""
+    return isinstance(value, (types.FunctionType, type, int, float, str,
+                              list, tuple, dict, set, frozenset)) or \
+        hasattr(value, '__wrapped__')
+
+
+def referred(code, namespace):
+    """Returns what code refers to by global name, and the attributes it
+    reads straight off modules of this repository, e.g. the function of
+    `main.output_problems`."""
+    module = None
+    for instruction in dis.get_instructions(code):
+        found = None
+        if module is not None and instruction.opname in ('LOAD_ATTR',
+                                                         'LOAD_METHOD'):
+            found = getattr(module, instruction.argval, None)
+        elif instruction.opname in ('LOAD_GLOBAL', 'LOAD_NAME'):
+            found = namespace.get(instruction.argval)
+        module = found if isinstance(found, types.ModuleType) and \
+            local(found) else None
+        if found is not None:
+            yield found
+
+
+def fingerprint(value, digest, seen, namespace=None):
+    """Feeds what a stage's output depends on into a hash.
+
+    Functions are hashed by their code and classes by their methods.
+    Both are followed into the functions, classes and constants their
+    code refers to, whether by name or as an attribute of a module,
+    e.g. main.output_problems, but only within this repository. Files
+    of the repository named by an absolute path, e.g.
+    `classify.climates_path`, are hashed by their contents. Other
+    objects of the repository's classes are hashed by their attributes
+    and values by their repr.
+
+    Args:
+        value: a function, class, code object, container or value.
+        digest: the hashlib object to update.
+        seen: the ids of the functions, classes and objects already
+            hashed.
+        namespace: the globals names in code are looked up in.
+    """
+    if hasattr(value, '__wrapped__') and not isinstance(value, type):
+        # e.g. functools.lru_cache
+        value = inspect.unwrap(value)
+    if isinstance(value, (types.FunctionType, type)):
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+        digest.update('{}.{}'.format(value.__module__,
+                                     value.__qualname__).encode())
+        if not local(value):
+            return
+        if isinstance(value, type):
+            for name, attribute in sorted(vars(value).items()):
+                attribute = getattr(attribute, '__func__', attribute)
+                if isinstance(attribute, property):
+                    attribute = [attribute.fget, attribute.fset]
+                if isinstance(attribute, (types.FunctionType, list, int,
+                                          float, str)):
+                    digest.update(name.encode())
+                    fingerprint(attribute, digest, seen)
+            fingerprint(list(value.__bases__), digest, seen)
+        else:
+            fingerprint(value.__code__, digest, seen, value.__globals__)
+            fingerprint([value.__defaults__, value.__kwdefaults__], digest,
+                        seen)
+    elif isinstance(value, types.CodeType):
+        digest.update(value.co_code)
+        fingerprint(value.co_consts, digest, seen, namespace)
+        for name in value.co_names:
+            digest.update(name.encode())
+        for found in referred(value, namespace or {}):
+            if followed(found):
+                fingerprint(found, digest, seen)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            fingerprint(item, digest, seen, namespace)
+    elif isinstance(value, dict):
+        for key in sorted(value, key=repr):
+            fingerprint([key, value[key]], digest, seen, namespace)
+    elif isinstance(value, (set, frozenset)):
+        # Set order changes between interpreters
+        fingerprint(sorted(map(repr, value)), digest, seen)
+    elif isinstance(value, str):
+        digest.update(value.encode())
+        if os.path.isabs(value) and value.startswith(here + os.sep) and \
+                os.path.isfile(value):
+            digest.update(file_hash(value).encode())
+    elif isinstance(value, (int, float, bytes, type(None))):
+        digest.update(repr(value).encode())
+    elif hasattr(value, '__dict__') and local(type(value)):
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+        fingerprint([type(value), vars(value)], digest, seen)
+    else:
+        digest.update(repr(value).encode())
+
+
+def contents(paths):
+    """Returns the path and content hash of every file at or in paths,
+    for the keys of stages reading them."""
+    return sorted((path, file_hash(path)) for found in paths
+                  for path in [found] + glob.glob(
+                      os.path.join(glob.escape(found), '**', '*'),
+                      recursive=True)
+                  if os.path.isfile(path))
+
+
+def checkpoint_path(prefix, stage, key, directory=None):
+    """Returns the checkpoint file of a stage's output.
+
+    Each stage of a workbook has its own directory, as sheet names can't
+    hold a '/', so a stage's checkpoints never mix with another's.
+
+    Args:
+        prefix: the directory name shared by the checkpoints of a
+            workbook, see `workbook_prefix`.
+        stage: the stage name.
+        key: the stage key.
+        directory: the checkpoint directory, defaults to `checkpoint_dir`.
+    """
+    return os.path.join(directory or checkpoint_dir, prefix,
+                        *stage.split(crosscheck.separator),
+                        '{}.arrow'.format(key[:16]))
+
+
+def workbook_prefix(path):
+    """Returns the checkpoint directory name of a workbook, its stem and
+    a hash of its absolute path."""
+    location = os.path.abspath(path)
+    return '{}-{}'.format(os.path.splitext(os.path.basename(location))[0],
+                          hashlib.sha256(location.encode()).hexdigest()[:16])
+
+
+def read_checkpoint(path):
+    """Returns the frame in a checkpoint, memory mapped."""
+    return pa.ipc.open_file(pa.memory_map(path)).read_all().to_pandas()
+
+
+def write_checkpoint(data, path):
+    """Writes a frame to a checkpoint.
+
+    Returns:
+        An empty string on success, otherwise a note on why the frame
+        wasn't checkpointed.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    partial = path + '.partial'
+    try:
+        table = pa.Table.from_pandas(data, preserve_index=True)
+        with pa.OSFile(partial, 'wb') as sink, \
+                pa.ipc.new_file(sink, table.schema) as ipc:
+            ipc.write_table(table)
+    except (pa.ArrowException, ValueError, TypeError) as e:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return ', not checkpointed: {}'.format(e)
+    os.replace(partial, path)
+    return ''
+
+
+class Pipeline:
+    """Stages run on demand, through the checkpoints of their outputs.
+
+    Args:
+        stages: the `Stage`s, inputs before the stages reading them.
+        source: the workbook path, its content hash keys the stages.
+        directory: the checkpoint directory, defaults to `checkpoint_dir`.
+        full: ignore the checkpoints and run every stage.
+    """
+
+    def __init__(self, stages, source, directory=None, full=False):
+        self.stages = {stage.name: stage for stage in stages}
+        self.prefix = workbook_prefix(source)
+        self.source = file_hash(source)
+        self.directory = directory
+        self.full = full
+        self.keys = {}
+        self.outputs = {}
+
+    def key(self, name):
+        """Returns the key of a stage's output."""
+        if name not in self.keys:
+            stage = self.stages[name]
+            digest = hashlib.sha256(name.encode())
+            fingerprint([stage.run, stage.settings], digest, set())
+            for key in [self.key(inputs) for inputs in stage.inputs] or \
+                    [self.source]:
+                digest.update(key.encode())
+            self.keys[name] = digest.hexdigest()
+        return self.keys[name]
+
+    def output(self, name):
+        """Returns the output of a stage, from its checkpoint if there is
+        a valid one, else by running it on the outputs of its inputs."""
+        if name in self.outputs:
+            return self.outputs[name]
+        start = time.perf_counter()
+        path = checkpoint_path(self.prefix, name, self.key(name),
+                               self.directory)
+        if pa is not None and not self.full and os.path.exists(path):
+            try:
+                with instrument.stage('checkpoint ' + name) as record:
+                    data = read_checkpoint(path)
+                    record['rows out'] = len(data)
+            except (OSError, pa.ArrowException) as e:
+                print('{}: unreadable checkpoint, {}'.format(name, e))
+            else:
+                print('{}: checkpoint ({:.2f}s)'.format(
+                    name, time.perf_counter() - start))
+                self.outputs[name] = data
+                return data
+
+        stage = self.stages[name]
+        inputs = [self.output(inputs) for inputs in stage.inputs]
+        start = time.perf_counter()
+        with instrument.stage(name, sum(map(len, inputs)) if inputs
+                              else None) as record:
+            data = stage.run(*inputs)
+            record['rows out'] = len(data)
+        note = ', not checkpointed: no pyarrow'
+        if pa is not None:
+            folder = os.path.dirname(path)
+            for old in glob.glob(os.path.join(glob.escape(folder),
+                                              '*.arrow')):
+                os.remove(old)
+            note = write_checkpoint(data, path)
+        print('{}: ran ({:.2f}s){}'.format(
+            name, time.perf_counter() - start, note))
+        self.outputs[name] = data
+        return data
+
+
+def loader(path, names):
+    """Returns a function reading a raw sheet, which reads every sheet in
+    `names` in one pass the first time one is needed."""
+    sheets = {}
+
+    def load(name):
+        if not sheets:
+            sheets.update(main.read_sheets(path, names, plan=False))
+        return sheets[name]
+    return load
+
+
+def outliers_frame(df, validation, settings):
+    """Returns the unusual values of a transformed sheet as a frame."""
+    return pd.DataFrame(
+        main.outlier_values(df, validation, settings=settings),
+        index=df.index,
+        columns=unusual_names(validation.metrics, validation.suffix))
+
+
+def rules_frame(df, validation):
+    """Returns the rule flags of a transformed sheet as a frame."""
+    return pd.DataFrame(flags(validation.rules, df), index=df.index,
+                        columns=[rule.name for rule in validation.rules])
+
+
+def export_frame(outliers, flagged):
+    """Returns the problems frame written out for a sheet."""
+    return main.output_problems(
+        Problems(outliers.index)
+        .add_values(list(outliers.columns), outliers.to_numpy())
+        .add_flags(list(flagged.columns), flagged.to_numpy())
+        .wide())
+
+
+def sheet_stages(validation, load, settings):
+    """Returns the stages checking a sheet.
+
+    Args:
+        validation: the `main.Validation` of the sheet.
+        load: a function of a sheet name returning the raw sheet.
+        settings: the `main.Settings` outliers are found with.
+
+    Returns:
+        A list of `Stage`s, ending with '<sheet>: export'.
+    """
+    name = validation.name
+    return [
+        Stage(step(name, 'load'), [], lambda: load(name),
+              [main.read_sheets]),
+        Stage(step(name, 'clean'), [step(name, 'load')], schema.apply),
+        Stage(step(name, 'transform'), [step(name, 'clean')],
+              validation.transform),
+        Stage(step(name, 'outliers'), [step(name, 'transform')],
+              lambda df: outliers_frame(df, validation, settings),
+              [main.outlier_values, validation.metrics,
+               validation.groupings, validation.report, validation.suffix,
+               # Threads don't change the outliers
+               settings._replace(workers=None),
+               contents([os.path.join(directory, name)
+                         for directory in settings.sketch_dirs] +
+                        [cube.cube_path(directory, name)
+                         for directory in settings.cube_dirs])]),
+        Stage(step(name, 'rules'), [step(name, 'transform')],
+              lambda df: rules_frame(df, validation), [validation.rules]),
+        Stage(step(name, 'export'),
+              [step(name, 'outliers'), step(name, 'rules')], export_frame),
+    ]
+
+
+def stages(path, validations=None, settings=None):
+    """Returns the stages checking a workbook.
+
+    Args:
+        path: the workbook path.
+        validations: the `main.Validation`s of the sheets checked,
+            defaults to the Vineyard and Winery checks.
+        settings: the `main.Settings` outliers are found with, the
+            defaults if None.
+
+    Returns:
+        A list of `Stage`s, with an '<sheet>: export' stage per sheet and
+        one for the cross-sheet checks.
+    """
+    if validations is None:
+        validations = [main.vineyard, main.winery]
+    settings = settings or main.Settings()
+    names = [validation.name for validation in validations]
+    load = loader(path, names)
+    found = [stage for validation in validations
+             for stage in sheet_stages(validation, load, settings)]
+    found.append(Stage(
+        step(cross_sheet, 'export'),
+        [step(name, 'clean') for name in names],
+        lambda *sheets: crosscheck.validate(dict(zip(names, sheets))),
+        [crosscheck.validate, crosscheck.cross_rules]))
+    return found
+
+
+def run(path='data.xlsx', format='xlsx', combined=False, directory=None,
+        full=False, settings=None, write_memory=False):
+    """Checks a workbook through the checkpoints and writes the problems.
+
+    Args:
+        path: the workbook path.
+        format: one of `writer.formats`.
+        combined: write one workbook with a sheet per frame, Excel only.
+        directory: the checkpoint directory, defaults to `checkpoint_dir`.
+        full: ignore the checkpoints and run every stage.
+        settings: the `main.Settings` outliers are found with, the
+            defaults if None.
+        write_memory: also report the peak memory of writing each file,
+            see `writer.write`.
+
+    Returns:
+        A dict of the problems frames written, keyed by sheet name.
+    """
+    import writer
+
+    pipeline = Pipeline(stages(path, settings=settings), path, directory,
+                        full)
+    frames = {name: pipeline.output(step(name, 'export'))
+              for name in sheet_names + [cross_sheet]}
+    writer.write(frames, format, combined=combined, memory=write_memory)
+    return frames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', nargs='?', default='data.xlsx',
+                        help='the workbook to validate')
+    parser.add_argument('--format', default='xlsx',
+                        choices=['xlsx', 'csv', 'parquet'],
+                        help='the output file format')
+    parser.add_argument('--combined', action='store_true',
+                        help='write one problems.xlsx with a sheet per '
+                             'frame')
+    parser.add_argument('--checkpoints', default=None,
+                        help='the checkpoint directory, defaults to '
+                             + checkpoint_dir)
+    parser.add_argument('--full', action='store_true',
+                        help='ignore the checkpoints and run every stage')
+    parser.add_argument('--write-memory', action='store_true',
+                        help='write each file again under tracemalloc to '
+                             'report its peak memory')
+    main.settings_arguments(parser)
+    args = parser.parse_args()
+
+    run(args.path, args.format, args.combined, args.checkpoints, args.full,
+        main.parse_settings(parser, args), args.write_memory)
@@ -0,0 +1,162 @@
+"""A sparse store of the problems found in a sheet.
+
+Problems are rare, so rather than a members x problems frame that is
+almost all blank, `Problems` keeps a (row, problem, value) triple per
+problem found, in three compact arrays. The unusual values keep their
+value or z score and rule flags are 'Yes'. The wide layout of the output
+files, a row per member with any problem and a column per problem, is
+only built by `wide` on export.
+
+Triples are sorted by member and by problem the first time either is
+queried, so "every problem of a member" and "every member a rule flags"
+are binary searches.
+"""
+import numpy as np
+import pandas as pd
+
+
+class Problems:
+    """The problems found in a sheet, as (row, problem, value) triples.
+
+    Args:
+        index: the Membership Number of each row of the sheet.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.names = []
+        self.flag = np.zeros(0, dtype=bool)
+        self.rows = np.zeros(0, dtype=np.int32)
+        self.codes = np.zeros(0, dtype=np.int16)
+        self.values = np.zeros(0)
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, names, rows, cols, values, flag):
+        first = len(self.names)
+        self.names.extend(names)
+        self.flag = np.append(self.flag, np.full(len(names), flag))
+        self.rows = np.concatenate([self.rows, rows.astype(np.int32)])
+        self.codes = np.concatenate(
+            [self.codes, (cols + first).astype(np.int16)])
+        self.values = np.concatenate([self.values, values])
+        self.orders = {}
+        return self
+
+    def add_values(self, names, values):
+        """Records the values of problem columns.
+
+        Args:
+            names: the problem column of each column of `values`.
+            values: a float matrix with a row per member, NaN where the
+                member has no such problem.
+
+        Returns:
+            This `Problems`.
+        """
+        rows, cols = np.nonzero(~np.isnan(values))
+        return self.add(names, rows, cols, values[rows, cols], False)
+
+    def add_flags(self, names, flags):
+        """Records the flags of rules.
+
+        Args:
+            names: the problem column of each column of `flags`.
+            flags: a boolean matrix with a row per member.
+
+        Returns:
+            This `Problems`.
+        """
+        rows, cols = np.nonzero(flags)
+        return self.add(names, rows, cols, np.full(len(rows), np.nan), True)
+
+    def select(self, key, value):
+        """Returns the positions of the triples whose 'rows' or 'codes'
+        are `value`."""
+        keys = getattr(self, key)
+        if key not in self.orders:
+            order = np.argsort(keys, kind='stable')
+            self.orders[key] = order, keys[order]
+        order, ordered = self.orders[key]
+        return order[np.searchsorted(ordered, value, side='left'):
+                     np.searchsorted(ordered, value, side='right')]
+
+    def labels(self, codes, values):
+        """Returns the values of triples as objects, 'Yes' for flags."""
+        return np.where(self.flag[codes], 'Yes', values.astype(object))
+
+    def member(self, member):
+        """Returns every problem of a member.
+
+        Args:
+            member: a Membership Number.
+
+        Returns:
+            A Series of the member's values or 'Yes' flags indexed by
+            problem column, empty for members without problems.
+        """
+        # A member repeated in the sheet has the problems of every row
+        rows = self.index.get_indexer_for([member])
+        found = np.concatenate([np.zeros(0, dtype=np.intp)] +
+                               [self.select('rows', row) for row in rows
+                                if row >= 0])
+        found = found[np.argsort(self.codes[found], kind='stable')]
+        return pd.Series(self.labels(self.codes[found], self.values[found]),
+                         index=np.array(self.names, dtype=object)[
+                             self.codes[found]],
+                         name=member, dtype=object)
+
+    def problem(self, name):
+        """Returns every member with a problem.
+
+        Args:
+            name: a problem column, e.g. a rule name.
+
+        Returns:
+            A Series of the values or 'Yes' flags indexed by Membership
+            Number, in the order of the sheet.
+        """
+        code = self.names.index(name)
+        found = np.sort(self.select('codes', code))
+        return pd.Series(self.labels(self.codes[found], self.values[found]),
+                         index=self.index[self.rows[found]], name=name,
+                         dtype=object)
+
+    def counts(self):
+        """Returns the number of members with each problem."""
+        return pd.Series(np.bincount(self.codes, minlength=len(self.names)),
+                         index=self.names)
+
+    def to_frame(self):
+        """Returns the problems in long format, a row per problem with
+        the 'Membership Number', 'problem' and 'value'."""
+        order = np.lexsort((self.codes, self.rows))
+        rows, codes, values = self.rows[order], self.codes[order], \
+            self.values[order]
+        return pd.DataFrame({
+            self.index.name or 'member': self.index[rows],
+            'problem': np.array(self.names, dtype=object)[codes],
+            'value': self.labels(codes, values)})
+
+    def wide(self):
+        """Returns the problems as a frame with a row per member with any
+        problem and a column per problem.
+
+        Values are floats and NaN where a member doesn't have the
+        problem. Flags are categoricals of 'Yes' and blank.
+        """
+        members, rows = np.unique(self.rows, return_inverse=True)
+        matrix = np.full((len(members), len(self.names)), np.nan)
+        matrix[rows, self.codes] = self.values
+        flagged = np.zeros(matrix.shape, dtype=bool)
+        flagged[rows, self.codes] = True
+        columns = {}
+        for i, name in enumerate(self.names):
+            if self.flag[i]:
+                columns[name] = pd.Categorical.from_codes(
+                    flagged[:, i].astype(np.int8) - 1, ['Yes'])
+            else:
+                columns[name] = matrix[:, i]
+        return pd.DataFrame(columns, index=self.index[members])
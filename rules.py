@@ -0,0 +1,159 @@
+"""Declarative conditional checks evaluated as NumPy boolean masks.
+
+Each rule reads like a call to `cond_problem`: it flags a row when
+`col1` has a value (and the optional `where` predicate holds) but `col2`
+does not. The columns a rule uses are pulled out of the DataFrame once
+and shared by every rule, and the flags of all rules are written into
+one preallocated boolean matrix.
+"""
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import instrument
+import schema
+
+Rule = namedtuple('Rule', ['name', 'col1', 'col2', 'where', 'two_way'],
+                  defaults=(None, None, None, False))
+Rule.__doc__ = """A conditional check.
+
+Args:
+    name: the problem column the rule writes.
+    col1: a column that needs col2 when present, None for every row.
+    col2: the column required by col1, None to flag whenever col1
+        (and where) holds.
+    where: an optional callable taking a `Columns` and returning a
+        boolean mask of the rows col1 applies to.
+    two_way: flag when either column is missing a value, but not both.
+"""
+
+
+class Columns:
+    """Caches columns of a DataFrame as NumPy arrays for the rules.
+
+    The survey uses zero for none, so zeros in every numeric column read
+    as blanks. This keeps the flags the rules have always raised. A zero
+    a member entered stays in the sheet, only the checks can't tell it
+    from a blank.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.arrays = {}
+        self.masks = {}
+        self.answers = {}
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            column = self.df[name]
+            if isinstance(column.dtype, pd.BooleanDtype):
+                # Blank answers are False, present() still sees them
+                self.arrays[name] = column.to_numpy(dtype=bool,
+                                                    na_value=False)
+            elif column.dtype.kind in 'iuf':
+                values = column.to_numpy(dtype=float, na_value=np.nan)
+                self.arrays[name] = np.where(values == 0, np.nan, values)
+            else:
+                self.arrays[name] = column.to_numpy()
+        return self.arrays[name]
+
+    def present(self, name):
+        """Returns a mask of the rows with a value in the column."""
+        if name not in self.masks:
+            if self.df[name].dtype.kind in 'iuf':
+                self.masks[name] = ~np.isnan(self[name])
+            else:
+                self.masks[name] = self.df[name].notna().to_numpy()
+        return self.masks[name]
+
+    def missing(self, name):
+        """Returns a mask of the rows without a value in the column."""
+        return ~self.present(name)
+
+    def answered(self, names, answer):
+        """Returns a boolean matrix of where answer columns hold an
+        answer, a column per name, see `schema.encode`."""
+        key = (tuple(names), answer)
+        if key not in self.answers:
+            self.answers[key] = schema.encode(self.df, names, [answer]) == 0
+        return self.answers[key]
+
+
+def rule_mask(rule: Rule, columns: Columns):
+    """Returns the boolean mask of the rows a rule flags.
+
+    Args:
+        rule: the rule to evaluate.
+        columns: the cached columns of the DataFrame.
+
+    Returns:
+        A boolean array with a value per row.
+    """
+    col1 = np.ones(len(columns), dtype=bool) if rule.col1 is None \
+        else columns.present(rule.col1)
+    if rule.where is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            col1 = col1 & rule.where(columns)
+    col2 = np.zeros(len(columns), dtype=bool) if rule.col2 is None \
+        else columns.present(rule.col2)
+
+    if rule.two_way:
+        return col1 ^ col2
+    return col1 & ~col2
+
+
+def flags(rules, df, pool=None):
+    """Returns the rows each rule flags as one boolean matrix, see
+    `evaluate` for the arguments.
+
+    Returns:
+        A boolean array with a column per rule.
+    """
+    columns = Columns(df)
+    flagged = np.zeros((len(df), len(rules)), dtype=bool)
+    if pool is not None:
+        def timed_mask(rule):
+            start = time.perf_counter()
+            mask = rule_mask(rule, columns)
+            return mask, time.perf_counter() - start
+
+        for i, (rule, (mask, seconds)) in enumerate(
+                zip(rules, pool.map(timed_mask, rules))):
+            flagged[:, i] = mask
+            # Timed on the threads and recorded in rule order
+            instrument.timed('rule: ' + rule.name, seconds, len(df),
+                             int(mask.sum()))
+    else:
+        for i, rule in enumerate(rules):
+            with instrument.stage('rule: ' + rule.name, len(df)) as record:
+                flagged[:, i] = rule_mask(rule, columns)
+                record['rows out'] = int(flagged[:, i].sum())
+    return flagged
+
+
+def evaluate(rules, df, pool=None):
+    """Returns the problems found by a table of rules.
+
+    Args:
+        rules: a list of `Rule`s.
+        df: the transformed DataFrame.
+        pool: an optional executor to evaluate each rule on, e.g. a
+            ThreadPoolExecutor. The columns are shared with the workers,
+            each column is read from `df` once.
+
+    Returns:
+        A DataFrame with a column per rule, 'Yes' where the rule flagged
+        the row and blank elsewhere.
+    """
+    flagged = flags(rules, df, pool)
+    # Categoricals of a single 'Yes' category are built from the flags
+    # without creating a string per row
+    codes = flagged.astype(np.int8) - 1
+    return pd.DataFrame(
+        {rule.name: pd.Categorical.from_codes(codes[:, i], ['Yes'])
+         for i, rule in enumerate(rules)}, index=df.index)
@@ -0,0 +1,221 @@
+"""The dtype plan applied to sheets when they are loaded.
+
+Every column of a sheet is read as float64 or as object/str, which is
+far more memory than the answers need. The plan picks a smaller dtype
+per column:
+
+- the contractor answers become nullable booleans, True for
+  'We perform', False for 'Contractor' and missing when blank,
+- other text columns with few distinct answers become categoricals,
+- whole numbers small enough to stay exact, in sums of several columns
+  too, become float32.
+
+Numbers with decimals stay float64, as float32 would change the exact
+comparisons the rules make. Missing values stay NaN, so the planned
+frames flow through the transforms unchanged.
+
+`encode` turns any set of answer columns, planned or not, into one int8
+matrix of answer codes for the checks.
+
+Usage:
+    python schema.py data.xlsx
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+#############
+# variables
+
+contractor_columns = ['Mechanical harvesting', 'Mechanical pruning',
+                      'Slashing', 'Fungicide spraying',
+                      'Insecticide spraying', 'Herbicide spraying']
+contractor_answers = {'We perform': True, 'Contractor': False}
+
+# Text columns with at most this share of distinct answers are
+# categorical
+category_share = 0.5
+
+# Whole numbers below this are exact in float32, and so are sums of up
+# to 16 of them
+float32_limit = 2 ** 20
+
+
+def whole_numbers(values: np.ndarray):
+    """Returns whether every value is a whole number below
+    `float32_limit`, ignoring missing values."""
+    values = values[~np.isnan(values)]
+    return bool(np.all(values == np.round(values)) and
+                np.all(np.abs(values) < float32_limit))
+
+
+def plan(data: pd.DataFrame):
+    """Returns the smaller dtype of each column that has one.
+
+    Args:
+        data: a sheet as read from the workbook.
+
+    Returns:
+        A dict of dtypes keyed by column.
+    """
+    dtypes = {}
+    for col in data.columns:
+        values = data[col]
+        if pd.api.types.is_float_dtype(values.dtype) or \
+                pd.api.types.is_integer_dtype(values.dtype):
+            if values.dtype != np.float32 and \
+                    whole_numbers(values.to_numpy(dtype=float)):
+                dtypes[col] = np.dtype(np.float32)
+        elif pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            answers = values.dropna().unique()
+            if col in contractor_columns and \
+                    set(answers) <= set(contractor_answers):
+                dtypes[col] = pd.BooleanDtype()
+            elif len(answers) <= category_share * len(values):
+                dtypes[col] = pd.CategoricalDtype()
+    return dtypes
+
+
+def apply(data: pd.DataFrame, dtypes=None):
+    """Returns a sheet with the dtypes of a plan.
+
+    Args:
+        data: a sheet as read from the workbook.
+        dtypes: the plan, defaults to the one `plan` picks for the sheet.
+
+    Returns:
+        A new DataFrame.
+    """
+    if dtypes is None:
+        dtypes = plan(data)
+    columns = {}
+    for col, dtype in dtypes.items():
+        if isinstance(dtype, pd.BooleanDtype):
+            columns[col] = data[col].map(contractor_answers).astype(dtype)
+        else:
+            columns[col] = data[col].astype(dtype)
+    return data.assign(**columns) if columns else data
+
+
+def conform(data: pd.DataFrame, like: pd.DataFrame):
+    """Returns new rows, e.g. a submitted form, with the columns of a
+    planned sheet.
+
+    Columns the rows don't have are blank and numbers, given as text too,
+    become one float64 block, so a submitted decimal isn't rounded to
+    float32. Answers stay as given: the checks read text and planned
+    answer columns alike, see `encode`. The conversion is a few calls
+    however many columns there are, which matters for single rows.
+
+    Args:
+        data: the new rows.
+        like: the planned sheet, only its columns and dtypes are used.
+
+    Returns:
+        A new DataFrame with the columns of `like`.
+    """
+    data = data.reindex(columns=like.columns)
+    numeric = [col for col, dtype in like.dtypes.items()
+               if isinstance(dtype, np.dtype) and dtype.kind in 'iuf']
+    dates = [col for col, dtype in like.dtypes.items()
+             if isinstance(dtype, np.dtype) and dtype.kind == 'M']
+    try:
+        # None reads as NaN
+        block = data[numeric].to_numpy(dtype=object).astype(float)
+    except (TypeError, ValueError):
+        block = data[numeric].apply(pd.to_numeric, errors='coerce') \
+            .to_numpy(dtype=float)
+    rest = like.columns.difference(numeric, sort=False)
+    columns = {col: pd.to_datetime(data[col], errors='coerce')
+               for col in dates}
+    return pd.concat([pd.DataFrame(block, index=data.index,
+                                   columns=numeric),
+                      data[rest].assign(**columns)],
+                     axis=1)[like.columns]
+
+
+def encode(data: pd.DataFrame, cols, answers):
+    """Encodes survey answer columns as one int8 matrix.
+
+    Text columns are stacked and looked up in one pass, categorical
+    columns through their categories and the planned contractor booleans
+    through `contractor_answers`.
+
+    Args:
+        data: the DataFrame holding the answers.
+        cols: the answer columns.
+        answers: the answers to encode.
+
+    Returns:
+        An int8 array with a column per answer column, holding the
+        position of each answer in `answers`, or -1 for blank and other
+        answers.
+    """
+    lookup = pd.Index(answers)
+    codes = np.full((len(data), len(cols)), -1, dtype=np.int8)
+    text = []
+    for i, col in enumerate(cols):
+        values = data[col]
+        if isinstance(values.dtype, pd.BooleanDtype):
+            labels = {value: answer
+                      for answer, value in contractor_answers.items()}
+            true, false = lookup.get_indexer([labels[True], labels[False]])
+            codes[:, i] = np.where(
+                values.to_numpy(dtype=bool, na_value=False), true, false)
+            codes[values.isna().to_numpy(), i] = -1
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            # The last entry is for the code -1 of blanks
+            lookup_codes = np.append(
+                lookup.get_indexer(values.cat.categories), -1)
+            codes[:, i] = lookup_codes[values.cat.codes.to_numpy()]
+        else:
+            text.append(i)
+    if text:
+        stacked = data[[cols[i] for i in text]].to_numpy(dtype=object)
+        codes[:, text] = lookup.get_indexer(stacked.ravel()) \
+            .reshape(stacked.shape)
+    return codes
+
+
+def memory_mb(data: pd.DataFrame):
+    """Returns the memory a DataFrame uses in MB, strings included."""
+    return data.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def memory_report(before: pd.DataFrame, after: pd.DataFrame):
+    """Returns the dtype and memory of each column before and after a
+    plan, with a Total row.
+
+    Args:
+        before: the sheet as read.
+        after: the sheet with the planned dtypes.
+
+    Returns:
+        A DataFrame indexed by column.
+    """
+    report = pd.DataFrame({
+        'dtype before': before.dtypes.astype(str),
+        'dtype after': after.dtypes.astype(str),
+        'MB before': before.memory_usage(deep=True, index=False) / 2 ** 20,
+        'MB after': after.memory_usage(deep=True, index=False) / 2 ** 20})
+    report.loc['Total', ['MB before', 'MB after']] = \
+        report[['MB before', 'MB after']].sum()
+    return report
+
+
+if __name__ == '__main__':
+    from main import read_sheets
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', nargs='?', default='data.xlsx',
+                        help='the workbook to plan')
+    parser.add_argument('--sheets', nargs='+',
+                        default=['Vineyard', 'Winery'],
+                        help='the sheets to plan')
+    args = parser.parse_args()
+
+    for name, data in read_sheets(args.path, args.sheets, plan=False) \
+            .items():
+        print(name)
+        print(memory_report(data, apply(data)).round(3).to_string())
@@ -0,0 +1,359 @@
+"""Scores single submissions against a warm cohort over HTTP.
+
+The workbook is read once and the group statistics of every grouping of
+each sheet (GI Region and Climate for the Vineyard, all wineries and
+Size for the Winery) are kept in memory, so a submission is transformed,
+scored against them and checked by the rules without touching the rest
+of the cohort. The workbook is watched in the background and the
+statistics are rebuilt when it changes, while requests keep being
+answered from the old ones.
+
+Endpoints, all answering JSON:
+
+    GET  /health          the workbook version and cohort sizes
+    POST /score/<sheet>   one row as a JSON object of column: answer
+    POST /batch/<sheet>   a JSON list of rows
+
+A row's problems are a JSON object of the problem columns that flagged
+it, with 'Unusual <metric>' holding the value or z score and the rules
+'Yes'. Rows may carry their 'Membership Number', which is echoed back.
+
+The server only needs the standard library: asyncio streams with a
+small HTTP/1.1 reader and keep-alive connections. Scoring runs on the
+default executor so the loop keeps accepting requests.
+
+Rows are scored with the settings of a batch run, e.g. --outliers mad
+or --fallback, so the service and main.py agree on a row.
+
+Usage:
+    python service.py data.xlsx --port 8080
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+import api
+import main
+import schema
+from loader import normalise_index
+from outliers import unusual
+from rules import evaluate
+from stats import GroupStats
+
+#############
+# variables
+
+host = '127.0.0.1'
+port = 8080
+# Seconds between checks of the workbook for changes
+refresh_interval = 5
+# The largest request body accepted, in bytes
+max_body = 16 * 2 ** 20
+
+statuses = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large',
+            500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HTTPError(Exception):
+    """An error answered with an HTTP status and a JSON message."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Cohort:
+    """The statistics and dtypes a sheet's submissions are checked with.
+
+    Args:
+        data: the sheet as returned by data_in.
+        validation: the `main.Validation` of the sheet.
+        settings: the `main.Settings` submissions are scored with, as in
+            a batch run with them, the defaults if None.
+    """
+
+    def __init__(self, data, validation, settings=None):
+        self.validation = validation
+        self.settings = settings = settings or main.Settings()
+        self.members = len(data)
+        # An empty frame holding the columns and dtypes of the sheet
+        self.like = data.iloc[:0]
+        transformed = validation.transform(data)
+        # Only the statistics the settings score against are kept
+        self.stats = self.sketches = self.cube = None
+        if settings.fallback:
+            self.cube = main.fallback_cube(transformed, validation,
+                                           settings.cube_dirs)
+        elif settings.outlier_method != 'zscore':
+            self.sketches = main.robust_sketches(transformed, validation,
+                                                 settings.sketch_dirs)
+        else:
+            self.stats = [GroupStats(by, validation.metrics).add(transformed)
+                          for by, minimum_count in validation.groupings]
+
+    def frame(self, rows):
+        """Returns submitted rows as a sheet with the cohort's dtypes.
+
+        Args:
+            rows: a list of dicts of column: answer.
+
+        Raises:
+            HTTPError: if a row isn't a JSON object.
+        """
+        if not all(isinstance(row, dict) for row in rows):
+            raise HTTPError(400, 'a row has to be a JSON object')
+        columns = list(dict.fromkeys(col for row in rows for col in row))
+        values = np.empty((len(rows), len(columns)), dtype=object)
+        for i, row in enumerate(rows):
+            values[i] = [row.get(col) for col in columns]
+        # One object block, rather than inferring a dtype per column
+        data = pd.DataFrame(values, columns=columns, dtype=object)
+        if api.index_column in data.columns:
+            try:
+                data = normalise_index(data, api.index_column)
+            except (TypeError, ValueError):
+                raise HTTPError(400, 'a {} is not a number'.format(
+                    api.index_column))
+        return schema.conform(data, self.like)
+
+    def score(self, rows):
+        """Returns the problems of submitted rows.
+
+        Each row is scored against the cohort's statistics, not against
+        the other submitted rows.
+
+        Args:
+            rows: a list of dicts of column: answer.
+
+        Returns:
+            A DataFrame with a column per problem and a row per submitted
+            row, NaN where the row has no such problem.
+        """
+        validation, settings = self.validation, self.settings
+        df = validation.transform(self.frame(rows))
+        outliers = unusual(
+            df, validation.metrics, validation.groupings, settings.threshold,
+            validation.suffix, validation.report, stats=self.stats,
+            sketches=self.sketches, method=settings.outlier_method,
+            cube=self.cube)
+        return pd.concat([outliers, evaluate(validation.rules, df)],
+                         axis=1)
+
+
+def json_value(value):
+    """Returns a problem value that JSON can hold, infinities as text."""
+    if isinstance(value, (float, np.floating)):
+        return float(value) if math.isfinite(value) else str(value)
+    return value
+
+
+def records(problems):
+    """Returns a list with the member and problems of each row."""
+    values = problems.astype(object).to_numpy()
+    found = ~pd.isna(values)
+    named = problems.index.name == api.index_column
+    return [{'member': int(member) if named else None,
+             'problems': {col: json_value(value) for col, value, flagged in
+                          zip(problems.columns, row, flags) if flagged}}
+            for member, row, flags in zip(problems.index, values, found)]
+
+
+class Service:
+    """The cohorts of a workbook and the HTTP handler scoring against them.
+
+    Args:
+        path: the workbook path.
+        interval: seconds between checks of the workbook for changes.
+        settings: the `main.Settings` submissions are scored with, the
+            defaults if None.
+    """
+
+    def __init__(self, path='data.xlsx', interval=refresh_interval,
+                 settings=None):
+        self.workbook = api.Workbook(path, settings=settings)
+        self.settings = settings
+        self.interval = interval
+        self.cohorts = {}
+        self.loaded = None
+
+    def refresh(self, force=False):
+        """Rebuilds the cohorts if the workbook changed.
+
+        The new cohorts replace the old ones in one assignment, so
+        requests scored meanwhile use the old ones throughout.
+
+        Returns:
+            Whether the cohorts were rebuilt.
+        """
+        if not self.workbook.load(force) and self.cohorts:
+            return False
+        self.cohorts = {name: Cohort(self.workbook.sheet(name),
+                                     api.validation(name), self.settings)
+                        for name in self.workbook.sheet_names}
+        self.loaded = time.time()
+        return True
+
+    async def watch(self):
+        """Rebuilds the cohorts in the background when the workbook
+        changes, until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if self.workbook.changed() and \
+                        await loop.run_in_executor(None, self.refresh):
+                    print('Cohorts rebuilt from {}'.format(
+                        self.workbook.path))
+            except Exception as e:
+                # Keep answering from the old cohorts, e.g. while the
+                # workbook is half written
+                print('Cohorts not rebuilt: {}'.format(e))
+
+    def cohort(self, sheet_name):
+        if not self.cohorts:
+            raise HTTPError(503, 'the cohorts are still loading')
+        if sheet_name not in self.cohorts:
+            raise HTTPError(404, 'no checks for sheet {!r}'.format(
+                sheet_name))
+        return self.cohorts[sheet_name]
+
+    def health(self):
+        return {'workbook': self.workbook.path, 'loaded': self.loaded,
+                'members': {name: cohort.members
+                            for name, cohort in self.cohorts.items()}}
+
+    async def route(self, method, target, body):
+        """Returns the JSON answer to a request.
+
+        Raises:
+            HTTPError: for bad requests and unknown endpoints.
+        """
+        parts = target.split('?')[0].strip('/').split('/')
+        if parts == ['health']:
+            if method != 'GET':
+                raise HTTPError(405, 'use GET')
+            return self.health()
+        if len(parts) != 2 or parts[0] not in ('score', 'batch'):
+            raise HTTPError(404, 'no endpoint {}'.format(target))
+        if method != 'POST':
+            raise HTTPError(405, 'use POST')
+
+        cohort = self.cohort(parts[1])
+        try:
+            rows = json.loads(body or b'null')
+        except ValueError as e:
+            raise HTTPError(400, 'invalid JSON: {}'.format(e))
+        single = parts[0] == 'score'
+        if single:
+            rows = [rows]
+        elif not isinstance(rows, list):
+            raise HTTPError(400, 'a batch has to be a JSON list of rows')
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        found = records(await loop.run_in_executor(None, cohort.score, rows))
+        elapsed = (time.perf_counter() - start) * 1000
+        if single:
+            return dict(found[0], ms=elapsed)
+        return {'rows': found, 'ms': elapsed}
+
+    async def handle(self, reader, stream):
+        """Answers the requests of one connection."""
+        try:
+            while True:
+                request = await reader.readline()
+                if not request.strip():
+                    break
+                try:
+                    method, target, version = request.decode().split()
+                except ValueError:
+                    await respond(stream, 400, {'error': 'bad request'},
+                                  True)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = headers.get('content-length') or '0'
+                # The body can't be found without a valid length, so the
+                # connection is closed after answering
+                if not (length.isascii() and length.isdigit()):
+                    await respond(stream, 400,
+                                  {'error': 'invalid Content-Length'}, True)
+                    break
+                length = int(length)
+                if length > max_body:
+                    await respond(stream, 413, {'error': 'body too large'},
+                                  True)
+                    break
+                body = await reader.readexactly(length)
+                try:
+                    status, answer = 200, await self.route(method, target,
+                                                           body)
+                except HTTPError as e:
+                    status, answer = e.status, {'error': str(e)}
+                except Exception as e:
+                    status, answer = 500, {'error': repr(e)}
+
+                close = headers.get('connection', '').lower() == 'close' \
+                    or version == 'HTTP/1.0'
+                await respond(stream, status, answer, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            stream.close()
+
+    async def serve(self, host=host, port=port):
+        """Loads the cohorts and serves requests until cancelled."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.refresh)
+        server = await asyncio.start_server(self.handle, host, port)
+        watcher = asyncio.create_task(self.watch())
+        print('Serving {} on http://{}:{}'.format(self.workbook.path, host,
+                                                 port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+
+async def respond(stream, status, answer, close=False):
+    """Writes a JSON response."""
+    body = json.dumps(answer).encode()
+    stream.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                 'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                     status, statuses[status], len(body),
+                     'close' if close else 'keep-alive').encode() + body)
+    await stream.drain()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', nargs='?', default='data.xlsx',
+                        help='the workbook of the cohort')
+    parser.add_argument('--host', default=host)
+    parser.add_argument('--port', type=int, default=port)
+    parser.add_argument('--interval', type=float, default=refresh_interval,
+                        help='seconds between checks of the workbook')
+    main.settings_arguments(parser)
+    args = parser.parse_args()
+    service = Service(args.path, args.interval,
+                      main.parse_settings(parser, args))
+
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,426 @@
+"""Mergeable quantile sketches for robust outlier bounds.
+
+A z score against the mean and standard deviation of a small, skewed
+group is dominated by its largest members. `GroupSketches` keeps a
+t-digest of every metric within each group instead, so medians, MADs and
+quantiles can be read without keeping or sorting the rows.
+
+The digests of every group and metric share flat arrays of centroids
+(digest, mean, weight). Rows are added in one pass. Adding or merging
+concatenates the centroids and compresses them all at once: they are
+sorted by digest and mean, and centroids falling in the same step of the
+k1 scale function, k(q) = compression / 2pi * asin(2q - 1), are merged.
+That keeps single values in the tails and at most `compression` / 2
+centroids per digest. Sketches from separate chunks, files or workers
+merge the same way and are saved as CSV between runs.
+
+Two ways of flagging are offered, both as scores where an absolute value
+above the threshold is unusual:
+
+- 'mad': (value - median) / (1.4826 * MAD), a z score that large
+  values can't inflate,
+- 'quantile': values outside the `quantile_bounds` of their group.
+
+Usage:
+    python sketch.py data.xlsx sketches/2023
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from stats import metric_values
+
+#############
+# variables
+
+# Centroids per digest are at most half of this
+compression = 200
+# The group quantiles outside which 'quantile' flags a value
+quantile_bounds = (0.01, 0.99)
+# Scales a MAD to a standard deviation for normally distributed values
+mad_scale = 1.4826
+# Scales a mean absolute deviation to a standard deviation, used where
+# more than half of a group's values are equal and the MAD is zero
+mean_deviation_scale = 1.2533
+
+methods = ['mad', 'quantile']
+
+
+def compress(digest, mean, weight, ndigests):
+    """Merges the centroids of many digests in one vectorised pass.
+
+    Args:
+        digest: the digest of each centroid.
+        mean: the mean of each centroid.
+        weight: the number of values in each centroid.
+        ndigests: the number of digests.
+
+    Returns:
+        A tuple of (digest, mean, weight) arrays sorted by digest and
+        mean.
+    """
+    if not len(digest):
+        return digest, mean, weight
+    order = np.lexsort((mean, digest))
+    digest, mean, weight = digest[order], mean[order], weight[order]
+    position = centres(digest, weight, ndigests)
+    step = np.floor(compression / (2 * np.pi) *
+                    np.arcsin(2 * position - 1)).astype(np.int64)
+    # Steps run from -compression / 4 to compression / 4, so keys never
+    # overlap between digests
+    key = digest * (compression + 2) + step
+    starts = np.flatnonzero(np.diff(key, prepend=key[0] - 1))
+    merged = np.add.reduceat(weight, starts)
+    return digest[starts], np.add.reduceat(weight * mean, starts) / merged, \
+        merged
+
+
+def centres(digest, weight, ndigests):
+    """Returns the quantile at the middle of each sorted centroid."""
+    total = np.bincount(digest, weights=weight, minlength=ndigests)
+    offsets = np.concatenate([[0], np.cumsum(total)[:-1]])
+    before = np.cumsum(weight) - weight - offsets[digest]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (before + weight / 2) / total[digest]
+
+
+def interpolate(digest, mean, weight, low, high, q):
+    """Returns a quantile of every digest.
+
+    Centroids sit at the quantile of their middle and the quantile is
+    interpolated between them, running to `low` at 0 and `high` at 1.
+
+    Args:
+        digest, mean, weight: centroids sorted by digest and mean.
+        low: the smallest value of each digest.
+        high: the largest value of each digest.
+        q: the quantile.
+
+    Returns:
+        An array with a value per digest, NaN for empty digests.
+    """
+    ndigests = len(low)
+    ids = np.arange(ndigests)
+    # Each digest spans [2d, 2d + 1] of one increasing axis
+    x = np.concatenate([2 * ids, 2 * digest +
+                        centres(digest, weight, ndigests), 2 * ids + 1])
+    y = np.concatenate([low, mean, high])
+    order = np.argsort(x, kind='stable')
+    empty = np.isnan(low)
+    x, y = x[order], np.where(np.isnan(y), 0, y)[order]
+    result = np.interp(2 * ids + q, x, y)
+    result[empty] = np.nan
+    return result
+
+
+class GroupSketches:
+    """Quantile sketches of metric columns within the groups of a column.
+
+    Args:
+        by: the grouping column, or None for a single group of all rows.
+        cols: the metric columns.
+    """
+
+    def __init__(self, by, cols):
+        self.by = by
+        self.cols = list(cols)
+        self.groups = {}
+        self.digest = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0)
+        self.weight = np.zeros(0)
+        self.low = np.zeros((0, len(self.cols)))
+        self.high = np.zeros((0, len(self.cols)))
+
+    def factorize(self, df):
+        """Returns the group code of each row and the group labels."""
+        if self.by is None:
+            return np.zeros(len(df), dtype=np.intp), [None]
+        codes, uniques = pd.factorize(df[self.by])
+        return codes, list(uniques)
+
+    def codes(self, df):
+        """Returns the group of the sketches for each row of a DataFrame,
+        -1 for rows without a known group."""
+        codes, uniques = self.factorize(df)
+        lookup = np.array([self.groups.get(label, -1) for label in uniques]
+                          + [-1], dtype=np.intp)
+        return lookup[codes]
+
+    def values(self, df):
+        return metric_values(df, self.cols)
+
+    def count(self):
+        """Returns the number of values of each group and metric."""
+        return np.bincount(self.digest, weights=self.weight,
+                           minlength=self.low.size).reshape(self.low.shape)
+
+    def add(self, df):
+        """Adds the rows of a DataFrame to the sketches."""
+        codes, uniques = self.factorize(df)
+        values = self.values(df)
+        ncols = len(self.cols)
+        valid = ~np.isnan(values) & (codes >= 0)[:, None]
+        rows, cols = np.nonzero(valid)
+
+        chunk = GroupSketches(self.by, self.cols)
+        chunk.groups = {label: i for i, label in enumerate(uniques)}
+        digest = codes[rows] * ncols + cols
+        chunk.low = np.full((len(uniques), ncols), np.inf)
+        chunk.high = np.full((len(uniques), ncols), -np.inf)
+        np.minimum.at(chunk.low.ravel(), digest, values[valid])
+        np.maximum.at(chunk.high.ravel(), digest, values[valid])
+        chunk.digest, chunk.mean, chunk.weight = digest, values[valid], \
+            np.ones(len(digest))
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """Adds the sketches of another `GroupSketches` of the same metrics.
+
+        Args:
+            other: sketches built from other rows, e.g. another chunk,
+                file, worker or reporting year.
+
+        Returns:
+            These `GroupSketches`.
+        """
+        if other.cols != self.cols:
+            raise ValueError('Can only merge sketches of the same '
+                             'metrics, {} != {}'.format(other.cols,
+                                                        self.cols))
+        for label in other.groups:
+            self.groups.setdefault(label, len(self.groups))
+        rows = np.array([self.groups[label] for label in other.groups],
+                        dtype=np.int64)
+        ncols = len(self.cols)
+        shape = (len(self.groups), ncols)
+        low, high = np.full(shape, np.inf), np.full(shape, -np.inf)
+        low[:len(self.low)], high[:len(self.high)] = self.low, self.high
+        if len(rows):
+            low[rows] = np.fmin(low[rows], other.low)
+            high[rows] = np.fmax(high[rows], other.high)
+        self.low, self.high = low, high
+
+        digest = rows[other.digest // ncols] * ncols + other.digest % ncols \
+            if len(other.digest) else other.digest
+        self.digest, self.mean, self.weight = compress(
+            np.concatenate([self.digest, digest]),
+            np.concatenate([self.mean, other.mean]),
+            np.concatenate([self.weight, other.weight]), self.low.size)
+        return self
+
+    def extremes(self):
+        """Returns the smallest and largest value of each digest, NaN for
+        empty ones."""
+        empty = self.count().ravel() == 0
+        return np.where(empty, np.nan, self.low.ravel()), \
+            np.where(empty, np.nan, self.high.ravel())
+
+    def quantile(self, q):
+        """Returns a quantile of each group and metric."""
+        low, high = self.extremes()
+        return interpolate(self.digest, self.mean, self.weight, low, high,
+                           q).reshape(self.low.shape)
+
+    def mad(self):
+        """Returns the median absolute deviation of each group and metric,
+        read from the centroids."""
+        low, high = self.extremes()
+        median = interpolate(self.digest, self.mean, self.weight, low, high,
+                             0.5)
+        deviation = np.abs(self.mean - median[self.digest])
+        order = np.lexsort((deviation, self.digest))
+        digest, deviation, weight = self.digest[order], \
+            deviation[order], self.weight[order]
+        smallest = np.full(len(low), np.inf)
+        np.minimum.at(smallest, digest, deviation)
+        largest = np.fmax(np.abs(low - median), np.abs(high - median))
+        return interpolate(digest, deviation, weight,
+                           np.where(np.isnan(low), np.nan, smallest),
+                           largest, 0.5).reshape(self.low.shape)
+
+    def scale(self):
+        """Returns the robust standard deviation of each group and metric:
+        the scaled MAD, or the scaled mean absolute deviation from the
+        median where the MAD is zero."""
+        mad = mad_scale * self.mad()
+        median = self.quantile(0.5).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_deviation = np.bincount(
+                self.digest, weights=self.weight *
+                np.abs(self.mean - median[self.digest]),
+                minlength=self.low.size).reshape(self.low.shape) / \
+                self.count()
+        return np.where(mad > 0, mad, mean_deviation_scale * mean_deviation)
+
+    def zscores(self, df, minimum_count=0, method='mad', threshold=2.5):
+        """Returns a robust score of each value against its group.
+
+        Args:
+            df: the DataFrame to score.
+            minimum_count: groups with this many values or fewer in a
+                metric give no scores for that metric.
+            method: 'mad' for (value - median) / robust standard
+                deviation, or 'quantile' for scores reaching `threshold`
+                at the `quantile_bounds` of the group.
+            threshold: the score of the quantile bounds.
+
+        Returns:
+            A 2d array of scores with a column per metric.
+        """
+        values = self.values(df)
+        codes = self.codes(df)
+        rows = np.where(codes >= 0, codes, 0)
+        if not len(self.groups):
+            return np.full(values.shape, np.nan)
+
+        median = self.quantile(0.5)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if method == 'mad':
+                z = (values - median[rows]) / self.scale()[rows]
+            elif method == 'quantile':
+                lower, upper = (self.quantile(q) for q in quantile_bounds)
+                deviation = values - median[rows]
+                z = threshold * np.where(
+                    deviation > 0, deviation / (upper - median)[rows],
+                    deviation / (median - lower)[rows])
+            else:
+                raise ValueError('method has to be one of {}, not '
+                                 '{!r}'.format(methods, method))
+        z[(self.count() <= minimum_count)[rows]] = np.nan
+        z[codes < 0] = np.nan
+        return z
+
+    def to_frame(self):
+        """Returns the sketches as a long DataFrame.
+
+        There is a row per centroid with the grouping column in 'by', the
+        group in 'group', the 'metric', the centroid's 'mean' and 'weight'
+        and the 'low' and 'high' values of its digest.
+        """
+        labels = np.array(list(self.groups) + [None], dtype=object)
+        ncols = len(self.cols)
+        return pd.DataFrame({
+            'by': self.by,
+            'group': labels[self.digest // ncols],
+            'metric': np.array(self.cols, dtype=object)[self.digest % ncols],
+            'mean': self.mean,
+            'weight': self.weight,
+            'low': self.low.ravel()[self.digest],
+            'high': self.high.ravel()[self.digest],
+        })
+
+    @classmethod
+    def from_frame(cls, frame, cols=None):
+        """Returns the sketches held in a frame from `to_frame`.
+
+        Args:
+            frame: the long DataFrame of centroids.
+            cols: the metric columns, defaults to those in the frame.
+
+        Returns:
+            `GroupSketches`.
+        """
+        by = frame['by'].iloc[0] if len(frame) else None
+        sketches = cls(None if pd.isna(by) else by,
+                       cols or list(dict.fromkeys(frame['metric'])))
+        groups = frame['group'].astype(object).where(
+            frame['group'].notna(), None)
+        sketches.groups = {label: i for i, label in
+                           enumerate(dict.fromkeys(groups))}
+        ncols = len(sketches.cols)
+        shape = (len(sketches.groups), ncols)
+        digest = groups.map(sketches.groups).to_numpy(dtype=np.int64) * \
+            ncols + frame['metric'].map(
+                {col: i for i, col in enumerate(sketches.cols)}) \
+            .to_numpy(dtype=np.int64)
+        sketches.low = np.full(shape, np.inf)
+        sketches.high = np.full(shape, -np.inf)
+        sketches.low.ravel()[digest] = frame['low'].to_numpy()
+        sketches.high.ravel()[digest] = frame['high'].to_numpy()
+        sketches.digest, sketches.mean, sketches.weight = compress(
+            digest, frame['mean'].to_numpy(dtype=float),
+            frame['weight'].to_numpy(dtype=float), sketches.low.size)
+        return sketches
+
+    def save(self, path):
+        """Writes the sketches to a CSV file."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.to_frame().to_csv(path, index=False)
+
+    @classmethod
+    def load(cls, path, cols=None):
+        """Reads sketches written by `save`."""
+        return cls.from_frame(pd.read_csv(path), cols)
+
+
+def accumulate(chunks, validation, sketches=None):
+    """Feeds sheet chunks into the sketches of a validation.
+
+    Args:
+        chunks: an iterable of DataFrames of raw sheet rows.
+        validation: the `main.Validation` of the sheet.
+        sketches: sketches to add to, one per grouping, new ones if None.
+
+    Returns:
+        A list of `GroupSketches`, one per grouping of the validation.
+    """
+    if sketches is None:
+        sketches = [GroupSketches(by, validation.metrics)
+                    for by, minimum_count in validation.groupings]
+    for chunk in chunks:
+        transformed = validation.transform(chunk)
+        for group_sketches in sketches:
+            group_sketches.add(transformed)
+    return sketches
+
+
+def sketch_path(directory, by):
+    """Returns the file of a grouping's sketches, named apart from the
+    `stats.stats_path` files so both can share a directory."""
+    return os.path.join(directory, '{}.sketch.csv'.format(by or 'All'))
+
+
+def save_all(sketches, directory):
+    """Writes a list of `GroupSketches` to a directory, a file per
+    grouping."""
+    for group_sketches in sketches:
+        group_sketches.save(sketch_path(directory, group_sketches.by))
+
+
+def load_all(directories, validation):
+    """Reads and merges the sketches saved in several directories.
+
+    Args:
+        directories: directories written by `save_all`, e.g. one
+            per reporting year.
+        validation: the `main.Validation` the sketches are for.
+
+    Returns:
+        A list of `GroupSketches`, one per grouping of the validation.
+    """
+    sketches = [GroupSketches(by, validation.metrics)
+                for by, minimum_count in validation.groupings]
+    for directory in directories:
+        for group_sketches in sketches:
+            group_sketches.merge(GroupSketches.load(
+                sketch_path(directory, group_sketches.by),
+                validation.metrics))
+    return sketches
+
+
+if __name__ == '__main__':
+    import main
+
+    parser = argparse.ArgumentParser(
+        description='Saves the quantile sketches of a workbook.')
+    parser.add_argument('path', help='the workbook')
+    parser.add_argument('directory', help='the directory to save to')
+    args = parser.parse_args()
+
+    sheets = main.data_in(['Vineyard', 'Winery'], path=args.path)
+    for name, validation in [('Vineyard', main.vineyard),
+                             ('Winery', main.winery)]:
+        save_all(accumulate([sheets[name]], validation),
+                 os.path.join(args.directory, name))
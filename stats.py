@@ -0,0 +1,404 @@
+"""Running group statistics for z scores.
+
+Each `GroupStats` keeps the count, mean and sum of squared deviations
+(M2) of the finite values of every metric within each group, combined
+with Welford's parallel update, and the count of its infinite values,
+e.g. ratios over a zero area. A group with any has no spread, as when
+its moments are reduced from every value at once, but as the infinities
+never enter the moments, rows can be added in batches and taken back
+out again, so the statistics follow a changing cohort without reducing
+any group again. Statistics built from separate chunks, files, workers
+or reporting years can be merged and saved between runs.
+
+Usage:
+    python stats.py data.xlsx stats/2023
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def group_moments(values: np.array, codes: np.array, ngroups: int):
+    """Returns the count, mean and M2 of each metric within each group.
+
+    Args:
+        values: a 2d array with a column per metric.
+        codes: the group of each row, -1 for rows without a group.
+        ngroups: the number of groups.
+
+    Returns:
+        A tuple of (count, mean, m2) arrays shaped (ngroups, metrics).
+        Missing values are ignored.
+    """
+    nrows, ncols = values.shape
+    valid = ~np.isnan(values) & (codes >= 0)[:, None]
+    rows = np.where(codes >= 0, codes, 0)
+    bins = (rows[:, None] * ncols + np.arange(ncols))[valid]
+    size = ngroups * ncols
+
+    count = np.bincount(bins, minlength=size).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(bins, weights=values[valid], minlength=size) \
+            / count
+        mean[count == 0] = 0
+        deviation = values - mean.reshape(ngroups, ncols)[rows]
+        m2 = np.bincount(bins, weights=deviation[valid] ** 2,
+                         minlength=size)
+
+    shape = (ngroups, ncols)
+    return count.reshape(shape), mean.reshape(shape), m2.reshape(shape)
+
+
+def finite_moments(values: np.array, codes: np.array, ngroups: int):
+    """Returns the moments of the finite values of each metric within
+    each group, and the number of infinite ones.
+
+    Args:
+        values: a 2d array with a column per metric.
+        codes: the group of each row, -1 for rows without a group.
+        ngroups: the number of groups.
+
+    Returns:
+        A tuple of (count, mean, m2, nonfinite) arrays shaped (ngroups,
+        metrics), see `group_moments`.
+    """
+    infinite = np.isinf(values)
+    count, mean, m2 = group_moments(np.where(infinite, np.nan, values),
+                                    codes, ngroups)
+    nonfinite = group_moments(np.where(infinite, 1.0, np.nan), codes,
+                              ngroups)[0]
+    return count, mean, m2, nonfinite
+
+
+def rollup(count, mean, m2, parent, ngroups):
+    """Combines the moments of groups into the moments of their parents.
+
+    Args:
+        count, mean, m2: arrays shaped (groups, metrics), e.g. from
+            `group_moments`.
+        parent: the parent of each group, -1 for groups without one.
+        ngroups: the number of parents.
+
+    Returns:
+        A tuple of (count, mean, m2) arrays shaped (ngroups, metrics).
+    """
+    ncols = count.shape[1]
+    valid = np.broadcast_to((parent >= 0)[:, None], count.shape)
+    bins = (np.where(parent >= 0, parent, 0)[:, None] * ncols +
+            np.arange(ncols))[valid]
+    size = ngroups * ncols
+    total = np.bincount(bins, weights=count[valid], minlength=size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        combined = np.bincount(bins, weights=(count * mean)[valid],
+                               minlength=size) / total
+        combined[total == 0] = 0
+        shape = (ngroups, ncols)
+        combined = combined.reshape(shape)
+        deviation = mean - combined[np.where(parent >= 0, parent, 0)]
+        spread = np.bincount(bins,
+                             weights=(m2 + count * deviation ** 2)[valid],
+                             minlength=size)
+    return total.reshape(shape), combined, spread.reshape(shape)
+
+
+def metric_values(df, cols):
+    """Returns metrics as a float matrix, zeros read as blanks.
+
+    The survey uses zero for none, so zeros are left out of the
+    statistics like blank answers, as they always have been, including
+    zeros a member entered.
+    """
+    values = df[cols].to_numpy(dtype=float)
+    return np.where(values == 0, np.nan, values)
+
+
+class GroupStats:
+    """Count, mean and M2 of metric columns within the groups of a column.
+
+    The moments are of the finite values, and `nonfinite` counts the
+    infinite ones.
+
+    Args:
+        by: the grouping column, or None for a single group of all rows.
+        cols: the metric columns.
+    """
+
+    def __init__(self, by, cols):
+        self.by = by
+        self.cols = list(cols)
+        self.groups = {}
+        self.count = np.zeros((0, len(self.cols)))
+        self.mean = np.zeros((0, len(self.cols)))
+        self.m2 = np.zeros((0, len(self.cols)))
+        self.nonfinite = np.zeros((0, len(self.cols)))
+
+    def factorize(self, df):
+        """Returns the group code of each row and the group labels."""
+        if self.by is None:
+            return np.zeros(len(df), dtype=np.intp), [None]
+        codes, uniques = pd.factorize(df[self.by])
+        return codes, list(uniques)
+
+    def codes(self, df):
+        """Returns the row of the statistics for each row of a DataFrame.
+
+        Args:
+            df: the DataFrame holding the grouping column.
+
+        Returns:
+            An array of rows, -1 for rows without a known group.
+        """
+        codes, uniques = self.factorize(df)
+        lookup = np.array([self.groups.get(label, -1) for label in uniques]
+                          + [-1], dtype=np.intp)
+        return lookup[codes]
+
+    def values(self, df):
+        return metric_values(df, self.cols)
+
+    def chunk(self, df):
+        """Returns the statistics of the rows of a DataFrame alone."""
+        codes, uniques = self.factorize(df)
+        chunk = GroupStats(self.by, self.cols)
+        chunk.groups = {label: i for i, label in enumerate(uniques)}
+        chunk.count, chunk.mean, chunk.m2, chunk.nonfinite = \
+            finite_moments(self.values(df), codes, len(uniques))
+        return chunk
+
+    def add(self, df):
+        """Adds the rows of a DataFrame to the statistics."""
+        return self.merge(self.chunk(df))
+
+    def remove(self, df):
+        """Takes rows added before out of the statistics.
+
+        Args:
+            df: the rows as they were added, e.g. the old rows of
+                changed members.
+
+        Returns:
+            This `GroupStats`.
+        """
+        chunk = self.chunk(df)
+        rows = [self.groups[label] for label in chunk.groups]
+        count, mean, m2 = self.count[rows], self.mean[rows], self.m2[rows]
+        left = count - chunk.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # The reverse of the update in `merge`
+            rest = (count * mean - chunk.count * chunk.mean) / left
+            delta = chunk.mean - rest
+            m2 = m2 - chunk.m2 - delta ** 2 * left * chunk.count / count
+        # Groups left without values are emptied exactly, and round-off
+        # can't leave a negative M2
+        self.mean[rows] = np.where(left > 0, rest, 0)
+        self.m2[rows] = np.where(left > 1, np.maximum(m2, 0), 0)
+        self.count[rows] = left
+        self.nonfinite[rows] -= chunk.nonfinite
+        return self
+
+    def merge(self, other):
+        """Adds the statistics of another `GroupStats` of the same metrics.
+
+        Args:
+            other: statistics built from other rows, e.g. another chunk,
+                file, worker or reporting year.
+
+        Returns:
+            This `GroupStats`.
+        """
+        if other.cols != self.cols:
+            raise ValueError('Can only merge statistics of the same '
+                             'metrics, {} != {}'.format(other.cols,
+                                                        self.cols))
+        for label in other.groups:
+            self.groups.setdefault(label, len(self.groups))
+        rows = [self.groups[label] for label in other.groups]
+        shape = (len(self.groups), len(self.cols))
+        count, mean, m2 = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+        count[rows], mean[rows], m2[rows] = \
+            other.count, other.mean, other.m2
+        self.nonfinite = np.vstack([self.nonfinite, np.zeros(
+            (shape[0] - len(self.nonfinite), shape[1]))])
+        self.nonfinite[rows] += other.nonfinite
+        for name in ['count', 'mean', 'm2']:
+            own = getattr(self, name)
+            setattr(self, name, np.vstack(
+                [own, np.zeros((shape[0] - len(own), shape[1]))]))
+
+        total = self.count + count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = mean - self.mean
+            self.mean = np.where(
+                total > 0, self.mean + delta * count / total, 0)
+            self.m2 = np.where(
+                total > 0,
+                self.m2 + m2 + delta ** 2 * self.count * count / total, 0)
+        self.count = total
+        return self
+
+    def total(self):
+        """Returns the number of values, finite or not, of each group and
+        metric."""
+        return self.count + self.nonfinite
+
+    def std(self, minimum_count=0):
+        """Returns the standard deviation of each group and metric.
+
+        Uses one degree of freedom, and is NaN where a group has
+        `minimum_count` values or fewer, or any infinite value.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(self.m2 / (self.count - 1))
+        std[(self.total() <= minimum_count) | (self.nonfinite > 0)] = np.nan
+        return std
+
+    def zscores(self, df, minimum_count=0):
+        """Returns the z score of each value against its group.
+
+        Args:
+            df: the DataFrame to score.
+            minimum_count: groups with this many values or fewer in a
+                metric give no z scores for that metric.
+
+        Returns:
+            A 2d array of z scores with a column per metric.
+        """
+        values = self.values(df)
+        codes = self.codes(df)
+        rows = np.where(codes >= 0, codes, 0)
+        if not len(self.groups):
+            return np.full(values.shape, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = (values - self.mean[rows]) / self.std(minimum_count)[rows]
+        z[codes < 0] = np.nan
+        return z
+
+    def to_frame(self):
+        """Returns the statistics as a long DataFrame.
+
+        There is a row per group and metric with the grouping column in
+        'by', the group in 'group' and the 'count', 'mean', 'm2' and
+        'nonfinite'.
+        """
+        labels = list(self.groups)
+        return pd.DataFrame({
+            'by': self.by,
+            'group': np.repeat(labels, len(self.cols)),
+            'metric': np.tile(self.cols, len(labels)),
+            'count': self.count.ravel(),
+            'mean': self.mean.ravel(),
+            'm2': self.m2.ravel(),
+            'nonfinite': self.nonfinite.ravel(),
+        })
+
+    @classmethod
+    def from_frame(cls, frame, cols=None):
+        """Returns the statistics held in a frame from `to_frame`.
+
+        Args:
+            frame: the long DataFrame of statistics.
+            cols: the metric columns, defaults to those in the frame.
+
+        Returns:
+            A `GroupStats`.
+        """
+        by = frame['by'].iloc[0] if len(frame) else None
+        stats = cls(None if pd.isna(by) else by,
+                    cols or list(dict.fromkeys(frame['metric'])))
+        groups = frame['group'].astype(object).where(
+            frame['group'].notna(), None)
+        stats.groups = {label: i for i, label in
+                        enumerate(dict.fromkeys(groups))}
+        shape = (len(stats.groups), len(stats.cols))
+        rows = groups.map(stats.groups).to_numpy()
+        metrics = frame['metric'].map(
+            {col: i for i, col in enumerate(stats.cols)}).to_numpy()
+        for name in ['count', 'mean', 'm2', 'nonfinite']:
+            values = np.zeros(shape)
+            # Files saved before infinite values were counted have none
+            if name in frame:
+                values[rows, metrics] = frame[name].to_numpy()
+            setattr(stats, name, values)
+        return stats
+
+    def save(self, path):
+        """Writes the statistics to a CSV file."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.to_frame().to_csv(path, index=False)
+
+    @classmethod
+    def load(cls, path, cols=None):
+        """Reads statistics written by `save`."""
+        return cls.from_frame(pd.read_csv(path), cols)
+
+
+def stats_path(directory, by):
+    return os.path.join(directory, '{}.csv'.format(by or 'All'))
+
+
+def accumulate(chunks, validation, stats=None):
+    """Feeds sheet chunks into the group statistics of a validation.
+
+    Only the statistics are kept, so the sheet never has to fit in
+    memory at once.
+
+    Args:
+        chunks: an iterable of DataFrames of raw sheet rows.
+        validation: the `main.Validation` of the sheet.
+        stats: statistics to add to, one per grouping, new ones if None.
+
+    Returns:
+        A list of `GroupStats`, one per grouping of the validation.
+    """
+    if stats is None:
+        stats = [GroupStats(by, validation.metrics)
+                 for by, minimum_count in validation.groupings]
+    for chunk in chunks:
+        transformed = validation.transform(chunk)
+        for group_stats in stats:
+            group_stats.add(transformed)
+    return stats
+
+
+def save_all(stats, directory):
+    """Writes a list of `GroupStats` to a directory, a file per grouping."""
+    for group_stats in stats:
+        group_stats.save(stats_path(directory, group_stats.by))
+
+
+def load_all(directories, validation):
+    """Reads and merges the statistics saved in several directories.
+
+    Args:
+        directories: directories written by `save_all`, e.g. one per
+            reporting year.
+        validation: the `main.Validation` the statistics are for.
+
+    Returns:
+        A list of `GroupStats`, one per grouping of the validation.
+    """
+    stats = [GroupStats(by, validation.metrics)
+             for by, minimum_count in validation.groupings]
+    for directory in directories:
+        for group_stats in stats:
+            group_stats.merge(GroupStats.load(
+                stats_path(directory, group_stats.by), validation.metrics))
+    return stats
+
+
+if __name__ == '__main__':
+    import main
+
+    parser = argparse.ArgumentParser(
+        description='Saves the group statistics of a workbook.')
+    parser.add_argument('path', help='the workbook')
+    parser.add_argument('directory', help='the directory to save to')
+    args = parser.parse_args()
+
+    sheets = main.data_in(['Vineyard', 'Winery'], path=args.path)
+    for name, validation in [('Vineyard', main.vineyard),
+                             ('Winery', main.winery)]:
+        save_all(accumulate([sheets[name]], validation),
+                 os.path.join(args.directory, name))
@@ -0,0 +1,185 @@
+"""Validates a sheet in row chunks so memory stays under a set limit.
+
+The sheet is streamed out of the workbook twice. The first pass feeds
+each chunk into the group statistics, which are all that is kept, and
+the second pass scores each chunk against them, runs the rules and
+appends the problems to a CSV file. The chunk size is picked from the
+memory used by the first chunk so a chunk and its derived columns fit
+well within `memory_limit`.
+
+Usage:
+    python stream.py data.xlsx --memory-limit 256
+"""
+import argparse
+import os
+import time
+
+import pandas as pd
+from openpyxl import load_workbook
+
+import main
+from loader import normalise_index
+from outliers import unusual
+from rules import evaluate
+import schema
+from stats import accumulate
+
+#############
+# variables
+
+memory_limit = 256  # MB
+first_chunk_size = 1000
+
+
+def column_names(header):
+    """Returns column names the way pandas names them.
+
+    Blank names become 'Unnamed: <position>' and repeated names get a
+    '.1', '.2', ... suffix, e.g. 'Applied.1'.
+    """
+    names, seen = [], {}
+    for i, name in enumerate(header):
+        name = 'Unnamed: {}'.format(i) if name is None else name
+        if name in seen:
+            seen[name] += 1
+            renamed = '{}.{}'.format(name, seen[name])
+            while renamed in seen:
+                seen[name] += 1
+                renamed = '{}.{}'.format(name, seen[name])
+            seen[renamed] = 0
+            name = renamed
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+class ChunkReader:
+    """Iterates over a sheet a chunk of rows at a time.
+
+    The chunk size is read before every chunk so it can be changed while
+    iterating.
+
+    Args:
+        path: the workbook path.
+        sheet_name: the sheet to read.
+        chunk_size: the number of rows in each chunk.
+        header: the row holding the column names.
+        index: a member number column to use as the index, see
+            `loader.normalise_index`.
+    """
+
+    def __init__(self, path, sheet_name, chunk_size=1000,
+                 header=1, index='Membership Number'):
+        self.path = path
+        self.sheet_name = sheet_name
+        self.chunk_size = chunk_size
+        self.header = header
+        self.index = index
+
+    def __iter__(self):
+        workbook = load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            rows = workbook[self.sheet_name].iter_rows(values_only=True)
+            for i in range(self.header):
+                next(rows, None)
+            names = column_names(next(rows, ()))
+
+            chunk = []
+            for row in rows:
+                if any(value is not None for value in row):
+                    chunk.append(row)
+                if len(chunk) >= self.chunk_size:
+                    yield self.frame(chunk, names)
+                    chunk = []
+            if chunk:
+                yield self.frame(chunk, names)
+        finally:
+            workbook.close()
+
+    def frame(self, rows, names):
+        data = pd.DataFrame.from_records(rows, columns=names).infer_objects()
+        data = data.loc[:, ~data.columns.duplicated()]
+        # Blank columns are floats in read_excel, not objects
+        blank = data.columns[data.isna().all().to_numpy()]
+        data[blank] = data[blank].astype(float)
+        if self.index is not None:
+            data = normalise_index(data, self.index)
+        return schema.apply(data)
+
+
+def fit_chunk_size(chunk, transformed, limit=None):
+    """Returns the rows per chunk that keep a chunk within the limit.
+
+    Args:
+        chunk: a chunk of raw rows.
+        transformed: the chunk after the validation's transform.
+        limit: the memory limit in MB, defaults to `memory_limit`.
+
+    Returns:
+        The number of rows, leaving half the limit for temporaries.
+    """
+    used = chunk.memory_usage(deep=True).sum() + \
+        transformed.memory_usage(deep=True).sum()
+    per_row = max(used / max(len(chunk), 1), 1)
+    return max(int((limit or memory_limit) * 2 ** 20 / 2 / per_row), 1)
+
+
+def stream_validate(path, sheet_name, validation, output, limit=None):
+    """Validates a sheet chunk by chunk and writes its problems to CSV.
+
+    Args:
+        path: the workbook path.
+        sheet_name: the sheet to validate.
+        validation: the `main.Validation` for the sheet.
+        output: the CSV file the problems are appended to.
+        limit: the memory limit in MB, defaults to `memory_limit`.
+
+    Returns:
+        The number of members with problems.
+    """
+    start = time.perf_counter()
+    reader = ChunkReader(path, sheet_name, first_chunk_size)
+
+    def sized(chunks):
+        for i, chunk in enumerate(chunks):
+            if i == 0:
+                reader.chunk_size = fit_chunk_size(
+                    chunk, validation.transform(chunk), limit)
+            yield chunk
+
+    stats = accumulate(sized(reader), validation)
+
+    if os.path.exists(output):
+        os.remove(output)
+    members = flagged = 0
+    for chunk in reader:
+        df = validation.transform(chunk)
+        problems = unusual(
+            df, validation.metrics, validation.groupings, main.threshold,
+            validation.suffix, validation.report, stats=stats)
+        problems = main.output_problems(
+            pd.concat([problems, evaluate(validation.rules, df)], axis=1))
+        problems.to_csv(output, mode='a', header=not members,
+                        index_label='Membership Number')
+        members += len(chunk)
+        flagged += len(problems)
+
+    print('{}: {} of {} members with problems, chunks of {} rows '
+          '({:.2f}s)'.format(sheet_name, flagged, members,
+                             reader.chunk_size, time.perf_counter() - start))
+    return flagged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', nargs='?', default='data.xlsx',
+                        help='the workbook to validate')
+    parser.add_argument('--memory-limit', type=float, default=memory_limit,
+                        help='the memory limit in MB')
+    args = parser.parse_args()
+
+    stream_validate(args.path, 'Vineyard', main.vineyard,
+                    'problems_vineyard.csv', args.memory_limit)
+    stream_validate(args.path, 'Winery', main.winery,
+                    'problems_winery.csv', args.memory_limit)
@@ -0,0 +1,59 @@
+"""Incremental revalidation gives the same problems as a full run."""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import api  # noqa: E402
+import bench  # noqa: E402
+from clean import proc_vineyard  # noqa: E402
+import incremental  # noqa: E402
+import main  # noqa: E402
+from stats import GroupStats  # noqa: E402
+
+
+def test_matches_full_run_after_changes_and_removals(tmp_path):
+    data = api.prepare(bench.synthetic_vineyard(3000))
+    incremental.revalidate(data, main.vineyard, 'Vineyard', tmp_path)
+
+    # Removing every member with an infinite ratio has to clear them out
+    # of their groups' statistics
+    transformed = main.vineyard.transform(data)
+    infinite = np.isinf(transformed[main.vineyard.metrics].to_numpy(
+        dtype=float)).any(axis=1)
+    changed = data.drop(data.index[infinite])
+    column = 'Grapes harvested (t)'
+    members = changed.index[:50]
+    changed.loc[members, column] = changed.loc[members, column] * 3
+
+    problems = incremental.revalidate(changed, main.vineyard, 'Vineyard',
+                                      tmp_path)
+    full = incremental.revalidate(changed, main.vineyard, 'Vineyard',
+                                  tmp_path / 'full', full=True)
+    assert infinite.sum() > 0
+    pd.testing.assert_frame_equal(problems, full)
+
+    state = pd.read_pickle(tmp_path / 'Vineyard.pkl')
+    pd.testing.assert_frame_equal(state['processed'],
+                                  proc_vineyard(changed))
+
+
+def test_removing_rows_matches_statistics_of_the_rest():
+    transformed = main.vineyard.transform(
+        api.prepare(bench.synthetic_vineyard(3000)))
+    removed = np.random.default_rng(0).random(len(transformed)) < 0.3
+    for by, minimum_count in main.vineyard.groupings:
+        stats = GroupStats(by, main.vineyard.metrics).add(transformed) \
+            .remove(transformed[removed])
+        rest = GroupStats(by, main.vineyard.metrics).add(
+            transformed[~removed])
+        assert stats.nonfinite.sum() > 0
+        rows = [stats.groups[label] for label in rest.groups]
+        for name in ['count', 'nonfinite', 'mean', 'm2']:
+            np.testing.assert_allclose(getattr(stats, name)[rows],
+                                       getattr(rest, name), rtol=1e-9,
+                                       atol=1e-9)
@@ -0,0 +1,96 @@
+"""Checkpointed runs give the same problems as a full run and rerun only
+the stages whose code, settings or data files changed."""
+import os
+import shutil
+import sys
+import tempfile
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import bench  # noqa: E402
+import classify  # noqa: E402
+import instrument  # noqa: E402
+import main  # noqa: E402
+import pipeline  # noqa: E402
+
+exports = [pipeline.step(name, 'export')
+           for name in pipeline.sheet_names + [pipeline.cross_sheet]]
+
+
+def check(path, directory, validations=None, full=False):
+    """Returns the exports of a pipeline run and the stages it ran."""
+    stages = pipeline.stages(path, validations)
+    found = pipeline.Pipeline(stages, path, directory, full)
+    with instrument.recording() as recorded:
+        frames = {name: found.output(name) for name in exports}
+    names = {stage.name for stage in stages}
+    return frames, {record['stage'] for record in recorded.records
+                    if record['stage'] in names}
+
+
+def workbook(tmp_path):
+    path = str(tmp_path / 'data.xlsx')
+    bench.synthetic_workbook(path, 1000)
+    return path
+
+
+def test_resumed_run_matches_full_run(tmp_path):
+    path = workbook(tmp_path)
+    directory = str(tmp_path / 'checkpoints')
+    first, ran = check(path, directory)
+    resumed, rerun = check(path, directory)
+    full, ran_full = check(path, directory, full=True)
+
+    assert rerun == set()
+    assert ran == ran_full
+    for name in exports:
+        pd.testing.assert_frame_equal(resumed[name], full[name])
+        pd.testing.assert_frame_equal(first[name], full[name])
+
+
+def test_editing_a_rule_reruns_only_its_rules_and_export(tmp_path):
+    path = workbook(tmp_path)
+    directory = str(tmp_path / 'checkpoints')
+    check(path, directory)
+
+    rules = list(main.vineyard.rules)
+    i = next(i for i, rule in enumerate(rules) if rule.where is not None)
+    rules[i] = rules[i]._replace(
+        where=lambda columns, where=rules[i].where: ~where(columns))
+    edited = [main.vineyard._replace(rules=rules), main.winery]
+    frames, ran = check(path, directory, edited)
+
+    assert ran == {'Vineyard: rules', 'Vineyard: export'}
+    full, ran_full = check(path, directory, edited, full=True)
+    pd.testing.assert_frame_equal(frames['Vineyard: export'],
+                                  full['Vineyard: export'])
+
+
+def test_changing_a_data_file_reruns_the_transform(tmp_path, monkeypatch):
+    path = workbook(tmp_path)
+    directory = str(tmp_path / 'checkpoints')
+    # Only files beside the code are hashed by their contents
+    climates = tempfile.NamedTemporaryFile(
+        'w', suffix='.csv', dir=pipeline.here, delete=False)
+    climates.close()
+    try:
+        shutil.copyfile(classify.climates_path, climates.name)
+        monkeypatch.setattr(classify, 'climates_path', climates.name)
+        check(path, directory)
+
+        # The first region moves to another climate
+        table = pd.read_csv(climates.name)
+        table.iloc[0, 1] = next(climate for climate in table.iloc[:, 1]
+                                if climate != table.iloc[0, 1])
+        table.to_csv(climates.name, index=False)
+        classify.load_climates.cache_clear()
+        frames, ran = check(path, directory)
+    finally:
+        os.remove(climates.name)
+        classify.load_climates.cache_clear()
+
+    assert 'Vineyard: transform' in ran
+    assert not {'Vineyard: load', 'Vineyard: clean'} & ran
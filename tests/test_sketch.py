@@ -0,0 +1,63 @@
+"""Quantile sketches agree with the exact statistics of their rows."""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from sketch import GroupSketches  # noqa: E402
+
+# The t-digest is approximate: a quantile may be off by this much in
+# rank, e.g. the median read as the 49.5th to 50.5th percentile
+rank_tolerance = 0.005
+# and a MAD by this fraction of the exact one
+mad_tolerance = 0.03
+quantiles = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+cols = ['skewed', 'normal']
+
+
+def sample(rows=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'group': rng.integers(0, 4, rows),
+                         'skewed': rng.lognormal(3, 1, rows),
+                         'normal': rng.normal(50, 10, rows)})
+
+
+def assert_matches_rows(sketches, df):
+    mads = sketches.mad()
+    for q in quantiles:
+        found = sketches.quantile(q)
+        for label, i in sketches.groups.items():
+            for j, col in enumerate(cols):
+                values = df.loc[df['group'] == label, col].to_numpy()
+                rank = (values < found[i, j]).mean()
+                assert abs(rank - q) <= rank_tolerance, (label, col, q)
+    for label, i in sketches.groups.items():
+        for j, col in enumerate(cols):
+            values = df.loc[df['group'] == label, col].to_numpy()
+            mad = np.median(np.abs(values - np.median(values)))
+            np.testing.assert_allclose(mads[i, j], mad, rtol=mad_tolerance)
+
+
+def test_quantiles_and_mad_match_exact_values():
+    df = sample()
+    assert_matches_rows(GroupSketches('group', cols).add(df), df)
+
+
+def test_merged_sketches_match_sketching_all_rows():
+    df = sample()
+    whole = GroupSketches('group', cols).add(df)
+    merged = GroupSketches('group', cols)
+    for i in range(7):
+        merged.merge(GroupSketches('group', cols).add(df.iloc[i::7]))
+
+    assert_matches_rows(merged, df)
+    rows = [merged.groups[label] for label in whole.groups]
+    np.testing.assert_array_equal(merged.count()[rows], whole.count())
+    np.testing.assert_array_equal(merged.low[rows], whole.low)
+    np.testing.assert_array_equal(merged.high[rows], whole.high)
+    np.testing.assert_allclose(merged.mad()[rows], whole.mad(),
+                               rtol=2 * mad_tolerance)
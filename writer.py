@@ -0,0 +1,129 @@
+"""Writes problems frames as Excel, CSV or Parquet files.
+
+Excel is written with xlsxwriter's constant_memory mode, which flushes
+each row to disk as soon as the next one starts. pandas' to_excel writes
+a column at a time, which that mode can't take, so rows are written
+directly. The time and size of every file written are reported, and
+on request, the --write-memory option of the command lines, the peak
+Python memory of writing it, traced with tracemalloc in a second write
+so the tracing doesn't slow the timed one.
+"""
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+import instrument
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+formats = ['xlsx', 'csv', 'parquet']
+
+
+def rows(problems):
+    """Yields the header and each row of a problems frame as lists,
+    with missing values as None."""
+    yield [problems.index.name or ''] + list(problems.columns)
+    # A copy, as the array of a frame can be read-only under copy on write
+    values = problems.astype(object).to_numpy(copy=True)
+    values[pd.isna(values)] = None
+    for index, row in zip(problems.index, values):
+        yield [index] + row.tolist()
+
+
+def write_excel(frames, path):
+    """Writes problems frames to the sheets of one Excel workbook.
+
+    Args:
+        frames: a dict of problems DataFrames keyed by sheet name.
+        path: the workbook to write.
+    """
+    if xlsxwriter is None:
+        with pd.ExcelWriter(path) as excel:
+            for name, problems in frames.items():
+                problems.to_excel(excel, sheet_name=name)
+        return
+
+    workbook = xlsxwriter.Workbook(
+        path, {'constant_memory': True, 'nan_inf_to_errors': True})
+    for name, problems in frames.items():
+        worksheet = workbook.add_worksheet(name)
+        for i, row in enumerate(rows(problems)):
+            worksheet.write_row(i, 0, row)
+    workbook.close()
+
+
+def write_one(frames, path, format):
+    if format == 'xlsx':
+        write_excel(frames, path)
+    else:
+        (problems,) = frames.values()
+        if format == 'csv':
+            problems.to_csv(path)
+        elif format == 'parquet':
+            problems.to_parquet(path)
+        else:
+            raise ValueError('Unknown format {}, expected one of {}'.format(
+                format, formats))
+
+
+def traced_peak(function, *args):
+    """Returns the peak Python memory of a call in MB, traced with
+    tracemalloc, or None while something else is tracing, as resetting
+    the peak would lose theirs."""
+    if tracemalloc.is_tracing():
+        return None
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def write(frames, format='xlsx', directory='.', combined=False,
+          memory=False):
+    """Writes problems frames and reports what each file cost.
+
+    Args:
+        frames: a dict of problems DataFrames keyed by sheet name, e.g.
+            {'Vineyard': ..., 'Winery': ...}.
+        format: one of `formats`.
+        directory: the directory to write to.
+        combined: write one problems.xlsx with a sheet per frame instead
+            of a problems_<sheet> file per frame, Excel only.
+        memory: also write each file again under tracemalloc to report
+            its peak Python memory.
+
+    Returns:
+        A DataFrame with the seconds, file MB and, with `memory`, peak MB
+        of each file.
+    """
+    if combined and format != 'xlsx':
+        raise ValueError('Only xlsx output can be combined')
+    if combined:
+        outputs = {os.path.join(directory, 'problems.xlsx'): frames}
+    else:
+        outputs = {os.path.join(directory, 'problems_{}.{}'.format(
+            name.lower(), format)): {name: problems}
+            for name, problems in frames.items()}
+
+    report = {}
+    for path, sheets in outputs.items():
+        start = time.perf_counter()
+        with instrument.stage('write ' + path, sum(
+                len(problems) for problems in sheets.values())):
+            write_one(sheets, path, format)
+        report[path] = {'Seconds': time.perf_counter() - start,
+                        'File MB': os.path.getsize(path) / 2 ** 20}
+        if memory:
+            report[path]['Peak MB'] = traced_peak(
+                write_one, sheets, path, format)
+
+    report = pd.DataFrame.from_dict(report, orient='index')
+    print(report.round(3).to_string())
+    return report